@@ -0,0 +1,65 @@
+"""
+Times opening a document from its Fountain file with FountainParser, against
+loading it from the .blocks cache server.BlocksCache keeps next to it.
+
+Run with: python -m benchmarks.BlocksCache
+"""
+import os
+import shutil
+import tempfile
+import time
+
+from common.FountianParser import FountainParser
+from server.BlocksCache import decode_cache, encode_cache
+
+REPEATS = 5
+
+
+def best_of(function) -> float:
+    best = float("inf")
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    with open(os.path.join(os.path.dirname(__file__), "..", "test.fountain"), "r", encoding="utf-8") as f:
+        script = f.read()
+    directory = tempfile.mkdtemp()
+    try:
+        print(f"Opening a document, best of {REPEATS}")
+        print(f"{'blocks':>7} {'fountain KB':>11} {'parse':>9} {'cache':>9} {'speedup':>8}")
+        for copies in (1, 10, 50):
+            path = os.path.join(directory, f"doc{copies}.fountain")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(script * copies)
+            source = os.stat(path)
+
+            def parse():
+                parser = FountainParser()
+                with open(path, "r", encoding="utf-8") as f_:
+                    parser.parse(f_.read())
+                return parser.blocks
+
+            blocks = parse()
+            cache = path + ".blocks"
+            with open(cache, "wb") as f:
+                f.write(encode_cache(source, blocks))
+
+            def load():
+                with open(cache, "rb") as f_:
+                    return decode_cache(f_.read(), source)
+
+            assert len(load()) == len(blocks)
+            parse_time = best_of(parse)
+            load_time = best_of(load)
+            print(f"{len(blocks):>7} {source.st_size / 1024:>11.0f} {parse_time * 1000:>7.1f}ms "
+                  f"{load_time * 1000:>7.1f}ms {parse_time / load_time:>7.1f}x")
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
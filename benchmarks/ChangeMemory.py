@@ -0,0 +1,80 @@
+"""
+Compares the memory used by change objects with a __dict__, as BlockChanged
+subclasses used to be, with the slotted ones in common.BlockPatches.
+
+Run with: python -m benchmarks.ChangeMemory
+"""
+import gc
+import tracemalloc
+
+from common.BlockPatches import (BlockAddChange, BlockRemoveChange, BlockDataAddChange, BlockDataRemoveChange,
+                                 BlockChangedType)
+from common.Blocks import Block, BlockType
+
+OBJECTS = 100000
+
+
+class LegacyChange:
+    """The attributes every BlockChanged had, stored in a per-instance __dict__."""
+    COUNT = 0
+
+    def __init__(self, block_id, start=0, length=0):
+        self.start = start
+        self.length = length
+        self.block_id = block_id
+        self.change_id = LegacyChange.COUNT
+        LegacyChange.COUNT += 1
+
+
+class LegacyAddChange(LegacyChange):
+    def __init__(self, block_id, block):
+        super().__init__(block_id)
+        self.block = block
+
+
+class LegacyDataAddChange(LegacyChange):
+    def __init__(self, position, data, block_id):
+        super().__init__(block_id, position)
+        self.data = data
+
+
+class LegacyChangedType(LegacyChange):
+    def __init__(self, block_id, block_type):
+        super().__init__(block_id)
+        self.block_type = block_type
+
+
+def allocated_per_object(create) -> float:
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objects = [create(i) for i in range(OBJECTS)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    # Without the list holding them.
+    size = after - before - len(objects) * 8
+    del objects
+    return size / OBJECTS
+
+
+def main():
+    block = Block(BlockType.ACTION, ["text"])
+    data = ["x"]
+    cases = (
+        ("BlockAddChange", lambda i: LegacyAddChange(i, block), lambda i: BlockAddChange(i, block)),
+        ("BlockRemoveChange", lambda i: LegacyChange(i), lambda i: BlockRemoveChange(i)),
+        ("BlockDataAddChange", lambda i: LegacyDataAddChange(i, data, 0), lambda i: BlockDataAddChange(i, data, 0)),
+        ("BlockDataRemoveChange", lambda i: LegacyChange(0, i, 1), lambda i: BlockDataRemoveChange(i, 1, 0)),
+        ("BlockChangedType", lambda i: LegacyChangedType(i, BlockType.ACTION),
+         lambda i: BlockChangedType(i, BlockType.ACTION)),
+    )
+    print(f"Bytes per object, {OBJECTS} objects of each")
+    print(f"{'change':>22} {'__dict__':>9} {'__slots__':>10} {'saved':>6}")
+    for name, legacy, slotted in cases:
+        legacy_size = allocated_per_object(legacy)
+        slotted_size = allocated_per_object(slotted)
+        print(f"{name:>22} {legacy_size:>9.0f} {slotted_size:>10.0f} {1 - slotted_size / legacy_size:>6.0%}")
+
+
+if __name__ == '__main__':
+    main()
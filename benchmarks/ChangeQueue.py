@@ -0,0 +1,85 @@
+"""
+Compares the plain list change_queue BlockPatch used to have with ChangeQueue,
+on the operations run on every acknowledgement and frozen-branch upload.
+
+Run with: python -m benchmarks.ChangeQueue
+"""
+import time
+
+from common.BlockPatches import BlockPatch, BlockDataAddChange
+from common.ChangeQueue import ChangeQueue
+
+PENDING_CHANGES = 10000
+# Changes acknowledged, or dropped, at a time.
+STEP = 10
+
+
+class LegacyQueue:
+    """The list based operations BlockPatch had before ChangeQueue."""
+
+    def __init__(self, entries):
+        self.change_queue = list(entries)
+
+    def drop_changes_with_smaller_change_id(self, change_id):
+        for v in self.change_queue.copy():
+            id_, _change = v
+            if id_ < change_id:
+                self.change_queue.remove(v)
+
+    def remove_change(self, remove_ids):
+        removed_list = []
+        for id_, change in self.change_queue:
+            if id_ not in remove_ids:
+                removed_list.append((id_, change))
+        self.change_queue = removed_list
+
+
+def build_entries():
+    return [(i, BlockDataAddChange(i, "x", 0)) for i in range(PENDING_CHANGES)]
+
+
+def time_acks(queue, remove) -> float:
+    start = time.perf_counter()
+    for first_id in range(0, PENDING_CHANGES, STEP):
+        remove(queue, set(range(first_id, first_id + STEP)))
+    return time.perf_counter() - start
+
+
+def time_drops(queue, drop) -> float:
+    start = time.perf_counter()
+    for first_id in range(STEP, PENDING_CHANGES + STEP, STEP):
+        drop(queue, first_id)
+    return time.perf_counter() - start
+
+
+def main():
+    entries = build_entries()
+
+    def legacy_remove(queue, ids):
+        queue.remove_change(ids)
+
+    def patch_remove(patch, ids):
+        patch.change_queue.remove_ids(ids)
+
+    def legacy_drop(queue, change_id):
+        queue.drop_changes_with_smaller_change_id(change_id)
+
+    def patch_drop(patch, change_id):
+        patch.drop_changes_with_smaller_change_id(change_id)
+
+    def new_patch():
+        patch = BlockPatch()
+        patch.change_queue = ChangeQueue(entries)
+        return patch
+
+    print(f"{PENDING_CHANGES} pending changes, {STEP} removed at a time")
+    print(f"{'operation':>22} {'list':>10} {'ChangeQueue':>12} {'speedup':>8}")
+    for name, legacy_time, new_time in (
+        ("remove acked ids", time_acks(LegacyQueue(entries), legacy_remove), time_acks(new_patch(), patch_remove)),
+        ("drop smaller ids", time_drops(LegacyQueue(entries), legacy_drop), time_drops(new_patch(), patch_drop)),
+    ):
+        print(f"{name:>22} {legacy_time * 1000:>8.1f}ms {new_time * 1000:>10.1f}ms {legacy_time / new_time:>7.0f}x")
+
+
+if __name__ == '__main__':
+    main()
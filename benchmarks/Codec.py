@@ -0,0 +1,54 @@
+"""
+Encodes and decodes a 5000 block SyncDoc with the version 1 payload encoding
+(to_bytes and from_msg) and the version 2 one of common.Codec.
+
+Run with: python -m benchmarks.Codec
+"""
+import random
+import time
+
+from common.Blocks import Block, BlockType, Style
+from common.ProjectEndpoints import SyncDoc
+
+BLOCKS = 5000
+ROUNDS = 5
+WORDS = ("the", "door", "opens", "slowly", "she", "looks", "back", "at", "him", "and", "smiles")
+
+
+def build_document() -> SyncDoc:
+    rnd = random.Random(17)
+    blocks = []
+    for i in range(BLOCKS):
+        text = " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(3, 30)))
+        if i % 4 == 0:
+            contents = [text[:10], Style.ITALICS, text[10:], Style.ITALICS]
+        else:
+            contents = [text]
+        blocks.append(Block(rnd.choice(list(BlockType)), contents))
+    return SyncDoc("0123456789abcdef01234567", 1000, blocks)
+
+
+def best_of(function) -> float:
+    best = float("inf")
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    sync_doc = build_document()
+    print(f"SyncDoc with {BLOCKS} blocks, best of {ROUNDS}")
+    print(f"{'codec':>7} {'size':>9} {'encode':>9} {'decode':>9} {'encode MB/s':>12} {'decode MB/s':>12}")
+    for codec_version in (1, 2):
+        msg = sync_doc.encode(codec_version)
+        encode_time = best_of(lambda: sync_doc.encode(codec_version))
+        decode_time = best_of(lambda: SyncDoc.decode(memoryview(msg), codec_version))
+        megabytes = len(msg) / 1e6
+        print(f"{'v' + str(codec_version):>7} {len(msg):>9} {encode_time * 1000:>7.1f}ms {decode_time * 1000:>7.1f}ms "
+              f"{megabytes / encode_time:>12.1f} {megabytes / decode_time:>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
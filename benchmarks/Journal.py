@@ -0,0 +1,74 @@
+"""
+Compares what it costs to make a document's edits durable: rewriting the whole
+Fountain file, as RealTimeDocument.save does, or group committing the patches
+to its DocumentJournal. Both are fsynced.
+
+Run with: python -m benchmarks.Journal
+"""
+import os
+import tempfile
+import time
+
+from common.BlockPatches import BlockPatch, BlockDataAddChange
+from common.FountianParser import FountainParser
+from server.DocumentJournal import DocumentJournal
+
+COMMITS = 200
+# Patches pushed between two group commits.
+BATCH = 10
+
+
+def script_blocks(copies: int) -> list:
+    parser = FountainParser()
+    with open(os.path.join(os.path.dirname(__file__), "..", "test.fountain"), "r", encoding="utf-8") as f:
+        parser.parse(f.read() * copies)
+    return parser.blocks
+
+
+def typing_patch(i: int) -> BlockPatch:
+    patch = BlockPatch()
+    patch.add_change(BlockDataAddChange(0, ["x"], i % 20))
+    return patch
+
+
+def time_fountain_saves(blocks: list, directory: str) -> float:
+    path = os.path.join(directory, "doc.fountain")
+    start = time.perf_counter()
+    for _ in range(COMMITS):
+        parser = FountainParser()
+        parser.blocks = blocks
+        serialized = parser.serialize()
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(serialized)
+            f.flush()
+            os.fsync(f.fileno())
+    return time.perf_counter() - start
+
+
+def time_journal_commits(blocks: list, directory: str) -> float:
+    journal = DocumentJournal("doc", directory)
+    journal.write_snapshot(0, DocumentJournal.encode_snapshot(0, blocks))
+    start = time.perf_counter()
+    for i in range(COMMITS):
+        for j in range(BATCH):
+            journal.append(typing_patch(i * BATCH + j))
+        journal.commit()
+    elapsed = time.perf_counter() - start
+    journal.close()
+    return elapsed
+
+
+def main():
+    print(f"{COMMITS} durable saves, {BATCH} patches per journal commit")
+    print(f"{'blocks':>7} {'fountain':>10} {'journal':>9} {'speedup':>8}")
+    for copies in (1, 10, 50):
+        blocks = script_blocks(copies)
+        with tempfile.TemporaryDirectory() as directory:
+            fountain_time = time_fountain_saves(blocks, directory)
+            journal_time = time_journal_commits(blocks, directory)
+        print(f"{len(blocks):>7} {fountain_time * 1000 / COMMITS:>8.2f}ms {journal_time * 1000 / COMMITS:>7.2f}ms "
+              f"{fountain_time / journal_time:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
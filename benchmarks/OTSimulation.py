@@ -0,0 +1,271 @@
+"""
+Simulates N RealTimeDocumentClients editing one RealTimeDocument, checks that
+every replica converges and reports how many changes were transformed per
+second and how long the queues got. A run where applying a patch raised counts
+as failed, like one that diverged. Exits with 1 when a run diverged or failed.
+
+The clients and the server are the real classes, connected by an in-memory
+transport: every message is encoded into a frame, held for a random delay in
+virtual time, and decoded on the other side, in order per connection as TCP
+would. Runs are deterministic for a given seed.
+
+Runs with a high --structural share can still fail: rebasing carries the base
+over the rebased changes instead of the changes as they were made, tracked by
+test_rebase_keeps_edits_to_inserted_block in tests/common/BlockPatches.py.
+
+Run with: python -m benchmarks.OTSimulation [--clients 2 4 8] [--edits 200] [--runs 5]
+"""
+import argparse
+import contextlib
+import copy
+import dataclasses
+import heapq
+import io
+import itertools
+import random
+import time
+import typing
+
+from client.RealTimeDocumentClient import RealTimeDocumentClient
+from common.BlockPatches import (BlockPatch, BlockDataAddChange, BlockDataRemoveChange, BlockAddChange,
+                                 BlockRemoveChange, BlockChangedType)
+from common.Blocks import Block, BlockType
+from common.EndpointCallbackSocket import EndpointCallbackSocket, Endpoint
+from common.EndpointConstructors import EndpointConstructor
+from common.FrameCompression import FrameFlag, split_endpoint_word
+from common.ScriptEndpoints import PatchScript, PatchedScript, AckPatch
+from server.RealTimeDocument import RealTimeDocument
+
+FILE_ID = "0" * 24
+PROJECT_ID = "1" * 24
+
+
+@dataclasses.dataclass
+class Stats:
+    transformed: int = 0
+    applied: int = 0
+    frames: int = 0
+    peak_in_transit: int = 0
+    peak_revisions: int = 0
+    peak_advance: int = 0
+    seconds: float = 0
+    # The exception that ended each failed run.
+    failures: list[str] = dataclasses.field(default_factory=list)
+
+    def add(self, other: 'Stats'):
+        self.transformed += other.transformed
+        self.applied += other.applied
+        self.frames += other.frames
+        self.peak_in_transit = max(self.peak_in_transit, other.peak_in_transit)
+        self.peak_revisions = max(self.peak_revisions, other.peak_revisions)
+        self.peak_advance = max(self.peak_advance, other.peak_advance)
+        self.seconds += other.seconds
+        self.failures += other.failures
+
+
+class Simulation:
+    """
+    Discrete event loop in virtual milliseconds.
+    """
+
+    def __init__(self, seed: int, latency: float):
+        self.rnd = random.Random(seed)
+        self.latency = latency
+        self.now = 0.0
+        self.events: list[tuple[float, int, typing.Callable]] = []
+        self.sequence = itertools.count()
+        self.stats = Stats()
+
+    def schedule(self, delay: float, action: typing.Callable):
+        heapq.heappush(self.events, (self.now + delay, next(self.sequence), action))
+
+    def run(self):
+        while self.events:
+            self.now, _seq, action = heapq.heappop(self.events)
+            action()
+
+
+class Link:
+    """
+    One direction of a connection, the socket the sending side writes to.
+    """
+    compression = FrameFlag.NONE
+    codec_version = 2
+    closed = False
+
+    def __init__(self, simulation: Simulation, endpoints: dict[int, Endpoint]):
+        self.simulation = simulation
+        self.endpoints = endpoints
+        self.last_delivery = 0.0
+        self.in_transit = 0
+
+    def send_endp(self, constructed: EndpointConstructor):
+        self.send_frame(EndpointCallbackSocket.encode_frame(constructed, self.compression, self.codec_version))
+
+    def send_frame(self, frame: bytes):
+        simulation = self.simulation
+        # Frames on one connection arrive in the order they were sent.
+        deliver_at = max(simulation.now + simulation.rnd.expovariate(1 / simulation.latency), self.last_delivery)
+        self.last_delivery = deliver_at
+        self.in_transit += 1
+        simulation.stats.frames += 1
+        simulation.stats.peak_in_transit = max(simulation.stats.peak_in_transit, self.in_transit)
+        simulation.schedule(deliver_at - simulation.now, lambda: self.deliver(frame))
+
+    def deliver(self, frame: bytes):
+        self.in_transit -= 1
+        header = EndpointCallbackSocket.HEADER
+        endpoint_word, _size = header.unpack_from(frame)
+        endpoint_id, flags = split_endpoint_word(endpoint_word)
+        endpoint = self.endpoints.get(endpoint_id, None)
+        if endpoint is None:
+            # Joins, leaves and syncs, the replicas start from the same blocks.
+            return
+        endpoint, msg, codec_version = EndpointCallbackSocket.decode_message(
+            endpoint, flags, memoryview(frame)[header.size:])
+        endpoint.callback(endpoint.constructor.decode(msg, codec_version))
+
+
+class SimulatedUser:
+    username = "simulated"
+
+
+class SimulatedHandler:
+    # What RealTimeDocument needs of a ClientHandler.
+    def __init__(self, sock: Link, address: int):
+        self.sock = sock
+        self.user = SimulatedUser()
+        self.sock_addr = address
+
+
+class SimulatedNet:
+    def __init__(self, sock: Link):
+        self.sock = sock
+
+
+def random_edit(rnd: random.Random, blocks: list[Block], structural: float) -> BlockPatch:
+    """
+    Mostly typing and deleting, with new, removed and retyped blocks now and then.
+    """
+    block_id = rnd.randrange(len(blocks))
+    length = blocks[block_id].get_block_len()
+    kind = rnd.random()
+    if kind < structural / 2:
+        change = BlockAddChange(rnd.randint(0, len(blocks)), Block(rnd.choice(list(BlockType)), ["new block"]))
+    elif kind < structural * 3 / 4 and len(blocks) > 1:
+        change = BlockRemoveChange(block_id)
+    elif kind < structural:
+        change = BlockChangedType(block_id, rnd.choice(list(BlockType)))
+    elif kind < 0.7 or not length:
+        change = BlockDataAddChange(rnd.randint(0, length), [rnd.choice("abcdef ")], block_id)
+    else:
+        change = BlockDataRemoveChange(rnd.randrange(length), rnd.randint(1, 3), block_id)
+    patch = BlockPatch()
+    patch.add_change(change)
+    return patch
+
+
+def replica(blocks: list[Block]) -> list[tuple[BlockType, list]]:
+    return [(block.block_type, list(block.block_contents)) for block in blocks]
+
+
+def simulate(seed: int, clients: int, edits: int, latency: float, typing_interval: float,
+             structural: float) -> tuple[bool, Stats]:
+    simulation = Simulation(seed, latency)
+    stats = simulation.stats
+    rnd = simulation.rnd
+    blocks = [Block(BlockType.ACTION, [f"Paragraph {i} of the scene."]) for i in range(8)]
+    rtd = RealTimeDocument(FILE_ID, PROJECT_ID, copy.deepcopy(blocks))
+
+    doc_clients = []
+    for i in range(clients):
+        client_endpoints = {}
+        server_endpoints = {}
+        down = Link(simulation, client_endpoints)
+        up = Link(simulation, server_endpoints)
+        rt_user = rtd.join_client(SimulatedHandler(down, i))
+        client = RealTimeDocumentClient(copy.deepcopy(blocks), FILE_ID, SimulatedNet(up))
+        client.on_rebase = lambda _blocks: None
+        client.on_change = lambda _dirty: None
+
+        def uploaded(msg: PatchScript, rt_user=rt_user):
+            if msg.branch_id != rt_user.current_branch or msg.document_timestamp != rtd.document_timestamp:
+                stats.transformed += len(msg.patch.change_queue)
+            stats.applied += len(msg.patch.change_queue)
+            rt_user.uploaded_patch(msg.patch, msg.branch_id, msg.document_timestamp)
+            stats.peak_revisions = max(stats.peak_revisions, len(rtd.revisions))
+
+        def got_change(msg: PatchedScript, client=client):
+            if msg.document_timestamp < client.document_timestamp:
+                stats.transformed += len(client.advance_patch.change_queue)
+            client.got_change(msg)
+
+        server_endpoints[PatchScript.ENDPOINT_ID] = Endpoint(uploaded, PatchScript)
+        client_endpoints[PatchedScript.ENDPOINT_ID] = Endpoint(got_change, PatchedScript)
+        client_endpoints[AckPatch.ENDPOINT_ID] = Endpoint(client.ack_change, AckPatch)
+        doc_clients.append(client)
+
+    def edit(client: RealTimeDocumentClient, remaining: int):
+        patch = random_edit(rnd, client.blocks_advanced, structural)
+        patch.apply_on_blocks(client.blocks_advanced)
+        client.send_change(patch)
+        stats.peak_advance = max(stats.peak_advance, len(client.advance_patch.change_queue))
+        if remaining > 1:
+            simulation.schedule(rnd.expovariate(1 / typing_interval), lambda: edit(client, remaining - 1))
+
+    for client in doc_clients:
+        simulation.schedule(rnd.expovariate(1 / typing_interval), lambda client=client: edit(client, edits))
+
+    start = time.perf_counter()
+    # The client and the server print every message.
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            simulation.run()
+    except Exception as e:
+        # A replica that can't apply a patch has already diverged.
+        stats.seconds = time.perf_counter() - start
+        stats.failures.append(f"seed {seed}: {type(e).__name__}: {e}")
+        return False, stats
+    stats.seconds = time.perf_counter() - start
+
+    server = replica(rtd.blocks)
+    converged = all(replica(client.blocks) == server and replica(client.blocks_advanced) == server
+                    for client in doc_clients)
+    return converged, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Multi-client OT convergence simulation.")
+    parser.add_argument("--clients", type=int, nargs="+", default=[2, 4, 8])
+    parser.add_argument("--edits", type=int, default=200, help="edits per client")
+    parser.add_argument("--runs", type=int, default=5, help="seeds per client count")
+    parser.add_argument("--latency", type=float, default=40, help="mean one way delay, in ms")
+    parser.add_argument("--interval", type=float, default=120, help="mean time between edits of a client, in ms")
+    parser.add_argument("--structural", type=float, default=0.05,
+                        help="share of edits adding, removing or retyping blocks")
+    args = parser.parse_args()
+
+    print(f"{args.edits} edits per client, {args.latency:g}ms mean latency, "
+          f"an edit every {args.interval:g}ms per client, {args.runs} runs each")
+    print(f"{'clients':>7} {'converged':>9} {'failed':>6} {'applied':>8} {'transformed':>11} {'transformed/s':>13} "
+          f"{'in transit':>10} {'revisions':>9} {'advance':>7}")
+    diverged = False
+    for clients in args.clients:
+        total = Stats()
+        converged = 0
+        for seed in range(args.runs):
+            ok, stats = simulate(seed, clients, args.edits, args.latency, args.interval, args.structural)
+            converged += ok
+            total.add(stats)
+        print(f"{clients:>7} {converged:>4}/{args.runs:<4} {len(total.failures):>6} {total.applied:>8} "
+              f"{total.transformed:>11} {total.transformed / total.seconds:>13.0f} {total.peak_in_transit:>10} "
+              f"{total.peak_revisions:>9} {total.peak_advance:>7}")
+        for failure in total.failures:
+            print(f"{'':>7} failed {failure}")
+        diverged |= converged < args.runs
+    if diverged:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+Rebases 1000 local changes onto 1000 remote ones with BlockPatch.rebase_to,
+compared with rebase_to_naive which maps every change through every base change.
+
+Run with: python -m benchmarks.Rebase
+"""
+import random
+import time
+
+from common.BlockPatches import (BlockPatch, BlockDataAddChange, BlockDataRemoveChange, BlockAddChange,
+                                 BlockChangedType)
+from common.Blocks import Block, BlockType
+
+CHANGES = 1000
+SEED = 15
+
+
+def typing_patch(rnd: random.Random, blocks: int, first_id: int) -> BlockPatch:
+    """
+    Mostly typing and deleting text all over the document, with the odd new block or type change.
+    """
+    patch = BlockPatch()
+    for i in range(CHANGES):
+        block_id = rnd.randrange(blocks)
+        kind = rnd.random()
+        if kind < 0.6:
+            change = BlockDataAddChange(rnd.randrange(80), ["x"], block_id)
+        elif kind < 0.95:
+            change = BlockDataRemoveChange(rnd.randrange(80), 1, block_id)
+        elif kind < 0.98:
+            change = BlockChangedType(block_id, BlockType.ACTION)
+        else:
+            change = BlockAddChange(block_id, Block(BlockType.ACTION, []))
+        patch.change_queue.append((first_id + i, change))
+    return patch
+
+
+def time_rebase(method: str, patch: BlockPatch, base: BlockPatch) -> float:
+    patch, base = patch.copy(), base.copy()
+    start = time.perf_counter()
+    getattr(patch, method)(base)
+    return time.perf_counter() - start
+
+
+def main():
+    rnd = random.Random(SEED)
+    print(f"{CHANGES} local changes rebased onto {CHANGES} remote changes")
+    print(f"{'document':>12} {'naive':>10} {'rebase_to':>10} {'speedup':>8}")
+    for blocks in (1, 10, 200):
+        local = typing_patch(rnd, blocks, 0)
+        remote = typing_patch(rnd, blocks, CHANGES)
+        naive_time = time_rebase("rebase_to_naive", local, remote)
+        new_time = time_rebase("rebase_to", local, remote)
+        print(f"{blocks:>5} blocks {naive_time * 1000:>8.0f}ms {new_time * 1000:>8.0f}ms {naive_time / new_time:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""
+Compares the old bytes-concatenation receive path with the ReceiveBuffer
+based one used by EndpointCallbackSocket.
+
+Run with: python -m benchmarks.ReceiveBuffer
+"""
+import ssl
+import struct
+import time
+
+from common.EndpointCallbackSocket import EndpointCallbackSocket, Endpoint
+from common.EndpointConstructors import EndpointConstructor
+
+FRAME_SIZES = (
+    ("1 KB", 0x400),
+    ("64 KB", 0x10000),
+    ("1 MB", 0x100000),
+)
+# TLS hands data to the application one record at a time.
+RECORD_SIZE = 0x4000
+
+
+class RawFrame(EndpointConstructor):
+    ENDPOINT_ID = 1
+    MAX_DATA_SIZE = -1
+
+    @classmethod
+    def from_msg(cls, msg: bytes):
+        return len(msg)
+
+
+class StreamSocket:
+    """Replays a byte stream the way a non-blocking SSL socket would."""
+
+    def __init__(self, data: bytes):
+        self.data = memoryview(data)
+        self.position = 0
+
+    def setblocking(self, _flag):
+        pass
+
+    def pending(self):
+        return 0
+
+    def next_chunk(self, size) -> memoryview:
+        if self.position >= len(self.data):
+            raise ssl.SSLWantReadError()
+        size = min(size, RECORD_SIZE, len(self.data) - self.position)
+        chunk = self.data[self.position:self.position + size]
+        self.position += size
+        return chunk
+
+    def recv(self, size):
+        return bytes(self.next_chunk(size))
+
+    def recv_into(self, buffer, size):
+        chunk = self.next_chunk(size)
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+
+class LegacyReceiver:
+    """The receive path before ReceiveBuffer: bytes concatenation and re-slicing."""
+
+    def __init__(self, sock, on_frame):
+        self.sock = sock
+        self.pending_data = b""
+        self.endpoints = {RawFrame.ENDPOINT_ID: Endpoint(on_frame, RawFrame)}
+
+    def continuous_recv(self, size) -> bytes:
+        data = self.pending_data
+        while len(data) < size:
+            data += self.sock.recv(4096)
+        self.pending_data = data[size:]
+        return data[:size]
+
+    def receive(self, frame_count):
+        for _ in range(frame_count):
+            endpoint_id, msg_size = struct.unpack("!II", self.continuous_recv(8))
+            endpoint = self.endpoints[endpoint_id]
+            endpoint.callback(endpoint.constructor.from_msg(self.continuous_recv(msg_size)))
+
+
+def build_stream(frame_size: int, frame_count: int) -> bytes:
+    frame = struct.pack("!II", RawFrame.ENDPOINT_ID, frame_size) + b"x" * frame_size
+    return frame * frame_count
+
+
+def time_legacy(stream: bytes, frame_count: int) -> float:
+    receiver = LegacyReceiver(StreamSocket(stream), lambda _size: None)
+    start = time.perf_counter()
+    receiver.receive(frame_count)
+    return time.perf_counter() - start
+
+
+def time_buffered(stream: bytes, frame_count: int) -> float:
+    received = 0
+
+    def on_frame(_size):
+        nonlocal received
+        received += 1
+
+    sock = EndpointCallbackSocket(StreamSocket(stream), writer_thread=False)
+    sock.set_endpoint(Endpoint(on_frame, RawFrame))
+    start = time.perf_counter()
+    while received < frame_count:
+        sock.do_receive()
+    return time.perf_counter() - start
+
+
+def main():
+    print(f"{'frame':>8} {'frames':>7} {'legacy':>10} {'buffered':>10} {'speedup':>8}")
+    for name, frame_size in FRAME_SIZES:
+        frame_count = max(4, 0x1000000 // frame_size // 4)
+        stream = build_stream(frame_size, frame_count)
+        legacy = time_legacy(stream, frame_count)
+        buffered = time_buffered(stream, frame_count)
+        print(f"{name:>8} {frame_count:>7} {legacy * 1000:>8.1f}ms {buffered * 1000:>8.1f}ms "
+              f"{legacy / buffered:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
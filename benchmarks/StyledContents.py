@@ -0,0 +1,103 @@
+"""
+Times typing and deleting in the middle of a long, heavily styled block, with
+the list walks BlockDataAddChange and BlockDataRemoveChange used to do and with
+the indexed common.StyledContents.
+
+Run with: python -m benchmarks.StyledContents
+"""
+import time
+
+from common.BlockPatches import BlockDataAddChange, BlockDataRemoveChange
+from common.Blocks import Block, BlockType, Style
+
+KEYSTROKES = 500
+
+
+def legacy_insert(block_contents: list, insert_position: int, data: list) -> list:
+    block_contents_copy = block_contents.copy()
+    if insert_position == 0:
+        return data + block_contents_copy
+    for i, block_content in enumerate(block_contents_copy):
+        if isinstance(block_content, str):
+            insert_position -= len(block_content)
+            if insert_position == 0:
+                return block_contents_copy[:i + 1] + data + block_contents_copy[i + 1:]
+            elif insert_position <= 0:
+                return (block_contents_copy[:i] + [block_content[:insert_position]] + data +
+                        [block_content[insert_position:]] + block_contents_copy[i + 1:])
+        else:
+            insert_position -= 1
+    return block_contents_copy
+
+
+def legacy_remove(block_contents: list, start: int, length: int) -> list:
+    block_contents_copy = block_contents.copy()
+    result = []
+    while start > 0 and block_contents_copy:
+        v = block_contents_copy.pop(0)
+        if isinstance(v, str):
+            start -= len(v)
+            if start < 0:
+                result.append(v[:start])
+                block_contents_copy.insert(0, v[start:])
+                break
+        else:
+            start -= 1
+        result.append(v)
+    while length > 0 and block_contents_copy:
+        v = block_contents_copy.pop(0)
+        if isinstance(v, str):
+            length -= len(v)
+            if length < 0:
+                result.append(v[length:])
+                break
+            elif length == 0:
+                break
+        else:
+            length -= 1
+            if length == 0:
+                break
+    return result + block_contents_copy
+
+
+def styled_paragraph(runs: int) -> list:
+    contents = []
+    for i in range(runs):
+        contents.append(f"run {i} of a long action paragraph ")
+        contents.append(Style.ITALICS)
+    return contents
+
+
+def run_legacy(contents: list, position: int) -> float:
+    start = time.perf_counter()
+    for i in range(KEYSTROKES):
+        contents = legacy_insert(contents, position + i, ["x"])
+    for i in range(KEYSTROKES):
+        contents = legacy_remove(contents, position + KEYSTROKES - i - 1, 1)
+    return time.perf_counter() - start
+
+
+def run_indexed(contents: list, position: int) -> float:
+    blocks = [Block(BlockType.ACTION, contents)]
+    start = time.perf_counter()
+    for i in range(KEYSTROKES):
+        BlockDataAddChange(position + i, ["x"], 0).apply_to_blocks(blocks)
+    for i in range(KEYSTROKES):
+        BlockDataRemoveChange(position + KEYSTROKES - i - 1, 1, 0).apply_to_blocks(blocks)
+    return time.perf_counter() - start
+
+
+def main():
+    print(f"{KEYSTROKES} characters typed then deleted in the middle of the block")
+    print(f"{'items':>6} {'list walk':>10} {'indexed':>9} {'speedup':>8}")
+    for runs in (10, 100, 1000, 5000):
+        contents = styled_paragraph(runs)
+        position = Block(BlockType.ACTION, contents).get_block_len() // 2
+        legacy_time = run_legacy(list(contents), position)
+        indexed_time = run_indexed(list(contents), position)
+        print(f"{len(contents):>6} {legacy_time * 1000:>8.1f}ms {indexed_time * 1000:>7.1f}ms "
+              f"{legacy_time / indexed_time:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
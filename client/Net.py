@@ -36,6 +36,8 @@ class Net:
             return False
 
         self.sock = EndpointCallbackSocket(sock)
+        # Agrees on batching and compression, which the server replies to with its own Hello.
+        self.sock.send_hello()
 
         if new_host:
             trusted = False
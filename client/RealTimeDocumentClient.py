@@ -1,6 +1,7 @@
 import copy
 
 from common.BlockPatches import Block
+from common.ChangeQueue import ChangeQueue
 from common.ScriptEndpoints import *
 
 from client.Net import Net
@@ -15,6 +16,9 @@ class RealTimeDocumentClient:
         self.advance_patch = BlockPatch()
         self.branch_id = 0
         self.document_timestamp = 0
+        # Id of the changes sent and waiting for an ack, and of the changes buffered meanwhile.
+        self.in_flight_id = None
+        self.pending_id = None
 
         self.file_id = file_id
         self.net = net
@@ -34,8 +38,38 @@ class RealTimeDocumentClient:
     def send_change(self, patch: BlockPatch):
         # We suppose the patch has already been applied to advanced.
         # patch.apply_on_blocks(self.blocks_advanced)
+        if not patch.change_queue:
+            return
 
+        # Every change made while a patch is in flight shares one id,
+        # so they can be compacted and are acknowledged together.
+        if self.pending_id is None:
+            self.pending_id = patch.change_queue[0][0]
+        patch.set_changes_id(self.pending_id)
         self.advance_patch.add_change(patch)
+
+        if self.in_flight_id is None:
+            self.flush_pending()
+
+    def flush_pending(self):
+        """
+        Sends the buffered changes as one patch, at most one patch is waiting for an ack at a time.
+        """
+        if self.pending_id is None:
+            return
+        pending_id = self.pending_id
+        self.pending_id = None
+
+        # The buffered changes are taken from advance_patch, where they were rebased on the changes received since.
+        self.advance_patch.compact()
+        patch = BlockPatch()
+        patch.change_queue = ChangeQueue(
+            (id_, change) for id_, change in self.advance_patch.change_queue if id_ == pending_id
+        )
+        if not patch.change_queue:
+            return
+
+        self.in_flight_id = pending_id
         self.net.sock.send_endp(PatchScript(self.file_id, patch, self.branch_id, self.document_timestamp))
         print(f"Sent change. Next one should be {self.document_timestamp}")
 
@@ -46,7 +80,11 @@ class RealTimeDocumentClient:
         print("Ack'd change.")
         msg.patch.apply_on_blocks(self.blocks)
         self.advance_patch.remove_change(msg.patch)
-        print(self.advance_patch.change_queue)
+        if self.in_flight_id is not None:
+            # Also drops in flight changes the server rebased away.
+            self.advance_patch.remove_change(self.in_flight_id)
+            self.in_flight_id = None
+        self.flush_pending()
 
     def got_change(self, msg: PatchedScript):
         print(f"Got change. Doc timestamp: {msg.document_timestamp} Expected: {self.document_timestamp}")
@@ -61,10 +99,12 @@ class RealTimeDocumentClient:
             self.advance_patch.rebase_to(msg.patch)
             self.advance_patch.apply_on_blocks(self.blocks_advanced)
             self.on_rebase(self.blocks_advanced)
+            # The whole document was laid out again.
+            dirty_blocks = set()
         else:
             # We are up-to-date.
-            msg.patch.apply_on_blocks(self.blocks_advanced)
-        self.on_change()
+            dirty_blocks = msg.patch.apply_on_blocks(self.blocks_advanced)
+        self.on_change(dirty_blocks)
 
         # The expected document timestamp increases by one.
         self.document_timestamp += 1
@@ -312,8 +312,8 @@ class InnerScriptEditor(ScriptRenderer, QtWidgets.QWidget):
         if self.rtd_c:
             self.rtd_c.send_change(patch)
 
-    def on_change(self):
-        self.ensure_all_are_line_blocks()
+    def on_change(self, dirty_blocks: set[int]):
+        self.ensure_all_are_line_blocks(dirty_blocks)
 
 
 class ScriptEditor(QtWidgets.QWidget):
@@ -1,3 +1,4 @@
+import typing
 from enum import Enum
 
 from common.BlockPatches import *
@@ -232,35 +233,40 @@ class ScriptRenderer:
 
             # Finished rendering block
 
-    def ensure_all_are_line_blocks(self):
-        line_block_idx = None
-        for block_i in range(len(self.blocks)):
+    def ensure_all_are_line_blocks(self, dirty_blocks: typing.Optional[typing.Iterable[int]] = None):
+        """
+        Lays out the blocks at the given indices again, and moves the blocks after them.
+        Without indices, as when the blocks are set, every block is laid out.
+        """
+        if dirty_blocks is None:
+            dirty_blocks = range(len(self.blocks))
+        dirty_blocks = sorted(dirty_blocks)
+        if not dirty_blocks:
+            return
+
+        for block_i in dirty_blocks:
             block = self.blocks[block_i]
             if not isinstance(block, LineBlock):
-                line_block = LineBlock.from_block(block)
-                line_block.split_at_length()
-                self.blocks[block_i] = line_block
-                if line_block_idx is None:
-                    line_block_idx = block_i
-            if line_block_idx is None and block.contents_modified:
-                line_block_idx = block_i
-        if line_block_idx is None:
-            return
+                block = self.blocks[block_i] = LineBlock.from_block(block)
+            block.split_at_length()
 
-        for block_i in range(line_block_idx, len(self.blocks)):
+        last_dirty = dirty_blocks[-1]
+        for block_i in range(dirty_blocks[0], len(self.blocks)):
             last_block = self.blocks[block_i - 1] if block_i > 0 else None
             block = self.blocks[block_i]
-            if block.contents_modified:
-                block.split_at_length()
+            old_lines = block.line_start, block.line_height
             block.update_line_height(last_block)
+            if block_i > last_dirty and (block.line_start, block.line_height) == old_lines:
+                # Nothing after it moves either.
+                break
 
     def apply_patch(self, patch: BlockPatch):
         s_block_i, s_block_pos = self.starting_cursor.to_block_pos()
         e_block_i, e_block_pos = self.ending_cursor.to_block_pos()
 
-        patch.apply_on_blocks(self.blocks)
+        dirty_blocks = patch.apply_on_blocks(self.blocks)
 
-        self.ensure_all_are_line_blocks()
+        self.ensure_all_are_line_blocks(dirty_blocks)
 
         s_block_i, s_block_pos = patch.map_point(s_block_i, s_block_pos)
         e_block_i, e_block_pos = patch.map_point(e_block_i, e_block_pos)
@@ -0,0 +1,287 @@
+import asyncio
+import functools
+import inspect
+import logging
+import ssl
+import threading
+import time
+import typing
+
+from common.EndpointConstructors import EndpointID, EndpointConstructor, Capability, Hello
+from common.FrameCompression import FrameFlag, split_endpoint_word
+from common.EndpointCallbackSocket import Endpoint, EndpointCallbackSocket
+from common import Metrics
+
+
+class AsyncEndpointSocket:
+    """
+    asyncio counterpart of EndpointCallbackSocket.
+
+    Speaks the same "!II" (endpoint id, length) framing over asyncio streams.
+    Endpoint callbacks may be coroutine functions, which are awaited, or
+    regular functions. Regular callbacks marked with Endpoint.offload are run
+    on the loop's executor so database and disk work never blocks the reader.
+    Frames of a connection are still dispatched one at a time, in order.
+
+    Once the peer's Hello allows it, frames sent during one loop iteration
+    are packed into a single batch frame and large frames are compressed.
+    send_endp and close can be called from any thread. Outgoing data is
+    buffered by the transport, whose high and low watermarks pause reading
+    from a peer that is not keeping up; a peer whose buffer would exceed
+    max_outbound is disconnected.
+    """
+    HEADER_SIZE = EndpointCallbackSocket.HEADER_SIZE
+    DISCARD_CHUNK = 4096
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                 on_close: typing.Callable = None,
+                 high_watermark: int = EndpointCallbackSocket.OUTBOUND_HIGH_WATERMARK,
+                 low_watermark: int = EndpointCallbackSocket.OUTBOUND_LOW_WATERMARK,
+                 max_outbound: int = EndpointCallbackSocket.OUTBOUND_MAX_SIZE):
+        self.reader = reader
+        self.writer = writer
+        self.writer.transport.set_write_buffer_limits(high_watermark, low_watermark)
+        self.high_watermark = high_watermark
+        self.max_outbound = max_outbound
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.endpoints: dict[EndpointID, Endpoint] = {}
+        self.on_close: typing.Callable = on_close
+        self.closed = False
+        self.last_received = time.monotonic()
+        self.send_batch: list[bytes] = []
+
+        # Same negotiation as EndpointCallbackSocket, see received_hello.
+        self.batch_frames = False
+        self.compression = FrameFlag.NONE
+        self.codec_version = 1
+        self.hello_sent = False
+        self.set_endpoint(Endpoint(self.received_hello, Hello))
+
+    @classmethod
+    async def connect(cls, hostname: str, port: int, ssl_context: ssl.SSLContext,
+                      on_close: typing.Callable = None) -> 'AsyncEndpointSocket':
+        reader, writer = await asyncio.open_connection(hostname, port, ssl=ssl_context)
+        return cls(reader, writer, on_close=on_close)
+
+    def get_peer_address(self):
+        return self.writer.get_extra_info("peername")
+
+    def set_endpoint(self, endpoint: Endpoint):
+        self.endpoints[endpoint.constructor.ENDPOINT_ID] = endpoint
+
+    def remove_endpoint(self, endpoint_constructor: type[EndpointConstructor]):
+        self.endpoints.pop(endpoint_constructor.ENDPOINT_ID, None)
+
+    def send_hello(self):
+        if self.hello_sent:
+            return
+        self.hello_sent = True
+        self.send_endp(Hello(EndpointCallbackSocket.PROTOCOL_VERSION,
+                             EndpointCallbackSocket.supported_capabilities()))
+
+    def received_hello(self, msg: Hello):
+        self.batch_frames = bool(msg.capabilities & EndpointCallbackSocket.supported_capabilities() &
+                                 Capability.BATCH)
+        self.compression = EndpointCallbackSocket.agreed_codec(msg.capabilities)
+        self.codec_version = min(msg.protocol_version, EndpointCallbackSocket.PROTOCOL_VERSION)
+        self.send_hello()
+
+    def in_loop_thread(self) -> bool:
+        return threading.get_ident() == self.loop_thread
+
+    async def discard(self, size: int):
+        while size > 0:
+            data = await self.reader.read(min(size, self.DISCARD_CHUNK))
+            if not data:
+                raise asyncio.IncompleteReadError(b"", size)
+            size -= len(data)
+
+    def lookup_endpoint(self, endpoint_id: int, msg_size: int) -> typing.Optional[Endpoint]:
+        endpoint = self.endpoints.get(endpoint_id, None)
+        if endpoint is None:
+            logging.warning(f"Endpoint {endpoint_id} not found.")
+            return None
+        if msg_size > endpoint.constructor.MAX_DATA_SIZE > -1:
+            logging.warning(f"Exceeded endpoint {endpoint_id} size ({msg_size}, "
+                            f"max {endpoint.constructor.MAX_DATA_SIZE})")
+            return None
+        return endpoint
+
+    def unpack_batch(self, batch: bytes) -> list[tuple[Endpoint, memoryview, int]]:
+        frames = []
+        batch = memoryview(batch)
+        offset = 0
+        while offset < len(batch):
+            if len(batch) - offset < self.HEADER_SIZE:
+                logging.warning("Truncated frame inside batch.")
+                break
+            endpoint_word, msg_size = EndpointCallbackSocket.HEADER.unpack_from(batch, offset)
+            endpoint_id, flags = split_endpoint_word(endpoint_word)
+            msg_start = offset + self.HEADER_SIZE
+            offset = msg_start + msg_size
+            if offset > len(batch):
+                logging.warning("Truncated frame inside batch.")
+                break
+            endpoint = self.lookup_endpoint(endpoint_id, msg_size)
+            if endpoint is None:
+                continue
+            frame = EndpointCallbackSocket.decode_message(endpoint, flags, batch[msg_start:offset])
+            if frame is not None:
+                frames.append(frame)
+        return frames
+
+    async def receive_frames(self) -> list[tuple[Endpoint, bytes, int]]:
+        msg_header = await self.reader.readexactly(self.HEADER_SIZE)
+        endpoint_word, msg_size = EndpointCallbackSocket.HEADER.unpack(msg_header)
+        endpoint_id, flags = split_endpoint_word(endpoint_word)
+        if endpoint_id == EndpointID.BATCH:
+            if msg_size > EndpointCallbackSocket.BATCH_MAX_SIZE or flags:
+                logging.warning(f"Invalid batch frame ({msg_size} bytes, flags {flags!r})")
+                await self.discard(msg_size)
+                return []
+            return self.unpack_batch(await self.reader.readexactly(msg_size))
+        endpoint = self.lookup_endpoint(endpoint_id, msg_size)
+        if endpoint is None:
+            await self.discard(msg_size)
+            return []
+        frame = EndpointCallbackSocket.decode_message(endpoint, flags, await self.reader.readexactly(msg_size))
+        if frame is None:
+            return []
+        return [frame]
+
+    async def dispatch(self, endpoint: Endpoint, msg: bytes, codec_version: int = 1):
+        self.last_received = time.monotonic()
+        constructor = endpoint.constructor
+        decode_start = time.perf_counter()
+        endpoint_constructed = constructor.decode(msg, codec_version)
+        handler_start = time.perf_counter()
+        if Metrics.enabled:
+            Metrics.FRAMES_RECEIVED.inc(constructor)
+            Metrics.BYTES_RECEIVED.inc(constructor, len(msg))
+            Metrics.DECODE_SECONDS.observe(handler_start - decode_start, constructor)
+        if endpoint_constructed is None:
+            logging.warning(f"Endpoint {endpoint} couldn't be parsed.")
+            return
+        if inspect.iscoroutinefunction(endpoint.callback):
+            await endpoint.callback(endpoint_constructed)
+        elif endpoint.offload:
+            await self.run_blocking(endpoint.callback, endpoint_constructed)
+        else:
+            endpoint.callback(endpoint_constructed)
+        if Metrics.enabled:
+            Metrics.HANDLER_SECONDS.observe(time.perf_counter() - handler_start, constructor)
+
+    async def run_blocking(self, func: typing.Callable, *args):
+        # Runs blocking work (database queries, disk access) on the executor.
+        return await self.loop.run_in_executor(None, functools.partial(func, *args))
+
+    @property
+    def congested(self) -> bool:
+        return self.writer.transport.get_write_buffer_size() >= self.high_watermark
+
+    async def receive_loop(self):
+        try:
+            while not self.closed:
+                if self.congested:
+                    # Stop reading until the peer catches up with our replies.
+                    await self.drain()
+                    continue
+                for frame in await self.receive_frames():
+                    await self.dispatch(*frame)
+        except (asyncio.IncompleteReadError, ConnectionError, ssl.SSLError):
+            pass
+        except Exception:
+            logging.exception("Exception while performing receive.")
+        self.close()
+
+    def write(self, data: bytes):
+        if self.closed:
+            return
+        queued = self.writer.transport.get_write_buffer_size()
+        if queued + len(data) > self.max_outbound:
+            logging.warning(f"Outbound buffer overflowed ({queued} bytes queued), "
+                            f"disconnecting slow consumer.")
+            self.close()
+            return
+        try:
+            self.writer.write(data)
+        except Exception:
+            logging.exception("Exception while sending to endpoint.")
+            self.close()
+
+    def send_endp(self, constructed: EndpointConstructor):
+        if self.closed:
+            return
+        try:
+            frame = EndpointCallbackSocket.encode_frame(constructed, self.compression, self.codec_version)
+        except Exception:
+            logging.exception("Exception while sending to endpoint.")
+            self.close()
+            return
+        if Metrics.enabled:
+            Metrics.FRAMES_SENT.inc(type(constructed))
+            Metrics.BYTES_SENT.inc(type(constructed), len(frame))
+        self.send_frame(frame)
+
+    def send_frame(self, frame: bytes):
+        if self.closed:
+            return
+        if self.in_loop_thread():
+            self.queue_frame(frame)
+        else:
+            self.loop.call_soon_threadsafe(self.queue_frame, frame)
+
+    def queue_frame(self, frame: bytes):
+        # Frames sent during one loop iteration are written together as a single batch.
+        if not self.batch_frames:
+            self.write(frame)
+            return
+        if not self.send_batch:
+            self.loop.call_soon(self.write_batch)
+        self.send_batch.append(frame)
+
+    def write_batch(self):
+        frames, self.send_batch = self.send_batch, []
+        batch = []
+        batch_size = 0
+        for frame in frames:
+            if batch and batch_size + len(frame) > EndpointCallbackSocket.BATCH_MAX_SIZE:
+                self.write_frames(batch)
+                batch = []
+                batch_size = 0
+            batch.append(frame)
+            batch_size += len(frame)
+        if batch:
+            self.write_frames(batch)
+
+    def write_frames(self, frames: list[bytes]):
+        if len(frames) == 1:
+            self.write(frames[0])
+        else:
+            self.write(EndpointCallbackSocket.encode_batch(frames))
+
+    async def drain(self):
+        if not self.closed:
+            await self.writer.drain()
+
+    def close_writer(self):
+        # Best effort to get out what is still batched, such as a Close frame.
+        frames, self.send_batch = self.send_batch, []
+        try:
+            for frame in frames:
+                self.writer.write(frame)
+        except Exception:
+            pass
+        self.writer.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.in_loop_thread():
+            self.close_writer()
+        else:
+            self.loop.call_soon_threadsafe(self.close_writer)
+        if self.on_close:
+            self.on_close()
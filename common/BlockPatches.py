@@ -1,9 +1,13 @@
 import io
 import struct
 
-from common.Blocks import Block, encode_styled, decode_styled, BlockType
+from common.Blocks import Block, encode_styled, decode_styled, encode_styled_into, decode_styled_from, BlockType
+from common.Codec import Reader, write_varint
+from common.ChangeQueue import ChangeQueue
+from common.PatchTransform import PatchTransformer
 import typing
 import copy
+import itertools
 from enum import IntEnum
 
 
@@ -17,15 +21,20 @@ class BlockChangeType(IntEnum):
 
 
 class BlockChanged:
-    COUNT = 0
+    __slots__ = ("start", "length", "block_id", "change_id")
+    # next() on a count is atomic, so no two changes get the same id even when created from different threads.
+    CHANGE_IDS = itertools.count()
     DELETE_WITH_BLOCK = True
+    # Adds or removes blocks, shifting the block ids of the changes after it.
+    SHIFTS_BLOCKS = False
+    # Adds or removes text, only changes to the same block are affected by it.
+    EDITS_TEXT = False
 
     def __init__(self):
         self.start = 0
         self.length = 0
         self.block_id = 0
-        self.change_id = BlockChanged.COUNT
-        BlockChanged.COUNT += 1
+        self.change_id = next(BlockChanged.CHANGE_IDS)
 
     @property
     def end(self):
@@ -34,11 +43,18 @@ class BlockChanged:
     def apply_to_blocks(self, blocks: list[Block]):
         pass
 
+    def update_dirty(self, dirty: set[int], block_count: int) -> set[int]:
+        # Indices of the blocks modified so far, once this change has been applied.
+        # block_count is the number of blocks after applying it.
+        return dirty
+
     def size_data(self):
         return 0
 
     def map(self, other: 'BlockChanged') -> tuple['BlockChanged']:
-        # This function should not modify changes if they are not in their domain
+        # This function should not modify changes if they are not in their domain.
+        # Changes are never modified in place, unchanged ones are returned as they are
+        # and a copy is only made when something moves.
         return other,
 
     def map_point(self, block_i, block_pos):
@@ -47,15 +63,25 @@ class BlockChanged:
     def partial_copy(self, start, end) -> 'BlockChanged':
         pass
 
+    def merge(self, other: 'BlockChanged') -> typing.Optional['BlockChanged']:
+        # Returns a single change with the same effect as applying self and then other,
+        # or None if they can't be combined.
+        return None
+
     def copy(self):
         raise NotImplemented()
 
     def to_bytes(self):
         return struct.pack("!B", BlockChangeType.NOTHING)
 
+    def encode_into(self, buf: bytearray):
+        buf.append(BlockChangeType.NOTHING)
+
 
 class BlockAddChange(BlockChanged):
+    __slots__ = ("block",)
     DELETE_WITH_BLOCK = False
+    SHIFTS_BLOCKS = True
 
     def __init__(self, block_id, block: Block):
         super().__init__()
@@ -63,7 +89,13 @@ class BlockAddChange(BlockChanged):
         self.block = block
 
     def apply_to_blocks(self, blocks: list[Block]):
-        blocks.insert(self.block_id, self.block)
+        # A copy, the document edits it in place while the change may still be sent or applied again.
+        blocks.insert(self.block_id, self.block.copy())
+
+    def update_dirty(self, dirty: set[int], block_count: int) -> set[int]:
+        dirty = {i + 1 if i >= self.block_id else i for i in dirty}
+        dirty.add(self.block_id)
+        return dirty
 
     def map_point(self, block_i, block_pos):
         if block_i >= self.block_id:
@@ -71,8 +103,10 @@ class BlockAddChange(BlockChanged):
         return block_i, block_pos
 
     def map(self, other: 'BlockChanged') -> tuple['BlockChanged']:
-        other = other.copy()
-        if other.block_id > self.block_id:
+        # The block at the insertion point moves down, a concurrent insert at the same point stays put.
+        if other.block_id > self.block_id or \
+                (other.block_id == self.block_id and not isinstance(other, BlockAddChange)):
+            other = other.copy()
             other.block_id += 1
         return other,
 
@@ -88,9 +122,21 @@ class BlockAddChange(BlockChanged):
         block = Block.from_bytes(rdr)
         return BlockAddChange(block_id, block)
 
+    def encode_into(self, buf: bytearray):
+        buf.append(BlockChangeType.ADD_BLOCK)
+        write_varint(buf, self.block_id)
+        self.block.encode_into(buf)
+
+    @classmethod
+    def decode_from(cls, rdr: Reader):
+        block_id = rdr.read_varint()
+        return BlockAddChange(block_id, Block.decode_from(rdr))
+
 
 class BlockRemoveChange(BlockChanged):
+    __slots__ = ()
     DELETE_WITH_BLOCK = False
+    SHIFTS_BLOCKS = True
 
     def __init__(self, block_id):
         super().__init__()
@@ -98,10 +144,15 @@ class BlockRemoveChange(BlockChanged):
 
     def apply_to_blocks(self, blocks: list[Block]):
         blocks.pop(self.block_id)
-        if len(blocks) > self.block_id:
-            blocks[self.block_id].contents_modified = True
+
+    def update_dirty(self, dirty: set[int], block_count: int) -> set[int]:
+        dirty = {i - 1 if i > self.block_id else i for i in dirty if i != self.block_id}
+        # The block taking its place, or the new last one, now follows a different block.
+        if block_count > self.block_id:
+            dirty.add(self.block_id)
         elif self.block_id > 0:
-            blocks[self.block_id - 1].contents_modified = True
+            dirty.add(self.block_id - 1)
+        return dirty
 
     def map_point(self, block_i, block_pos):
         if block_i >= self.block_id:
@@ -109,12 +160,13 @@ class BlockRemoveChange(BlockChanged):
         return block_i, block_pos
 
     def map(self, other: 'BlockChanged') -> tuple['BlockChanged']:
-        other = other.copy()
         if other.block_id == self.block_id:
-            if other.DELETE_WITH_BLOCK:
+            # A concurrent removal of the same block is already done.
+            if other.DELETE_WITH_BLOCK or isinstance(other, BlockRemoveChange):
                 return tuple()
             return other,
         if other.block_id > self.block_id:
+            other = other.copy()
             other.block_id -= 1
         return other,
 
@@ -129,9 +181,19 @@ class BlockRemoveChange(BlockChanged):
         block_id = struct.unpack("!I", rdr.read(4))[0]
         return BlockRemoveChange(block_id)
 
+    def encode_into(self, buf: bytearray):
+        buf.append(BlockChangeType.REMOVE_BLOCK)
+        write_varint(buf, self.block_id)
+
+    @classmethod
+    def decode_from(cls, rdr: Reader):
+        return BlockRemoveChange(rdr.read_varint())
+
 
 class BlockDataAddChange(BlockChanged):
+    __slots__ = ("data",)
     DELETE_WITH_BLOCK = True
+    EDITS_TEXT = True
 
     def __init__(self, position, data, block_id):
         super().__init__()
@@ -141,34 +203,11 @@ class BlockDataAddChange(BlockChanged):
         self.length = 0
 
     def apply_to_blocks(self, blocks: list[Block]):
-        block = blocks[self.block_id]
-        blocks[self.block_id].contents_modified = True
-        insert_position = self.start
-        block_contents_copy = block.block_contents.copy()
-        if insert_position == 0:
-            block.block_contents = self.data + block_contents_copy
-            return
-        for i, block_content in enumerate(block_contents_copy):
-            if isinstance(block_content, str):
-                insert_position -= len(block_content)
-                if insert_position == 0:
-                    block.block_contents = block_contents_copy[:i+1]
-                    block.block_contents.extend(self.data)
-                    block.block_contents.extend(block_contents_copy[i+1:])
-                    break
-                elif insert_position <= 0:
-                    block.block_contents = block_contents_copy[:i]
-                    block.block_contents.append(block_content[:insert_position])
-                    block.block_contents.extend(self.data)
-                    block.block_contents.append(block_content[insert_position:])
-                    block.block_contents.extend(block_contents_copy[i + 1:])
-                    break
-            else:
-                insert_position -= 1
-                if insert_position == 0:
-                    block.block_contents = block_contents_copy[:i]
-                    block.block_contents.extend(self.data)
-                    block.block_contents.extend(block_contents_copy[i:])
+        blocks[self.block_id].block_contents.insert_at(self.start, self.data)
+
+    def update_dirty(self, dirty: set[int], block_count: int) -> set[int]:
+        dirty.add(self.block_id)
+        return dirty
 
     def size_data(self):
         size = 0
@@ -187,12 +226,12 @@ class BlockDataAddChange(BlockChanged):
         return block_i, block_pos
 
     def map(self, other: 'BlockChanged'):
-        other = other.copy()
         if other.block_id != self.block_id:
             return other,
         if other.start <= other.end <= self.start:
             return other,
         if other.start > self.start:
+            other = other.copy()
             other.start += self.size_data()
             return other,
         p1 = other.partial_copy(other.start, self.start)
@@ -203,6 +242,21 @@ class BlockDataAddChange(BlockChanged):
     def partial_copy(self, start, end) -> 'BlockChanged':
         raise ValueError("There should never be a partial copy of an add block!")
 
+    def merge(self, other: 'BlockChanged') -> typing.Optional['BlockChanged']:
+        # Only text typed right after this one. Inserting anywhere else inside it doesn't
+        # land where expected when this insert went before a trailing style marker.
+        if not isinstance(other, BlockDataAddChange) or other.block_id != self.block_id:
+            return None
+        if other.start != self.start + self.size_data():
+            return None
+        data = self.data.copy()
+        for v in other.data:
+            if isinstance(v, str) and data and isinstance(data[-1], str):
+                data[-1] += v
+            else:
+                data.append(v)
+        return BlockDataAddChange(self.start, data, self.block_id)
+
     def copy(self):
         return BlockDataAddChange(self.start, self.data, self.block_id)
 
@@ -214,9 +268,23 @@ class BlockDataAddChange(BlockChanged):
         block_id, start = struct.unpack("!IH", rdr.read(6))
         return BlockDataAddChange(start, decode_styled(rdr), block_id)
 
+    def encode_into(self, buf: bytearray):
+        buf.append(BlockChangeType.ADD_TEXT)
+        write_varint(buf, self.block_id)
+        write_varint(buf, self.start)
+        encode_styled_into(buf, self.data)
+
+    @classmethod
+    def decode_from(cls, rdr: Reader):
+        block_id = rdr.read_varint()
+        start = rdr.read_varint()
+        return BlockDataAddChange(start, decode_styled_from(rdr), block_id)
+
 
 class BlockDataRemoveChange(BlockChanged):
+    __slots__ = ()
     DELETE_WITH_BLOCK = True
+    EDITS_TEXT = True
 
     def __init__(self, start, length, block_id):
         super().__init__()
@@ -234,53 +302,33 @@ class BlockDataRemoveChange(BlockChanged):
         return block_i, block_pos - self.length
 
     def map(self, other: 'BlockChanged'):
-        other = other.copy()
         if other.block_id != self.block_id:
             return other,
-        if other.start >= self.end:
-            other.start -= self.length
-        elif self.start <= other.start < self.end:
-            other.length -= self.end - other.start
-            other.length = max(other.length, 0)
-            other.start = self.start
-
-        if self.start <= other.end <= self.end:
-            other.length -= other.end - self.start
-            other.length = max(other.length, 0)
+        start = other.start
+        length = other.length
+        if start >= self.end:
+            start -= self.length
+        elif self.start <= start < self.end:
+            length -= self.end - start
+            length = max(length, 0)
+            start = self.start
+
+        if self.start <= start + length <= self.end:
+            length -= start + length - self.start
+            length = max(length, 0)
+        if start == other.start and length == other.length:
+            return other,
+        other = other.copy()
+        other.start = start
+        other.length = length
         return other,
 
     def apply_to_blocks(self, blocks: list[Block]):
-        block = blocks[self.block_id]
-        blocks[self.block_id].contents_modified = True
-        start = self.start
-        length = self.length
-        block_contents_copy = block.block_contents.copy()
-        block.block_contents = []
-        while start > 0 and block_contents_copy:
-            v = block_contents_copy.pop(0)
-            if isinstance(v, str):
-                start -= len(v)
-                if start < 0:
-                    block.block_contents.append(v[:start])
-                    block_contents_copy.insert(0, v[start:])
-                    break
-            else:
-                start -= 1
-            block.block_contents.append(v)
-        while length > 0 and block_contents_copy:
-            v = block_contents_copy.pop(0)
-            if isinstance(v, str):
-                length -= len(v)
-                if length < 0:
-                    block.block_contents.append(v[length:])
-                    break
-                elif length == 0:
-                    break
-            else:
-                length -= 1
-                if length == 0:
-                    break
-        block.block_contents.extend(block_contents_copy)
+        blocks[self.block_id].block_contents.remove_range(self.start, self.length)
+
+    def update_dirty(self, dirty: set[int], block_count: int) -> set[int]:
+        dirty.add(self.block_id)
+        return dirty
 
     def copy(self):
         return BlockDataRemoveChange(self.start, self.length, self.block_id)
@@ -288,6 +336,17 @@ class BlockDataRemoveChange(BlockChanged):
     def partial_copy(self, start, end) -> 'BlockChanged':
         return BlockDataRemoveChange(start, end - start, self.block_id)
 
+    def merge(self, other: 'BlockChanged') -> typing.Optional['BlockChanged']:
+        if not isinstance(other, BlockDataRemoveChange) or other.block_id != self.block_id:
+            return None
+        if other.end == self.start:
+            # Backspace
+            return BlockDataRemoveChange(other.start, other.length + self.length, self.block_id)
+        if other.start == self.start:
+            # Delete
+            return BlockDataRemoveChange(self.start, self.length + other.length, self.block_id)
+        return None
+
     def to_bytes(self):
         return struct.pack("!BIHH", BlockChangeType.REMOVE_TEXT, self.block_id, self.start, self.length)
 
@@ -296,8 +355,21 @@ class BlockDataRemoveChange(BlockChanged):
         block_id, start, length = struct.unpack("!IHH", rdr.read(8))
         return BlockDataRemoveChange(start, length, block_id)
 
+    def encode_into(self, buf: bytearray):
+        buf.append(BlockChangeType.REMOVE_TEXT)
+        write_varint(buf, self.block_id)
+        write_varint(buf, self.start)
+        write_varint(buf, self.length)
+
+    @classmethod
+    def decode_from(cls, rdr: Reader):
+        block_id = rdr.read_varint()
+        start = rdr.read_varint()
+        return BlockDataRemoveChange(start, rdr.read_varint(), block_id)
+
 
 class BlockChangedType(BlockChanged):
+    __slots__ = ("block_type",)
     DELETE_WITH_BLOCK = True
 
     def __init__(self, block_id, block_type):
@@ -309,11 +381,19 @@ class BlockChangedType(BlockChanged):
 
     def apply_to_blocks(self, blocks: list[Block]):
         blocks[self.block_id].block_type = self.block_type
-        blocks[self.block_id].contents_modified = True
+
+    def update_dirty(self, dirty: set[int], block_count: int) -> set[int]:
+        dirty.add(self.block_id)
+        return dirty
 
     def copy(self):
         return BlockChangedType(self.block_id, self.block_type)
 
+    def merge(self, other: 'BlockChanged') -> typing.Optional['BlockChanged']:
+        if isinstance(other, BlockChangedType) and other.block_id == self.block_id:
+            return other.copy()
+        return None
+
     def to_bytes(self):
         return struct.pack("!BIB", BlockChangeType.CHANGED_TYPE, self.block_id, self.block_type)
 
@@ -322,6 +402,16 @@ class BlockChangedType(BlockChanged):
         block_id, block_type = struct.unpack("!IB", rdr.read(5))
         return BlockChangedType(block_id, BlockType(block_type))
 
+    def encode_into(self, buf: bytearray):
+        buf.append(BlockChangeType.CHANGED_TYPE)
+        write_varint(buf, self.block_id)
+        buf.append(self.block_type)
+
+    @classmethod
+    def decode_from(cls, rdr: Reader):
+        block_id = rdr.read_varint()
+        return BlockChangedType(block_id, BlockType(rdr.read_u8()))
+
 
 def change_from_bytes(rdr: io.BytesIO):
     change_type = struct.unpack("!B", rdr.read(1))[0]
@@ -338,21 +428,31 @@ def change_from_bytes(rdr: io.BytesIO):
     return None
 
 
+CHANGE_DECODERS = {
+    BlockChangeType.ADD_BLOCK: BlockAddChange.decode_from,
+    BlockChangeType.REMOVE_BLOCK: BlockRemoveChange.decode_from,
+    BlockChangeType.ADD_TEXT: BlockDataAddChange.decode_from,
+    BlockChangeType.REMOVE_TEXT: BlockDataRemoveChange.decode_from,
+    BlockChangeType.CHANGED_TYPE: BlockChangedType.decode_from,
+}
+
+
+def change_decode_from(rdr: Reader) -> typing.Optional[BlockChanged]:
+    decoder = CHANGE_DECODERS.get(rdr.read_u8(), None)
+    if decoder is None:
+        return None
+    return decoder(rdr)
+
+
 class BlockPatch:
     def __init__(self):
-        self.change_queue: list[tuple[int, BlockChanged]] = []
+        self.change_queue = ChangeQueue()
 
     def set_changes_id(self, change_id):
-        change_queue = self.change_queue
-        self.change_queue = []
-        for id_, change in change_queue:
-            self.change_queue.append((change_id, change))
+        self.change_queue.set_ids(change_id)
 
     def drop_changes_with_smaller_change_id(self, change_id):
-        for v in self.change_queue.copy():
-            id_, _change = v
-            if id_ < change_id:
-                self.change_queue.remove(v)
+        self.change_queue.drop_before(change_id)
 
     def add_change(self, change: typing.Union[BlockChanged, 'BlockPatch']):
         if isinstance(change, BlockChanged):
@@ -372,22 +472,30 @@ class BlockPatch:
 
     def remove_change(self, change_id: typing.Union['BlockPatch', int]):
         if isinstance(change_id, int):
-            removed_list = []
-            for id_, change in self.change_queue:
-                if id_ != change_id:
-                    removed_list.append((id_, change))
-            self.change_queue = removed_list
+            self.change_queue.remove_ids((change_id,))
         else:
-            removed_list = []
-            remove_ids = set()
-            for change_hash, change in change_id.change_queue:
-                if change_hash not in remove_ids:
-                    remove_ids.add(change_hash)
-
-            for id_, change in self.change_queue:
-                if id_ not in remove_ids:
-                    removed_list.append((id_, change))
-            self.change_queue = removed_list
+            self.change_queue.remove_ids({id_ for id_, _change in change_id.change_queue})
+
+    def compact(self):
+        """
+        Merges runs of changes with the same id into as few changes as possible,
+        so text typed or deleted one key at a time becomes a single change.
+        Changes with different ids are never merged, they are acknowledged and dropped separately.
+        """
+        compacted = ChangeQueue()
+        last_id = last_change = None
+        for id_, change in self.change_queue:
+            if last_change is not None and id_ == last_id:
+                merged = last_change.merge(change)
+                if merged is not None:
+                    last_change = merged
+                    continue
+            if last_change is not None:
+                compacted.append((last_id, last_change))
+            last_id, last_change = id_, change
+        if last_change is not None:
+            compacted.append((last_id, last_change))
+        self.change_queue = compacted
 
     def map_point(self, block_i, block_pos):
         for _id, change in self.change_queue:
@@ -396,15 +504,31 @@ class BlockPatch:
 
     def rebase_to_change(self, base_change: BlockChanged):
         old_change_queue = self.change_queue
-        self.change_queue = []
+        self.change_queue = ChangeQueue()
         for id_, change in old_change_queue:
             mapped_changes = base_change.map(change)
             for mapped_change in mapped_changes:
                 self.change_queue.append((id_, mapped_change))
 
     def rebase_to(self, base: 'BlockPatch'):
+        """
+        Rebases this patch onto base, and base onto this patch.
+        Same result as rebase_to_naive, mapping changes only through the base changes that can move them.
+        """
+        transformer = PatchTransformer(base.change_queue)
         old_change_queue = self.change_queue
-        self.change_queue = []
+        self.change_queue = ChangeQueue()
+        for id_, change in old_change_queue:
+            mapped_changes = transformer.map_change(change)
+            for res in mapped_changes:
+                self.change_queue.append((id_, res))
+            for mapped_change in mapped_changes:
+                transformer.rebase_base(mapped_change)
+        base.change_queue = ChangeQueue(transformer.base_entries())
+
+    def rebase_to_naive(self, base: 'BlockPatch'):
+        old_change_queue = self.change_queue
+        self.change_queue = ChangeQueue()
         for id_, change in old_change_queue:
             mapped_changes = [change]
 
@@ -424,30 +548,23 @@ class BlockPatch:
             for mapped_change in mapped_changes:
                 base.rebase_to_change(mapped_change)
 
-    def apply_on_blocks(self, blocks: list[Block]):
-        for block in blocks:
-            block.contents_modified = False
-
+    def apply_on_blocks(self, blocks: list[Block]) -> set[int]:
+        """
+        Applies every change to blocks, and returns the indices of the blocks it modified or added.
+        Only those blocks are normalized, the rest of the document isn't visited.
+        """
+        dirty: set[int] = set()
         for _id, change in self.change_queue:
             change.apply_to_blocks(blocks)
+            dirty = change.update_dirty(dirty, len(blocks))
 
-        # Cleanup
-        for block in blocks:
-            block_contents_copy = block.block_contents
-            block.block_contents = []
-            for b in block_contents_copy:
-                if block.block_contents:
-                    if isinstance(b, str) and isinstance(block.block_contents[-1], str):
-                        block.block_contents[-1] += b
-                        continue
-                if isinstance(b, str):
-                    if b == "":  # Skip empty string
-                        continue
-                block.block_contents.append(b)
+        for block_i in dirty:
+            blocks[block_i].normalize_contents()
+        return dirty
 
     def copy(self):
         r = BlockPatch()
-        r.change_queue = [(id_, o.copy()) for id_, o in self.change_queue]
+        r.change_queue = ChangeQueue((id_, o.copy()) for id_, o in self.change_queue)
         return r
 
     def to_bytes(self) -> bytes:
@@ -459,7 +576,7 @@ class BlockPatch:
     @classmethod
     def from_bytes(cls, rdr: io.BytesIO):
         changes_length = struct.unpack("!H", rdr.read(2))[0]
-        change_queue = []
+        change_queue = ChangeQueue()
         for i in range(changes_length):
             id_ = struct.unpack("!I", rdr.read(4))[0]
             change = change_from_bytes(rdr)
@@ -470,6 +587,26 @@ class BlockPatch:
         patch.change_queue = change_queue
         return patch
 
+    def encode_into(self, buf: bytearray):
+        write_varint(buf, len(self.change_queue))
+        for id_, changed in self.change_queue:
+            write_varint(buf, id_)
+            changed.encode_into(buf)
+
+    @classmethod
+    def decode_from(cls, rdr: Reader) -> typing.Optional['BlockPatch']:
+        changes_length = rdr.read_varint()
+        change_queue = ChangeQueue()
+        for i in range(changes_length):
+            id_ = rdr.read_varint()
+            change = change_decode_from(rdr)
+            if change is None:
+                return None
+            change_queue.append((id_, change))
+        patch = cls()
+        patch.change_queue = change_queue
+        return patch
+
 
 if __name__ == '__main__':
     from common.FountianParser import FountainParser
@@ -1,7 +1,11 @@
 import io
+import itertools
 import struct
 from enum import IntEnum
 
+from common.Codec import Reader, CodecError, read_varint_at, write_varint, write_str
+from common.StyledContents import StyledContents
+
 LINES_PER_PAGE = 57
 
 
@@ -26,6 +30,10 @@ class Style(IntEnum):
     TEXT = 4
 
 
+STYLES = {style.value: style for style in Style}
+BLOCK_TYPES = {block_type.value: block_type for block_type in BlockType}
+
+
 def style_contents(block_contents: str):
     """length_wrap = {
         BlockType.CHARACTER: 58 - 43,
@@ -149,36 +157,109 @@ def decode_styled(rdr: io.BytesIO) -> list:
     return contents
 
 
+def encode_styled_into(buf: bytearray, styled: list):
+    # Version 2 of encode_styled, with varint lengths.
+    write_varint(buf, len(styled))
+    for v in styled:
+        if isinstance(v, str):
+            buf.append(Style.TEXT)
+            write_str(buf, v)
+        else:
+            buf.append(v)
+
+
+def decode_styled_from(rdr: Reader) -> list:
+    try:
+        contents, rdr.offset = decode_styled_at(rdr.view, rdr.offset)
+    except IndexError:
+        raise CodecError(f"Truncated styled contents at {rdr.offset}")
+    return contents
+
+
+def decode_styled_at(view: memoryview, offset: int) -> tuple[list, int]:
+    # Reads straight from the view, this runs for every block of a document.
+    contents_length = view[offset]
+    if contents_length < 0x80:
+        offset += 1
+    else:
+        contents_length, offset = read_varint_at(view, offset)
+    contents = []
+    for i in range(contents_length):
+        content_type = view[offset]
+        offset += 1
+        if content_type == Style.TEXT:
+            text_len = view[offset]
+            if text_len < 0x80:
+                offset += 1
+            else:
+                text_len, offset = read_varint_at(view, offset)
+            end = offset + text_len
+            if end > len(view):
+                raise CodecError(f"Truncated text at {offset}")
+            contents.append(str(view[offset:end], "utf-8"))
+            offset = end
+        else:
+            style = STYLES.get(content_type, None)
+            if style is None:
+                raise CodecError(f"Unknown style {content_type}")
+            contents.append(style)
+    return contents, offset
+
+
+def decode_blocks_from(rdr: Reader, count: int) -> list['Block']:
+    """
+    Decodes count consecutive blocks, as Block.decode_from would one by one.
+    """
+    view = rdr.view
+    offset = rdr.offset
+    blocks = []
+    try:
+        for i in range(count):
+            block_type = BLOCK_TYPES.get(view[offset], None)
+            if block_type is None:
+                raise CodecError(f"Unknown block type {view[offset]}")
+            contents, offset = decode_styled_at(view, offset + 1)
+            blocks.append(Block(block_type, contents))
+    except IndexError:
+        raise CodecError(f"Truncated block at {offset}")
+    rdr.offset = offset
+    return blocks
+
+
 class Block:
     def __init__(self, block_type: BlockType, block_contents: list):
         self.block_type: BlockType = block_type
-        self.block_contents: list = block_contents
-        self.contents_modified = False
+        self.block_contents: StyledContents = block_contents
+
+    @property
+    def block_contents(self) -> StyledContents:
+        return self.styled_contents
+
+    @block_contents.setter
+    def block_contents(self, block_contents: list):
+        if not isinstance(block_contents, StyledContents):
+            block_contents = StyledContents(block_contents)
+        self.styled_contents = block_contents
 
     def copy(self):
-        return Block(self.block_type, self.block_contents)
+        # Contents are edited in place, the copy gets its own.
+        return Block(self.block_type, StyledContents(self.block_contents))
 
     def get_at(self, block_pos):
-        block_queue = self.block_contents.copy()
-        while block_pos > 0 and block_queue:
-            v = block_queue.pop(0)
-            if isinstance(v, str):
-                if len(v) > block_pos:
-                    return v[block_pos]
-                block_pos -= len(v)
-            else:
-                if block_pos == 0:
-                    return v
-                block_pos -= 1
-        return None
+        return self.block_contents.get_at(block_pos)
 
     def exclude_styles(self, start, end):
         ranges = []
-        block_queue = self.block_contents.copy()
+        contents = self.block_contents
+        # Items ending before start are skipped without changing the ranges.
+        first = contents.first_index_ending_after(start)
+        block_pos = contents.item_start(first) if first < len(contents) else 0
+        start -= block_pos
+        end -= block_pos
         current_range = [0, 0]
-        block_pos = 0
-        while end > 0 and block_queue:
-            v = block_queue.pop(0)
+        for v in itertools.islice(contents, first, None):
+            if end <= 0:
+                break
             if isinstance(v, str):
                 if len(v) >= start:
                     range_start = max(start, 0)
@@ -201,14 +282,22 @@ class Block:
         ranges.append(current_range)
         return ranges
 
+    def normalize_contents(self):
+        # Merges adjacent strings and drops empty ones.
+        block_contents = []
+        for b in self.block_contents:
+            if block_contents:
+                if isinstance(b, str) and isinstance(block_contents[-1], str):
+                    block_contents[-1] += b
+                    continue
+            if isinstance(b, str):
+                if b == "":  # Skip empty string
+                    continue
+            block_contents.append(b)
+        self.block_contents = block_contents
+
     def get_block_len(self):
-        length = 0
-        for v in self.block_contents:
-            if isinstance(v, str):
-                length += len(v)
-            else:
-                length += 1
-        return length
+        return self.block_contents.length()
 
     @classmethod
     def from_text(cls, block_type: BlockType, block_contents: str):
@@ -230,6 +319,14 @@ class Block:
         contents = decode_styled(rdr)
         return Block(BlockType(block_type), contents)
 
+    def encode_into(self, buf: bytearray):
+        buf.append(self.block_type)
+        encode_styled_into(buf, self.block_contents)
+
+    @classmethod
+    def decode_from(cls, rdr: Reader) -> 'Block':
+        return decode_blocks_from(rdr, 1)[0]
+
 
 if __name__ == '__main__':
     from common.FountianParser import FountainParser
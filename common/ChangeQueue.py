@@ -0,0 +1,107 @@
+import collections
+import typing
+
+if typing.TYPE_CHECKING:
+    from common.BlockPatches import BlockChanged
+
+ChangeEntry = tuple[int, 'BlockChanged']
+
+
+class ChangeQueue:
+    """
+    Ordered queue of (change id, change) entries, the change_queue of a BlockPatch.
+
+    Entries are kept in a deque together with a count of entries per id,
+    so whether an id is queued is known in constant time. Acknowledged
+    and frozen-branch changes are always the oldest ones, so dropping them
+    only pops from the front: drop_before and remove_ids are amortized
+    constant time per removed entry as long as ids are appended in
+    non-decreasing order, which is how both the client and the server
+    number their changes. Otherwise they fall back to a linear filter.
+    """
+
+    def __init__(self, entries: typing.Iterable[ChangeEntry] = ()):
+        self.entries: collections.deque[ChangeEntry] = collections.deque()
+        self.id_counts: dict[int, int] = {}
+        # Whether the ids are in non-decreasing order.
+        self.monotonic = True
+        self.extend(entries)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __iter__(self) -> typing.Iterator[ChangeEntry]:
+        return iter(self.entries)
+
+    def __getitem__(self, index: int) -> ChangeEntry:
+        return self.entries[index]
+
+    def __contains__(self, change_id: int) -> bool:
+        return change_id in self.id_counts
+
+    def __repr__(self):
+        return f"ChangeQueue({list(self.entries)!r})"
+
+    def append(self, entry: ChangeEntry):
+        change_id = entry[0]
+        if self.entries and change_id < self.entries[-1][0]:
+            self.monotonic = False
+        self.entries.append(entry)
+        self.id_counts[change_id] = self.id_counts.get(change_id, 0) + 1
+
+    def extend(self, entries: typing.Iterable[ChangeEntry]):
+        for entry in entries:
+            self.append(entry)
+
+    def clear(self):
+        # New containers rather than clearing them, callers may still be iterating the old entries.
+        self.entries = collections.deque()
+        self.id_counts = {}
+        self.monotonic = True
+
+    def popleft(self) -> ChangeEntry:
+        entry = self.entries.popleft()
+        change_id = entry[0]
+        count = self.id_counts[change_id] - 1
+        if count:
+            self.id_counts[change_id] = count
+        else:
+            del self.id_counts[change_id]
+        if not self.entries:
+            self.monotonic = True
+        return entry
+
+    def filter(self, keep: typing.Callable[[int], bool]):
+        entries = self.entries
+        self.clear()
+        self.extend(entry for entry in entries if keep(entry[0]))
+
+    def drop_before(self, change_id: int):
+        """
+        Removes every entry with an id smaller than change_id.
+        """
+        if not self.monotonic:
+            self.filter(lambda id_: id_ >= change_id)
+            return
+        while self.entries and self.entries[0][0] < change_id:
+            self.popleft()
+
+    def remove_ids(self, change_ids: typing.Collection[int]):
+        """
+        Removes every entry whose id is in change_ids.
+        """
+        id_counts = self.id_counts
+        if not any(change_id in id_counts for change_id in change_ids):
+            return
+        while self.entries and self.entries[0][0] in change_ids:
+            self.popleft()
+        if any(change_id in id_counts for change_id in change_ids):
+            self.filter(lambda id_: id_ not in change_ids)
+
+    def set_ids(self, change_id: int):
+        entries = self.entries
+        self.clear()
+        self.extend((change_id, change) for _id, change in entries)
+
+    def copy(self) -> 'ChangeQueue':
+        return ChangeQueue(self.entries)
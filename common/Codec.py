@@ -0,0 +1,91 @@
+import typing
+
+# No value sent in the protocol needs more than 64 bits.
+MAX_VARINT_SIZE = 10
+
+
+class CodecError(ValueError):
+    pass
+
+
+def write_varint(buf: bytearray, value: int):
+    """
+    Appends an unsigned integer 7 bits per byte, lowest first, with the top bit set on every byte but the last.
+    """
+    if value < 0:
+        raise ValueError(f"Negative varint {value}")
+    while value >= 0x80:
+        buf.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+def write_bytes(buf: bytearray, data: bytes):
+    write_varint(buf, len(data))
+    buf += data
+
+
+def write_str(buf: bytearray, text: str):
+    write_bytes(buf, text.encode("utf-8"))
+
+
+def read_varint_at(view: memoryview, offset: int) -> tuple[int, int]:
+    """
+    Returns the varint at offset and the offset right after it.
+    """
+    end = min(offset + MAX_VARINT_SIZE, len(view))
+    start = offset
+    value = 0
+    shift = 0
+    while offset < end:
+        byte = view[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+    raise CodecError(f"Truncated or oversized varint at {start}")
+
+
+class Reader:
+    """
+    Reads the version 2 encoding from a memoryview, without copying anything but the values themselves.
+    Raises CodecError when the data is truncated or malformed.
+    """
+    __slots__ = ("view", "offset")
+
+    def __init__(self, data: typing.Union[bytes, bytearray, memoryview]):
+        self.view = memoryview(data)
+        self.offset = 0
+
+    @property
+    def remaining(self) -> int:
+        return len(self.view) - self.offset
+
+    def read(self, size: int) -> memoryview:
+        start = self.offset
+        end = start + size
+        if end > len(self.view):
+            raise CodecError(f"Truncated message, {size} bytes needed at {start}")
+        self.offset = end
+        return self.view[start:end]
+
+    def read_u8(self) -> int:
+        offset = self.offset
+        if offset >= len(self.view):
+            raise CodecError(f"Truncated message, 1 byte needed at {offset}")
+        self.offset = offset + 1
+        return self.view[offset]
+
+    def read_varint(self) -> int:
+        value, self.offset = read_varint_at(self.view, self.offset)
+        return value
+
+    def read_bytes(self) -> memoryview:
+        return self.read(self.read_varint())
+
+    def read_str(self) -> str:
+        return str(self.read_bytes(), "utf-8")
+
+    def read_ascii(self, size: int) -> str:
+        return str(self.read(size), "ascii")
@@ -1,29 +1,95 @@
 import dataclasses
+import functools
 import logging
 import select
 import struct
 import threading
+import time
 import ssl
 import typing
 
-from common.EndpointConstructors import EndpointID, EndpointConstructor
+from common.EndpointConstructors import EndpointID, EndpointConstructor, Capability, Hello
+from common.FrameCompression import FrameFlag, FLAG_SHIFT, ENDPOINT_ID_MASK, COMPRESSION_FLAGS
+from common.FrameCompression import split_endpoint_word, join_endpoint_word
+from common.FrameCompression import available_codecs, preferred_codec, compress, decompress
+from common.ReceiveBuffer import ReceiveBuffer
+from common import Metrics
+from common.OutboundQueue import OutboundQueue
 
 
 @dataclasses.dataclass
 class Endpoint:
     callback: typing.Callable
     constructor: type[EndpointConstructor]
+    # Run the callback off the event loop when served by an AsyncEndpointSocket,
+    # or off the reactor thread when served by a Reactor.
+    offload: bool = False
 
 
 class EndpointCallbackSocket:
-    def __init__(self, sock: ssl.SSLSocket, on_close: typing.Callable = None):
+    HEADER = struct.Struct("!II")
+    HEADER_SIZE = HEADER.size
+    SEND_SIZE = 0x4000
+
+    # Queued frames are packed into a single batch frame, written at once,
+    # when the writer flushes. The writer thread waits up to BATCH_DELAY
+    # seconds for BATCH_MAX_SIZE bytes to accumulate before flushing.
+    BATCH_MAX_SIZE = SEND_SIZE
+    BATCH_DELAY = 0.002
+
+    # Frames at least this big are compressed, if the peer agreed to a codec.
+    COMPRESSION_THRESHOLD = 0x400
+    # Version 2 adds the common.Codec payload encoding.
+    PROTOCOL_VERSION = 2
+
+    OUTBOUND_HIGH_WATERMARK = 0x40000
+    OUTBOUND_LOW_WATERMARK = 0x10000
+    OUTBOUND_MAX_SIZE = 0x400000
+
+    def __init__(self, sock: ssl.SSLSocket, on_close: typing.Callable = None, writer_thread: bool = True,
+                 high_watermark: int = OUTBOUND_HIGH_WATERMARK, low_watermark: int = OUTBOUND_LOW_WATERMARK,
+                 max_outbound: int = OUTBOUND_MAX_SIZE):
         self.sock = sock
         self.sock.setblocking(0)
-        self.pending_data = b""
+        self.recv_buffer = ReceiveBuffer()
+        self.discard_size = 0
+        self.batch: typing.Optional[memoryview] = None
+        self.batch_offset = 0
         self.endpoints: dict[EndpointID, Endpoint] = {}
         self.on_close: typing.Callable = on_close
         self.sock_lock = threading.RLock()
+        self.recv_lock = threading.RLock()
         self.closed = False
+        self.closing = False
+        # Any received frame proves the peer is alive.
+        self.last_received = time.monotonic()
+
+        # Batching, compression and newer payload encodings are only used once the peer's Hello
+        # says it understands them. Received frames are always decoded, whatever was agreed.
+        self.batch_frames = False
+        self.compression = FrameFlag.NONE
+        self.codec_version = 1
+        self.hello_sent = False
+        self.set_endpoint(Endpoint(self.received_hello, Hello))
+
+        # send_endp only queues frames. They are written either by our own
+        # writer thread or, without it, by whoever drives flush (a Reactor),
+        # which is told about new data through on_send_queued.
+        self.outbound = OutboundQueue(high_watermark, low_watermark, max_outbound)
+        self.on_send_queued: typing.Optional[typing.Callable] = None
+        # Set by a Reactor to run the callbacks of offload endpoints on its workers. Frames after
+        # an offloaded one stay in the receive buffer until it is done, then on_offload_done is called.
+        self.run_offloaded: typing.Optional[typing.Callable[[typing.Callable], typing.Any]] = None
+        self.on_offload_done: typing.Optional[typing.Callable] = None
+        self.offloaded = False
+        self.writer: typing.Optional[threading.Thread] = None
+        if writer_thread:
+            self.writer = threading.Thread(target=self.writer_loop, daemon=True)
+            self.writer.start()
+
+    def fileno(self) -> int:
+        # Allows the socket to be registered directly on a selector.
+        return self.sock.fileno()
 
     def set_endpoint(self, endpoint: Endpoint):
         self.endpoints[endpoint.constructor.ENDPOINT_ID] = endpoint
@@ -31,99 +97,337 @@ class EndpointCallbackSocket:
     def remove_endpoint(self, endpoint_constructor: type[EndpointConstructor]):
         self.endpoints.pop(endpoint_constructor.ENDPOINT_ID, None)
 
-    def continuous_recv(self, size) -> bytes:
-        data = self.pending_data
-        while len(data) < size and not self.closed:
+    @staticmethod
+    def supported_capabilities() -> Capability:
+        capabilities = Capability.BATCH
+        if available_codecs() & FrameFlag.ZLIB:
+            capabilities |= Capability.ZLIB
+        if available_codecs() & FrameFlag.ZSTD:
+            capabilities |= Capability.ZSTD
+        return capabilities
+
+    @classmethod
+    def agreed_codec(cls, capabilities: Capability) -> FrameFlag:
+        agreed = capabilities & cls.supported_capabilities()
+        codecs = FrameFlag.NONE
+        if agreed & Capability.ZLIB:
+            codecs |= FrameFlag.ZLIB
+        if agreed & Capability.ZSTD:
+            codecs |= FrameFlag.ZSTD
+        return preferred_codec(codecs)
+
+    def send_hello(self):
+        if self.hello_sent:
+            return
+        self.hello_sent = True
+        self.send_endp(Hello(self.PROTOCOL_VERSION, self.supported_capabilities()))
+
+    def received_hello(self, msg: Hello):
+        self.batch_frames = bool(msg.capabilities & self.supported_capabilities() & Capability.BATCH)
+        self.compression = self.agreed_codec(msg.capabilities)
+        self.codec_version = min(msg.protocol_version, self.PROTOCOL_VERSION)
+        # Answers the peer that started the exchange.
+        self.send_hello()
+
+    def wait_readable(self, timeout: float) -> bool:
+        # Any complete frame has already been dispatched by do_receive,
+        # so only the socket itself can make progress.
+        if self.closed:
+            return False
+        try:
+            with self.sock_lock:
+                if self.sock.pending():
+                    return True
+            return bool(select.select([self.sock], [], [], timeout)[0])
+        except (OSError, ValueError):
+            return False
+
+    def read_available(self) -> bool:
+        # Reads what the socket has ready into the receive buffer without ever blocking.
+        # Returns True if it stopped because the buffer is full of complete frames,
+        # which have to be dispatched before reading any further.
+        while not self.closed:
+            if not self.recv_buffer.writable():
+                return True
             try:
-                data += self.sock.recv(4096)
-            except ssl.SSLWantReadError as e:
-                if select.select([self.sock], [], [], 5)[0]:
+                with self.sock_lock:
+                    received = self.recv_buffer.recv_into(self.sock)
+            except (ssl.SSLWantReadError, ssl.SSLWantWriteError, BlockingIOError):
+                return False
+            except OSError:
+                self.close()
+                return False
+            if received == 0:
+                # The peer closed the connection.
+                self.close()
+                return False
+        return False
+
+    def lookup_endpoint(self, endpoint_id: int, msg_size: int) -> typing.Optional[Endpoint]:
+        endpoint = self.endpoints.get(endpoint_id, None)
+        if endpoint is None:
+            logging.warning(f"Endpoint {endpoint_id} not found.")
+            return None
+        if msg_size > endpoint.constructor.MAX_DATA_SIZE > -1:
+            logging.warning(f"Exceeded endpoint {endpoint_id} size ({msg_size}, "
+                            f"max {endpoint.constructor.MAX_DATA_SIZE})")
+            return None
+        return endpoint
+
+    @staticmethod
+    def decode_message(endpoint: Endpoint, flags: int, msg: memoryview) \
+            -> typing.Optional[tuple[Endpoint, memoryview, int]]:
+        # Returns the frame to dispatch: the endpoint, its payload and the codec version it's encoded with.
+        if not flags:
+            return endpoint, msg, 1
+        compression = flags & COMPRESSION_FLAGS
+        if compression:
+            msg = decompress(FrameFlag(compression), msg, endpoint.constructor.MAX_DATA_SIZE)
+            if msg is None:
+                return None
+        return endpoint, msg, 2 if flags & FrameFlag.CODEC_V2 else 1
+
+    def next_batched_frame(self) -> typing.Optional[tuple[Endpoint, memoryview, int]]:
+        batch = self.batch
+        while self.batch_offset < len(batch):
+            if len(batch) - self.batch_offset < self.HEADER_SIZE:
+                logging.warning("Truncated frame inside batch.")
+                break
+            endpoint_word, msg_size = self.HEADER.unpack_from(batch, self.batch_offset)
+            endpoint_id, flags = split_endpoint_word(endpoint_word)
+            msg_start = self.batch_offset + self.HEADER_SIZE
+            msg_end = msg_start + msg_size
+            if msg_end > len(batch):
+                logging.warning("Truncated frame inside batch.")
+                break
+            self.batch_offset = msg_end
+            endpoint = self.lookup_endpoint(endpoint_id, msg_size)
+            if endpoint is None:
+                continue
+            frame = self.decode_message(endpoint, flags, batch[msg_start:msg_end])
+            if frame is not None:
+                return frame
+        self.batch = None
+        return None
+
+    def next_frame(self) -> typing.Optional[tuple[Endpoint, memoryview, int]]:
+        recv_buffer = self.recv_buffer
+        while not self.closed:
+            if self.batch is not None:
+                frame = self.next_batched_frame()
+                if frame is not None:
+                    return frame
+            if self.discard_size:
+                self.discard_size -= recv_buffer.skip(self.discard_size)
+                if self.discard_size:
+                    return None
+            available = len(recv_buffer)
+            if available < self.HEADER_SIZE:
+                return None
+
+            endpoint_word, msg_size = recv_buffer.unpack_from(self.HEADER)
+            # Same as split_endpoint_word, without building a FrameFlag for every frame.
+            endpoint_id = endpoint_word & ENDPOINT_ID_MASK
+            flags = endpoint_word >> FLAG_SHIFT
+            if endpoint_id == EndpointID.BATCH:
+                endpoint = None
+                if msg_size > self.BATCH_MAX_SIZE or flags:
+                    logging.warning(f"Invalid batch frame ({msg_size} bytes, flags {flags!r})")
+                    recv_buffer.skip(self.HEADER_SIZE)
+                    self.discard_size = msg_size
+                    continue
+            else:
+                endpoint = self.lookup_endpoint(endpoint_id, msg_size)
+                if endpoint is None:
+                    recv_buffer.skip(self.HEADER_SIZE)
+                    self.discard_size = msg_size
                     continue
-                else:
-                    # Reraise exception if we've been waiting for more than 5 seconds.
-                    raise e
-        self.pending_data = data[size:]
-        return data[:size]
-
-    def throw_recv(self, size) -> None:
-        while size > len(self.pending_data):
-            try:
-                self.pending_data += self.sock.recv(4096)
-            except ssl.SSLWantReadError:
-                pass
-        self.pending_data = self.pending_data[size:]
 
-    def waiting_header(self) -> bool:
+            frame_size = self.HEADER_SIZE + msg_size
+            if available < frame_size:
+                recv_buffer.reserve(frame_size)
+                return None
+            msg = recv_buffer.consume(frame_size)[self.HEADER_SIZE:]
+            if endpoint is None:
+                # Unpacked frame by frame into the usual dispatch.
+                self.batch = msg
+                self.batch_offset = 0
+                continue
+            frame = self.decode_message(endpoint, flags, msg)
+            if frame is not None:
+                return frame
+        return None
+
+    def dispatch(self, endpoint: Endpoint, msg: memoryview, codec_version: int = 1):
+        # The message is a view into the receive buffer, decode must not keep it.
+        self.last_received = time.monotonic()
+        constructor = endpoint.constructor
+        decode_start = time.perf_counter()
+        endpoint_constructed = constructor.decode(msg, codec_version)
+        handler_start = time.perf_counter()
+        if Metrics.enabled:
+            Metrics.FRAMES_RECEIVED.inc(constructor)
+            Metrics.BYTES_RECEIVED.inc(constructor, len(msg))
+            Metrics.DECODE_SECONDS.observe(handler_start - decode_start, constructor)
+        if endpoint_constructed is None:
+            logging.warning(f"Endpoint {endpoint} couldn't be parsed.")
+            return
+        if endpoint.offload and self.run_offloaded is not None:
+            self.offloaded = True
+            self.run_offloaded(functools.partial(self.finish_offloaded, endpoint, endpoint_constructed, handler_start))
+            return
+        endpoint.callback(endpoint_constructed)
+        if Metrics.enabled:
+            Metrics.HANDLER_SECONDS.observe(time.perf_counter() - handler_start, constructor)
+
+    def finish_offloaded(self, endpoint: Endpoint, endpoint_constructed: EndpointConstructor, handler_start: float):
         try:
-            data = self.sock.recv(8)
-            self.pending_data += data
-            if len(data) == 0:
-                return False
-        except ssl.SSLWantReadError:
-            return False
-        except OSError:
+            endpoint.callback(endpoint_constructed)
+            if Metrics.enabled:
+                Metrics.HANDLER_SECONDS.observe(time.perf_counter() - handler_start, endpoint.constructor)
+        except Exception:
+            logging.exception(f"Exception in the offloaded callback of {endpoint}.")
             self.close()
-            return False
-        return len(self.pending_data) >= 8
+        finally:
+            self.offloaded = False
+            if self.on_offload_done:
+                self.on_offload_done()
 
     def do_receive(self):
-        with self.sock_lock:
-            if self.closed:
-                return
-            if not self.waiting_header():
+        # Reads whatever is ready and dispatches every complete frame.
+        # Incomplete frames stay buffered until the rest of the data arrives,
+        # so this never blocks waiting on the peer.
+        with self.recv_lock:
+            if self.closed or self.offloaded:
                 return
             try:
-                msg_header = self.continuous_recv(8)
-                endpoint_id, msg_size = struct.unpack("!II", msg_header)
-                if endpoint_id not in self.endpoints:
-                    logging.warning(f"Endpoint {endpoint_id} not found.")
-                    self.throw_recv(msg_size)
-                    return
-
-                endpoint = self.endpoints[endpoint_id]
-                if msg_size > endpoint.constructor.MAX_DATA_SIZE > -1:
-                    logging.warning(f"Exceeded endpoint {endpoint_id} size ({msg_size}, "
-                                    f"max {endpoint.constructor.MAX_DATA_SIZE})")
-                    self.throw_recv(msg_size)
-                    return
-
-                msg = self.continuous_recv(msg_size)
-                endpoint_constructed = endpoint.constructor.from_msg(msg)
-                if endpoint_constructed is not None:
-                    endpoint.callback(endpoint_constructed)
-                else:
-                    logging.warning(f"Endpoint {endpoint} couldn't be parsed.")
+                while True:
+                    buffer_full = self.read_available()
+                    while not self.offloaded and (frame := self.next_frame()) is not None:
+                        self.dispatch(*frame)
+                    if not buffer_full or self.offloaded:
+                        break
+                self.recv_buffer.shrink()
             except Exception:
                 logging.exception("Exception while performing receive.")
                 self.close()
 
+    @property
+    def congested(self) -> bool:
+        return self.outbound.congested
+
+    @classmethod
+    def encode_frame(cls, constructed: EndpointConstructor, compression: FrameFlag = FrameFlag.NONE,
+                     codec_version: int = 1) -> bytes:
+        codec_version = min(codec_version, constructed.CODEC_VERSION)
+        msg = constructed.encode(codec_version)
+        flags = FrameFlag.CODEC_V2 if codec_version >= 2 else FrameFlag.NONE
+        if compression and len(msg) >= cls.COMPRESSION_THRESHOLD:
+            compressed = compress(compression, msg)
+            if len(compressed) < len(msg):
+                msg = compressed
+                flags |= compression
+        return cls.HEADER.pack(join_endpoint_word(constructed.ENDPOINT_ID, flags), len(msg)) + msg
+
     def send_endp(self, constructed: EndpointConstructor):
         if self.closed:
             return
+        try:
+            frame = self.encode_frame(constructed, self.compression, self.codec_version)
+        except Exception:
+            logging.exception("Exception while sending to endpoint.")
+            self.close()
+            return
+        if Metrics.enabled:
+            Metrics.FRAMES_SENT.inc(type(constructed))
+            Metrics.BYTES_SENT.inc(type(constructed), len(frame))
+        self.send_frame(frame)
+
+    def send_frame(self, frame: bytes):
+        if self.closed:
+            return
+        if not self.outbound.put(frame):
+            logging.warning(f"Outbound queue overflowed ({len(self.outbound)} bytes queued), "
+                            f"disconnecting slow consumer.")
+            self.close()
+            return
+        if self.writer is None and self.on_send_queued:
+            self.on_send_queued()
+
+    @classmethod
+    def encode_batch(cls, frames: list[bytes]) -> bytes:
+        return cls.HEADER.pack(EndpointID.BATCH, sum(len(frame) for frame in frames)) + b"".join(frames)
+
+    def coalesce_outbound(self):
+        frames = self.outbound.take_frames(self.BATCH_MAX_SIZE)
+        if len(frames) > 1:
+            # Kept whole even when the socket can't take it yet, a batch can't be batched again.
+            self.outbound.push_front(self.encode_batch(frames), batched=True)
+        elif frames:
+            self.outbound.push_front(frames[0])
+
+    def flush(self) -> bool:
+        # Writes as much of the outbound queue as the socket takes without blocking.
+        # Returns True once the queue is empty (or the socket closed).
         with self.sock_lock:
+            while not self.closed:
+                if self.batch_frames:
+                    self.coalesce_outbound()
+                data = self.outbound.peek(self.SEND_SIZE)
+                if data is None:
+                    return True
+                try:
+                    data_sent = self.sock.send(data)
+                except (ssl.SSLWantWriteError, ssl.SSLWantReadError, BlockingIOError):
+                    return False
+                except OSError:
+                    logging.exception("Exception while sending to endpoint.")
+                    self.close()
+                    return True
+                self.outbound.advance(data_sent)
+        return True
+
+    def writer_loop(self):
+        while not self.closed:
+            if not self.outbound.wait(0.5):
+                continue
+            if self.batch_frames:
+                self.outbound.wait_for_size(self.BATCH_MAX_SIZE, self.BATCH_DELAY)
+            if self.flush():
+                continue
             try:
-                msg = constructed.to_bytes()
-                msg_header = struct.pack("!II", constructed.ENDPOINT_ID, len(msg))
-                data_to_be_sent = msg_header + msg
-                while len(data_to_be_sent):
-                    try:
-                        data_sent = self.sock.send(data_to_be_sent[:4096])
-                    except ssl.SSLWantWriteError as e:
-                        if select.select([], [self.sock], [], 5)[1]:
-                            continue
-                        else:
-                            # Re-raise exception if we block for more than 5 seconds
-                            raise e
-                    data_to_be_sent = data_to_be_sent[data_sent:]
-            except Exception:
-                logging.exception("Exception while sending to endpoint.")
-                self.close()
+                select.select([], [self.sock], [], 0.5)
+            except (OSError, ValueError):
+                break
 
     def close(self):
-        if self.closed:
+        if self.closed or self.closing:
             return
+        # Best effort to get out what is already queued, such as a Close frame.
+        self.closing = True
+        self.flush()
         self.closed = True
         with self.sock_lock:
+            self.outbound.clear()
             self.sock.close()
             if self.on_close:
                 self.on_close()
+
+
+def broadcast(sockets: typing.Iterable, constructed: EndpointConstructor):
+    """
+    Sends the same message to many sockets, encoding it only once per compression codec and
+    payload encoding in use. Sockets sharing both queue the same immutable frame.
+    """
+    frames: dict[tuple[FrameFlag, int], bytes] = {}
+    for sock in sockets:
+        if sock.closed:
+            continue
+        encoding = (sock.compression, sock.codec_version)
+        frame = frames.get(encoding, None)
+        if frame is None:
+            frame = frames[encoding] = EndpointCallbackSocket.encode_frame(constructed, *encoding)
+        if Metrics.enabled:
+            Metrics.FRAMES_SENT.inc(type(constructed))
+            Metrics.BYTES_SENT.inc(type(constructed), len(frame))
+        sock.send_frame(frame)
@@ -7,6 +7,8 @@ import struct
 class EndpointID(enum.IntEnum):
     PING = 1
     PONG = 2
+    BATCH = 3  # Several frames packed into one, handled by the socket itself
+    HELLO = 4  # Transport capabilities, exchanged on connect
 
     LOGIN = 10  # Done
     LOGIN_RESULT = 11  # Done
@@ -29,6 +31,10 @@ class EndpointID(enum.IntEnum):
     RENAMED_PROJECT = 52  # Done
     CLOSED_PROJECT = 62
 
+    # Server metrics, as the text exposition served over HTTP
+    STATS = 70
+    STATS_RESULT = 72
+
     # Project wide updates
     ERROR_FULFILLING_PROJECT_REQUEST = 99
     JOIN_DOC = 100
@@ -75,6 +81,9 @@ class EndpointID(enum.IntEnum):
 class EndpointConstructor:
     MAX_DATA_SIZE = 4096
     ENDPOINT_ID = 0
+    # Newest payload encoding the constructor has, see common.Codec.
+    # Version 1 is to_bytes and from_msg.
+    CODEC_VERSION = 1
 
     def __init__(self):
         pass
@@ -86,6 +95,15 @@ class EndpointConstructor:
     def from_msg(cls, msg: bytes):
         return cls()
 
+    def encode(self, codec_version: int) -> bytes:
+        return self.to_bytes()
+
+    @classmethod
+    def decode(cls, msg: bytes, codec_version: int):
+        if codec_version > cls.CODEC_VERSION:
+            return None
+        return cls.from_msg(msg)
+
 
 class RequestError(EndpointConstructor):
     MAX_DATA_SIZE = 256
@@ -127,7 +145,7 @@ class IdEndpoint(EndpointConstructor):
             return None
         if not re.match(b"^[a-fA-F0-9]{24}$", msg):
             return None
-        return cls(msg.decode("ascii"))
+        return cls(str(msg, "ascii"))
 
 
 class IdAndNameEndpoint(EndpointConstructor):
@@ -179,3 +197,30 @@ class Ping(EndpointConstructor):
 class Pong(EndpointConstructor):
     ENDPOINT_ID = EndpointID.PONG
     MAX_DATA_SIZE = 0
+
+
+class Capability(enum.IntFlag):
+    NONE = 0
+    BATCH = 1
+    ZLIB = 2
+    ZSTD = 4
+
+
+class Hello(EndpointConstructor):
+    ENDPOINT_ID = EndpointID.HELLO
+    MAX_DATA_SIZE = 2
+
+    def __init__(self, protocol_version: int, capabilities: Capability):
+        super().__init__()
+        self.protocol_version = protocol_version
+        self.capabilities = capabilities
+
+    def to_bytes(self) -> bytes:
+        return struct.pack("!BB", self.protocol_version, self.capabilities)
+
+    @classmethod
+    def from_msg(cls, msg: bytes):
+        if len(msg) != 2:
+            return None
+        protocol_version, capabilities = struct.unpack("!BB", msg)
+        return cls(protocol_version, Capability(capabilities))
@@ -0,0 +1,100 @@
+import enum
+import logging
+import typing
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class FrameFlag(enum.IntFlag):
+    """
+    Flags carried in the top byte of a frame's endpoint id word.
+    The lower bytes hold the endpoint id itself.
+    """
+    NONE = 0
+    ZLIB = 1
+    ZSTD = 2
+    # The payload uses the version 2 encoding of common.Codec.
+    CODEC_V2 = 0x10
+
+
+COMPRESSION_FLAGS = FrameFlag.ZLIB | FrameFlag.ZSTD
+
+FLAG_SHIFT = 24
+ENDPOINT_ID_MASK = (1 << FLAG_SHIFT) - 1
+
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+# Most a compressed frame may expand to, even for endpoints without a MAX_DATA_SIZE.
+MAX_DECOMPRESSED_SIZE = 0x2000000
+
+
+def split_endpoint_word(word: int) -> tuple[int, FrameFlag]:
+    return word & ENDPOINT_ID_MASK, FrameFlag(word >> FLAG_SHIFT)
+
+
+def join_endpoint_word(endpoint_id: int, flags: FrameFlag) -> int:
+    return endpoint_id | (flags << FLAG_SHIFT)
+
+
+def available_codecs() -> FrameFlag:
+    codecs = FrameFlag.ZLIB
+    if zstandard is not None:
+        codecs |= FrameFlag.ZSTD
+    return codecs
+
+
+def preferred_codec(codecs: FrameFlag) -> FrameFlag:
+    for codec in (FrameFlag.ZSTD, FrameFlag.ZLIB):
+        if codec & codecs & available_codecs():
+            return codec
+    return FrameFlag.NONE
+
+
+def compress(codec: FrameFlag, data: bytes) -> bytes:
+    if codec == FrameFlag.ZLIB:
+        return zlib.compress(data, ZLIB_LEVEL)
+    if codec == FrameFlag.ZSTD:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return data
+
+
+def decompress(codec: FrameFlag, data: typing.Union[bytes, memoryview],
+               max_size: int) -> typing.Optional[bytes]:
+    """
+    Decompresses a frame without ever producing more than max_size bytes, or
+    MAX_DECOMPRESSED_SIZE when that is smaller or max_size is -1, so a small
+    frame can't expand past what its endpoint accepts.
+    Returns None if the data is invalid or too large.
+    """
+    if max_size < 0 or max_size > MAX_DECOMPRESSED_SIZE:
+        max_size = MAX_DECOMPRESSED_SIZE
+    limit = max_size + 1
+    try:
+        if codec == FrameFlag.ZLIB:
+            decompressor = zlib.decompressobj()
+            result = decompressor.decompress(data, limit)
+            if not decompressor.eof:
+                logging.warning("Compressed frame is truncated or too large.")
+                return None
+        elif codec == FrameFlag.ZSTD and zstandard is not None:
+            with zstandard.ZstdDecompressor().stream_reader(data) as reader:
+                result = reader.read(limit)
+        else:
+            logging.warning(f"Unsupported frame compression {codec!r}.")
+            return None
+    except (zlib.error, ValueError) as error:
+        logging.warning(f"Couldn't decompress frame: {error}")
+        return None
+    except Exception as error:
+        if zstandard is not None and isinstance(error, zstandard.ZstdError):
+            logging.warning(f"Couldn't decompress frame: {error}")
+            return None
+        raise
+    if len(result) > max_size:
+        logging.warning(f"Decompressed frame exceeds {max_size} bytes.")
+        return None
+    return result
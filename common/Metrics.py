@@ -0,0 +1,165 @@
+import bisect
+import threading
+import typing
+
+
+class Metric:
+    """
+    Base for metrics that keep one value per label, such as an endpoint id.
+    Metrics are updated from every socket thread, so all updates take the metric's lock.
+    """
+    TYPE = "untyped"
+
+    def __init__(self, name: str, description: str, label_name: typing.Optional[str] = None):
+        self.name = name
+        self.description = description
+        self.label_name = label_name
+        self.lock = threading.Lock()
+
+    def format_labels(self, label, extra: str = "") -> str:
+        labels = []
+        if self.label_name is not None and label is not None:
+            # Endpoints are keyed by constructor class, which hashes much faster than
+            # an EndpointID, and shown by endpoint id name.
+            label = getattr(label, "ENDPOINT_ID", label)
+            labels.append(f'{self.label_name}="{getattr(label, "name", label)}"')
+        if extra:
+            labels.append(extra)
+        return "{" + ",".join(labels) + "}" if labels else ""
+
+    def samples(self) -> list[tuple[str, float]]:
+        return []
+
+
+class Counter(Metric):
+    TYPE = "counter"
+
+    def __init__(self, name: str, description: str, label_name: typing.Optional[str] = None):
+        super().__init__(name, description, label_name)
+        self.values: dict[typing.Any, float] = {}
+
+    def inc(self, label=None, amount: float = 1):
+        with self.lock:
+            self.values[label] = self.values.get(label, 0) + amount
+
+    def samples(self) -> list[tuple[str, float]]:
+        with self.lock:
+            return [(self.name + self.format_labels(label), value) for label, value in self.values.items()]
+
+
+class Gauge(Metric):
+    """
+    Gauge whose value is either set explicitly or, more usually, read from
+    a function when the metrics are collected, so nothing has to keep it up to date.
+    """
+    TYPE = "gauge"
+
+    def __init__(self, name: str, description: str, function: typing.Optional[typing.Callable[[], float]] = None):
+        super().__init__(name, description)
+        self.function = function
+        self.value = 0
+
+    def set(self, value: float):
+        with self.lock:
+            self.value = value
+
+    def get(self) -> float:
+        if self.function is not None:
+            return self.function()
+        with self.lock:
+            return self.value
+
+    def samples(self) -> list[tuple[str, float]]:
+        return [(self.name, self.get())]
+
+
+class Histogram(Metric):
+    TYPE = "histogram"
+    # Seconds, from 50 µs to 5 s.
+    DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                       0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    def __init__(self, name: str, description: str, label_name: typing.Optional[str] = None,
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, description, label_name)
+        self.buckets = buckets
+        # Per label: observation count of every bucket (the last one is +Inf), and the sum.
+        self.counts: dict[typing.Any, list[int]] = {}
+        self.sums: dict[typing.Any, float] = {}
+
+    def observe(self, value: float, label=None):
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.counts.get(label)
+            if counts is None:
+                counts = self.counts[label] = [0] * (len(self.buckets) + 1)
+                self.sums[label] = 0.0
+            counts[bucket] += 1
+            self.sums[label] += value
+
+    def samples(self) -> list[tuple[str, float]]:
+        samples = []
+        with self.lock:
+            for label, counts in self.counts.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    bound_text = "+Inf" if bound == float("inf") else repr(bound)
+                    samples.append((self.name + "_bucket" + self.format_labels(label, f'le="{bound_text}"'),
+                                    cumulative))
+                samples.append((self.name + "_sum" + self.format_labels(label), self.sums[label]))
+                samples.append((self.name + "_count" + self.format_labels(label), cumulative))
+        return samples
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        with self.lock:
+            # Registering again (a restarted server) replaces the previous metric.
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, description: str, label_name: typing.Optional[str] = None) -> Counter:
+        return self.register(Counter(name, description, label_name))
+
+    def gauge(self, name: str, description: str, function: typing.Optional[typing.Callable[[], float]] = None) -> Gauge:
+        return self.register(Gauge(name, description, function))
+
+    def histogram(self, name: str, description: str, label_name: typing.Optional[str] = None,
+                  buckets: tuple[float, ...] = Histogram.DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, description, label_name, buckets))
+
+    def render_text(self) -> str:
+        """
+        Renders every metric in the Prometheus text exposition format.
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.TYPE}")
+            for sample_name, value in metric.samples():
+                lines.append(f"{sample_name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+# Sockets only record frame metrics once this is set, which the server does on startup.
+enabled = False
+
+REGISTRY = MetricsRegistry()
+
+FRAMES_RECEIVED = REGISTRY.counter("frames_received_total", "Frames received, per endpoint.", "endpoint")
+BYTES_RECEIVED = REGISTRY.counter("bytes_received_total", "Frame payload bytes received, per endpoint.", "endpoint")
+FRAMES_SENT = REGISTRY.counter("frames_sent_total", "Frames sent, per endpoint.", "endpoint")
+BYTES_SENT = REGISTRY.counter("bytes_sent_total", "Frame bytes sent, header included, per endpoint.", "endpoint")
+DECODE_SECONDS = REGISTRY.histogram("frame_decode_seconds", "Time spent in from_msg, per endpoint.", "endpoint")
+HANDLER_SECONDS = REGISTRY.histogram("frame_handler_seconds", "Time spent in endpoint callbacks, per endpoint.",
+                                     "endpoint")
+RESIDENCY_HITS = REGISTRY.counter("residency_hits_total", "Opens served by an already loaded object, per kind.",
+                                  "kind")
+RESIDENCY_MISSES = REGISTRY.counter("residency_misses_total", "Opens that had to load the object, per kind.", "kind")
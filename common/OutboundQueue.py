@@ -0,0 +1,102 @@
+import collections
+import threading
+import typing
+
+
+class OutboundQueue:
+    """
+    Bounded queue of encoded frames waiting to be written to a socket.
+
+    Producers never block: put refuses data once max_size bytes are queued,
+    which is how slow consumers are detected. Crossing the high watermark
+    marks the queue as congested until it drains below the low watermark,
+    so the owner can stop reading from that peer in the meantime.
+    """
+
+    def __init__(self, high_watermark: int, low_watermark: int, max_size: int):
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.max_size = max_size
+
+        self.frames: collections.deque[bytes] = collections.deque()
+        self.offset = 0  # Bytes of the first frame that have already been written.
+        # The first frame is a batch pushed back by push_front, it is written as it is.
+        self.head_batched = False
+        self.size = 0
+        self.congested = False
+        self.condition = threading.Condition()
+
+    def __len__(self):
+        return self.size
+
+    def put(self, data: bytes) -> bool:
+        with self.condition:
+            if self.size + len(data) > self.max_size:
+                return False
+            self.frames.append(data)
+            self.size += len(data)
+            if self.size >= self.high_watermark:
+                self.congested = True
+            self.condition.notify_all()
+        return True
+
+    def take_frames(self, max_size: int) -> list[bytes]:
+        # Pops the whole frames at the front that fit in max_size bytes.
+        # Nothing is taken while the first frame is partially written or already a batch.
+        frames = []
+        with self.condition:
+            if self.offset or self.head_batched:
+                return frames
+            taken_size = 0
+            while self.frames and taken_size + len(self.frames[0]) <= max_size:
+                frame = self.frames.popleft()
+                frames.append(frame)
+                taken_size += len(frame)
+            self.size -= taken_size
+        return frames
+
+    def push_front(self, frame: bytes, batched: bool = False):
+        with self.condition:
+            self.frames.appendleft(frame)
+            self.size += len(frame)
+            self.head_batched = batched
+
+    def wait_for_size(self, size: int, timeout: float) -> bool:
+        with self.condition:
+            return self.condition.wait_for(lambda: self.size >= size, timeout)
+
+    def peek(self, max_size: int) -> typing.Optional[memoryview]:
+        with self.condition:
+            if not self.frames:
+                return None
+            return memoryview(self.frames[0])[self.offset:self.offset + max_size]
+
+    def advance(self, sent: int):
+        with self.condition:
+            self.offset += sent
+            self.size -= sent
+            if self.offset == len(self.frames[0]):
+                self.frames.popleft()
+                self.offset = 0
+                self.head_batched = False
+            if self.congested and self.size <= self.low_watermark:
+                self.congested = False
+                self.condition.notify_all()
+
+    def wait(self, timeout: float) -> bool:
+        # Waits until there is something to write.
+        with self.condition:
+            return self.condition.wait_for(lambda: self.size > 0, timeout)
+
+    def wait_uncongested(self, timeout: float) -> bool:
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.congested, timeout)
+
+    def clear(self):
+        with self.condition:
+            self.frames.clear()
+            self.offset = 0
+            self.size = 0
+            self.head_batched = False
+            self.congested = False
+            self.condition.notify_all()
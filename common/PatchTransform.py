@@ -0,0 +1,109 @@
+import bisect
+import typing
+
+if typing.TYPE_CHECKING:
+    from common.BlockPatches import BlockChanged
+
+ChangeEntry = tuple[int, 'BlockChanged']
+
+
+class PatchTransformer:
+    """
+    Rebases changes onto a base patch, updating the base as it goes.
+
+    Gives the same changes as mapping each change through every base change,
+    and then mapping every base change through the result, which is what
+    BlockPatch.rebase_to_naive does. It just avoids most of those maps:
+    text changes only ever affect text changes to the same block, and only
+    changes that add or remove blocks affect the others, so the base is
+    indexed by block and every change is only mapped through the base
+    changes that can move it.
+
+    The base is kept as one slot per original base change, holding what it
+    became (a removal can be split in two by an insert, or dropped with its
+    block), so the order of the base is kept without rebuilding it.
+    """
+
+    def __init__(self, base: typing.Iterable[ChangeEntry]):
+        self.slots: list[list[ChangeEntry]] = [[entry] for entry in base]
+        self.index_slots()
+
+    def index_slots(self):
+        # Slot indices, in order, of the base changes adding or removing blocks.
+        self.structural: list[int] = []
+        # Block id -> slot indices, in order, of the text changes to that block.
+        self.text: dict[int, list[int]] = {}
+        for i, slot in enumerate(self.slots):
+            if not slot:
+                continue
+            change = slot[0][1]
+            if change.SHIFTS_BLOCKS:
+                self.structural.append(i)
+            elif change.EDITS_TEXT:
+                self.text.setdefault(change.block_id, []).append(i)
+
+    @staticmethod
+    def map_through(slot: list[ChangeEntry], changes: typing.Sequence['BlockChanged']) \
+            -> typing.Sequence['BlockChanged']:
+        for _id, base_change in slot:
+            if len(changes) == 1:
+                changes = base_change.map(changes[0])
+                continue
+            mapped = []
+            for change in changes:
+                mapped.extend(base_change.map(change))
+            changes = mapped
+        return changes
+
+    @staticmethod
+    def map_slot(change: 'BlockChanged', slot: list[ChangeEntry]):
+        if len(slot) == 1:
+            id_, base_change = slot[0]
+            mapped = change.map(base_change)
+            if len(mapped) != 1:
+                slot[:] = [(id_, change_) for change_ in mapped]
+            elif mapped[0] is not base_change:
+                slot[0] = (id_, mapped[0])
+            return
+        slot[:] = [(id_, mapped) for id_, base_change in slot for mapped in change.map(base_change)]
+
+    def map_change(self, change: 'BlockChanged') -> typing.Sequence['BlockChanged']:
+        """
+        Maps a change through the whole base, it may be split or dropped on the way.
+        """
+        changes = [change]
+        slot_count = len(self.slots)
+        start = 0
+        for boundary in self.structural + [slot_count]:
+            if change.EDITS_TEXT:
+                # Every piece of a text change stays in the same block.
+                block_slots = self.text.get(changes[0].block_id)
+                if block_slots:
+                    first = bisect.bisect_left(block_slots, start)
+                    last = bisect.bisect_left(block_slots, boundary)
+                    for i in range(first, last):
+                        changes = self.map_through(self.slots[block_slots[i]], changes)
+            if boundary == slot_count:
+                break
+            changes = self.map_through(self.slots[boundary], changes)
+            if not changes:
+                break
+            start = boundary + 1
+        return changes
+
+    def rebase_base(self, change: 'BlockChanged'):
+        """
+        Maps every base change through a rebased change.
+        """
+        if change.SHIFTS_BLOCKS:
+            for slot in self.slots:
+                self.map_slot(change, slot)
+            self.index_slots()
+        elif change.EDITS_TEXT:
+            slots = self.slots
+            for i in self.text.get(change.block_id, ()):
+                self.map_slot(change, slots[i])
+
+    def base_entries(self) -> typing.Iterator[ChangeEntry]:
+        for slot in self.slots:
+            yield from slot
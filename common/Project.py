@@ -112,12 +112,21 @@ class Project:
         self.trash: dict[str, TrashObject] = trash
         self.project_id: typing.Optional[str] = None
 
+    @staticmethod
+    def split_path(path) -> list[str]:
+        path_split = []
+        while True:
+            head, tail = os.path.split(path)
+            if tail:
+                path_split.insert(0, tail)
+            if head == path or head == "":
+                return path_split
+            path = head
+
     def create_folder(self, path):
-        path_split = [path]
-        while path_split[0] != "":
-            v = path_split.pop(0)
-            path_split = list(os.path.split(v)).extend(path_split)
-        path_split = path_split[1:]
+        path_split = self.split_path(path)
+        if not path_split:
+            return None, "Folder already exists."
 
         current_folder = self.filesystem
         while len(path_split) != 1:
@@ -126,7 +135,7 @@ class Project:
                 return None, "Parent folder not found."
             current_folder = current_folder.folders[v]
         folder_name = path_split.pop(0)
-        if folder_name in current_folder:
+        if folder_name in current_folder.folders:
             return None, "Folder already exists."
         current_folder.folders[folder_name] = Folder.new()
         return current_folder.folders[folder_name], None
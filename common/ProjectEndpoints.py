@@ -1,4 +1,5 @@
-from common.Blocks import Block
+from common.Blocks import Block, decode_blocks_from
+from common.Codec import Reader, write_varint
 from common.EndpointConstructors import *
 
 
@@ -44,6 +45,7 @@ class LeftDoc(IdAndUsernameEndpoint):
 class SyncDoc(EndpointConstructor):
     ENDPOINT_ID = EndpointID.SYNC_DOC
     MAX_DATA_SIZE = 0x100000  # in bytes ~= 1 MB
+    CODEC_VERSION = 2
 
     def __init__(self, file_id: str, document_timestamp: int, blocks: list[Block]):
         super().__init__()
@@ -70,6 +72,30 @@ class SyncDoc(EndpointConstructor):
             blocks.append(Block.from_bytes(rdr))
         return cls(file_id, document_timestamp, blocks)
 
+    def encode(self, codec_version: int) -> bytes:
+        if codec_version < 2:
+            return self.to_bytes()
+        buf = bytearray(self.file_id.encode("ascii"))
+        write_varint(buf, self.document_timestamp)
+        write_varint(buf, len(self.blocks))
+        for block in self.blocks:
+            block.encode_into(buf)
+        return bytes(buf)
+
+    @classmethod
+    def decode(cls, msg: bytes, codec_version: int):
+        if codec_version < 2:
+            return cls.from_msg(msg)
+        try:
+            rdr = Reader(msg)
+            file_id = rdr.read_ascii(24)
+            document_timestamp = rdr.read_varint()
+            block_count = rdr.read_varint()
+            blocks = decode_blocks_from(rdr, block_count)
+        except ValueError:
+            return None
+        return cls(file_id, document_timestamp, blocks)
+
 
 class PathEndpoint(EndpointConstructor):
     def __init__(self, path: str):
@@ -0,0 +1,96 @@
+import socket
+import struct
+
+
+class ReceiveBuffer:
+    """
+    Preallocated receive buffer.
+
+    Data is read straight into a bytearray with recv_into and handed out as
+    memoryview slices, so a frame is never copied on its way to from_msg.
+    Consumed space at the front is reclaimed by moving the unread tail back
+    to the start, and the buffer only grows when a single frame does not fit.
+
+    Views returned by consume stay valid until the next call to writable,
+    so they must not be kept after the frame has been dispatched.
+    """
+    DEFAULT_CAPACITY = 0x10000
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY):
+        self.initial_capacity = capacity
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    @property
+    def capacity(self):
+        return len(self.buffer)
+
+    def reallocate(self, capacity: int):
+        # Views handed out earlier keep the old bytearray alive, so they stay valid.
+        size = len(self)
+        buffer = bytearray(capacity)
+        view = memoryview(buffer)
+        view[:size] = self.view[self.start:self.end]
+        self.buffer = buffer
+        self.view = view
+        self.start = 0
+        self.end = size
+
+    def reserve(self, size: int):
+        # Makes sure `size` unread bytes fit in the buffer.
+        if size <= self.capacity:
+            return
+        capacity = self.capacity
+        while capacity < size:
+            capacity *= 2
+        self.reallocate(capacity)
+
+    def shrink(self):
+        # Returns the memory used by an oversized frame once it has been consumed.
+        if self.capacity > self.initial_capacity and len(self) == 0:
+            self.reallocate(self.initial_capacity)
+
+    def compact(self):
+        if self.start == 0:
+            return
+        size = len(self)
+        # memoryview assignment handles the overlapping move.
+        self.view[:size] = self.view[self.start:self.end]
+        self.start = 0
+        self.end = size
+
+    def writable(self) -> memoryview:
+        if self.end == self.capacity:
+            self.compact()
+        return self.view[self.end:]
+
+    def recv_into(self, sock: socket.socket) -> int:
+        free = self.writable()
+        received = sock.recv_into(free, len(free))
+        self.end += received
+        return received
+
+    def write(self, data: bytes):
+        self.reserve(len(self) + len(data))
+        if self.capacity - self.end < len(data):
+            self.compact()
+        self.view[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def unpack_from(self, fmt: struct.Struct) -> tuple:
+        return fmt.unpack_from(self.buffer, self.start)
+
+    def consume(self, size: int) -> memoryview:
+        view = self.view[self.start:self.start + size]
+        self.start += size
+        return view
+
+    def skip(self, size: int) -> int:
+        skipped = min(size, len(self))
+        self.start += skipped
+        return skipped
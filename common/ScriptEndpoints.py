@@ -3,6 +3,7 @@ import struct
 import io
 
 from common.BlockPatches import BlockPatch
+from common.Codec import Reader, write_varint
 
 
 class ScriptScopeRequestError(RequestError):
@@ -11,6 +12,7 @@ class ScriptScopeRequestError(RequestError):
 
 class PatchScript(EndpointConstructor):
     ENDPOINT_ID = EndpointID.SCRIPT_PATCH
+    CODEC_VERSION = 2
 
     def __init__(self, document_id: str, patch: BlockPatch, branch_id: int, document_timestamp: int):
         super().__init__()
@@ -35,9 +37,35 @@ class PatchScript(EndpointConstructor):
             return None
         return cls(file_id, patch, branch_id, document_timestamp)
 
+    def encode(self, codec_version: int) -> bytes:
+        if codec_version < 2:
+            return self.to_bytes()
+        buf = bytearray(self.document_id.encode("ascii"))
+        write_varint(buf, self.branch_id)
+        write_varint(buf, self.document_timestamp)
+        self.patch.encode_into(buf)
+        return bytes(buf)
+
+    @classmethod
+    def decode(cls, msg: bytes, codec_version: int):
+        if codec_version < 2:
+            return cls.from_msg(msg)
+        try:
+            rdr = Reader(msg)
+            file_id = rdr.read_ascii(24)
+            branch_id = rdr.read_varint()
+            document_timestamp = rdr.read_varint()
+            patch = BlockPatch.decode_from(rdr)
+        except ValueError:
+            return None
+        if patch is None:
+            return None
+        return cls(file_id, patch, branch_id, document_timestamp)
+
 
 class PatchedScript(EndpointConstructor):
     ENDPOINT_ID = EndpointID.SCRIPT_PATCHED
+    CODEC_VERSION = 2
 
     def __init__(self, document_id: str, patch: BlockPatch, document_timestamp: int):
         super().__init__()
@@ -61,9 +89,33 @@ class PatchedScript(EndpointConstructor):
             return None
         return cls(file_id, patch, document_timestamp)
 
+    def encode(self, codec_version: int) -> bytes:
+        if codec_version < 2:
+            return self.to_bytes()
+        buf = bytearray(self.document_id.encode("ascii"))
+        write_varint(buf, self.document_timestamp)
+        self.patch.encode_into(buf)
+        return bytes(buf)
+
+    @classmethod
+    def decode(cls, msg: bytes, codec_version: int):
+        if codec_version < 2:
+            return cls.from_msg(msg)
+        try:
+            rdr = Reader(msg)
+            file_id = rdr.read_ascii(24)
+            document_timestamp = rdr.read_varint()
+            patch = BlockPatch.decode_from(rdr)
+        except ValueError:
+            return None
+        if patch is None:
+            return None
+        return cls(file_id, patch, document_timestamp)
+
 
 class AckPatch(EndpointConstructor):
     ENDPOINT_ID = EndpointID.SCRIPT_PATCH_ACK
+    CODEC_VERSION = 2
 
     def __init__(self, document_id: str, patch: BlockPatch):
         super().__init__()
@@ -83,3 +135,24 @@ class AckPatch(EndpointConstructor):
         if patch is None:
             return None
         return cls(file_id, patch)
+
+    def encode(self, codec_version: int) -> bytes:
+        if codec_version < 2:
+            return self.to_bytes()
+        buf = bytearray(self.document_id.encode("ascii"))
+        self.patch.encode_into(buf)
+        return bytes(buf)
+
+    @classmethod
+    def decode(cls, msg: bytes, codec_version: int):
+        if codec_version < 2:
+            return cls.from_msg(msg)
+        try:
+            rdr = Reader(msg)
+            file_id = rdr.read_ascii(24)
+            patch = BlockPatch.decode_from(rdr)
+        except ValueError:
+            return None
+        if patch is None:
+            return None
+        return cls(file_id, patch)
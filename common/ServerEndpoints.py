@@ -100,3 +100,27 @@ class SyncProject(EndpointConstructor):
         for i in range(user_count):
             users.append(User.from_bytes_public(rdr))
         return cls(project, users)
+
+
+class StatsRequest(EndpointConstructor):
+    ENDPOINT_ID = EndpointID.STATS
+    MAX_DATA_SIZE = 0
+
+
+class Stats(EndpointConstructor):
+    ENDPOINT_ID = EndpointID.STATS_RESULT
+    MAX_DATA_SIZE = 0x100000
+
+    def __init__(self, text: str):
+        super().__init__()
+        self.text: str = text
+
+    def to_bytes(self) -> bytes:
+        return self.text.encode("utf-8")
+
+    @classmethod
+    def from_msg(cls, msg: bytes):
+        try:
+            return cls(str(msg, "utf-8"))
+        except UnicodeDecodeError:
+            return None
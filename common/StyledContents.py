@@ -0,0 +1,209 @@
+import bisect
+import itertools
+import typing
+
+
+def content_size(v) -> int:
+    # Text counts one position per character, a style marker counts as one.
+    return len(v) if isinstance(v, str) else 1
+
+
+class StyledContents(list):
+    """
+    The contents of a block, text runs and Style markers, with an index of where each one ends.
+
+    It is still the plain list every other part of the code reads, compares
+    and encodes, so the encode_styled format is unchanged. Positions in the
+    block are looked up with a bisect over the end positions of the items
+    instead of walking the list from the start, and edits are done in place
+    on the list. Inserting and removing through this class shifts the index
+    of the items after the edit along with them, any other list mutation
+    drops the index from the first item it touches, to be rebuilt lazily the
+    next time a position is looked up.
+    """
+    __slots__ = ("ends", )
+
+    def __init__(self, contents: typing.Iterable = ()):
+        super().__init__(contents)
+        # ends[i] is the position right after item i, for the items indexed so far.
+        self.ends: list[int] = []
+
+    def invalidate_from(self, index: int):
+        if index < len(self.ends):
+            del self.ends[max(index, 0):]
+
+    def index_ends(self) -> list[int]:
+        ends = self.ends
+        count = len(ends)
+        if count < len(self):
+            ends.extend(itertools.accumulate(
+                map(content_size, itertools.islice(self, count, None)),
+                initial=ends[-1] if ends else 0
+            ))
+            # accumulate starts with the initial value, which is already in ends or is 0.
+            del ends[count]
+        return ends
+
+    def length(self) -> int:
+        ends = self.index_ends()
+        return ends[-1] if ends else 0
+
+    def replace_items(self, start: int, stop: int, items: list):
+        """
+        Replaces self[start:stop] with items, keeping the index of the items after them.
+        """
+        ends = self.ends
+        # Only the part of the index in front of the replaced items can be kept otherwise.
+        indexed = len(ends) >= stop
+        if indexed:
+            removed = ends[stop - 1] - self.item_start(start) if stop > start else 0
+            shift = sum(map(content_size, items)) - removed
+            tail = ends[stop:]
+        super().__setitem__(slice(start, stop), items)
+        del ends[start:]
+        if indexed:
+            end = ends[-1] if ends else 0
+            for v in items:
+                end += content_size(v)
+                ends.append(end)
+            if shift:
+                ends.extend([end_ + shift for end_ in tail])
+            else:
+                ends.extend(tail)
+
+    def item_start(self, index: int) -> int:
+        return self.ends[index - 1] if index > 0 else 0
+
+    def get_at(self, position: int):
+        """
+        Text character at position, or None at the boundary of two items, as Block.get_at always did.
+        """
+        if position <= 0:
+            return None
+        ends = self.index_ends()
+        i = bisect.bisect_right(ends, position)
+        if i == len(self):
+            return None
+        v = self[i]
+        offset = position - self.item_start(i)
+        if offset == 0 or not isinstance(v, str):
+            return None
+        return v[offset]
+
+    def insert_at(self, position: int, data: list):
+        """
+        Inserts data at position, nothing is inserted past the end.
+
+        Inserting right after a style marker goes after the markers that
+        follow, in front of the next text. When only markers follow, it
+        goes in front of the marker instead.
+        """
+        if position <= 0:
+            self.replace_items(0, 0, data)
+            return
+        ends = self.index_ends()
+        i = bisect.bisect_left(ends, position)
+        if i == len(self):
+            return
+        v = self[i]
+        if isinstance(v, str):
+            if ends[i] == position:
+                self.replace_items(i + 1, i + 1, data)
+                return
+            offset = position - self.item_start(i)
+            self.replace_items(i, i + 1, [v[:offset], *data, v[offset:]])
+            return
+        for j in range(i + 1, len(self)):
+            if isinstance(self[j], str):
+                self.replace_items(j, j, data)
+                return
+        self.replace_items(i, i, data)
+
+    def remove_range(self, start: int, length: int):
+        """
+        Removes length positions from start, text and markers alike.
+        """
+        if length <= 0:
+            return
+        start = max(start, 0)
+        ends = self.index_ends()
+        first = bisect.bisect_right(ends, start)
+        if first == len(self):
+            return
+        end = start + length
+        last = min(bisect.bisect_left(ends, end, first), len(self) - 1)
+        kept = []
+        v = self[first]
+        if isinstance(v, str) and start > self.item_start(first):
+            kept.append(v[:start - self.item_start(first)])
+        v = self[last]
+        if isinstance(v, str) and ends[last] > end:
+            kept.append(v[end - self.item_start(last):])
+        self.replace_items(first, last + 1, kept)
+
+    def first_index_ending_after(self, position: int) -> int:
+        """
+        Index of the first item ending at or after position.
+        """
+        return bisect.bisect_left(self.index_ends(), position)
+
+    # Every list mutation drops the index from the first item it touches.
+
+    def __setitem__(self, key, value):
+        if isinstance(key, slice):
+            start = key.indices(len(self))[0] if key.step in (None, 1) else 0
+        else:
+            start = key if key >= 0 else key + len(self)
+        self.invalidate_from(start)
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        if isinstance(key, slice):
+            start = key.indices(len(self))[0] if key.step in (None, 1) else 0
+        else:
+            start = key if key >= 0 else key + len(self)
+        self.invalidate_from(start)
+        super().__delitem__(key)
+
+    def __iadd__(self, other):
+        self.invalidate_from(len(self))
+        return super().__iadd__(other)
+
+    def __imul__(self, n):
+        self.invalidate_from(0)
+        return super().__imul__(n)
+
+    def append(self, v):
+        self.invalidate_from(len(self))
+        super().append(v)
+
+    def extend(self, values):
+        self.invalidate_from(len(self))
+        super().extend(values)
+
+    def insert(self, index, v):
+        self.invalidate_from(min(index, len(self)) if index >= 0 else 0)
+        super().insert(index, v)
+
+    def pop(self, index=-1):
+        self.invalidate_from(index if index >= 0 else index + len(self))
+        return super().pop(index)
+
+    def remove(self, v):
+        self.invalidate_from(0)
+        super().remove(v)
+
+    def clear(self):
+        self.ends = []
+        super().clear()
+
+    def reverse(self):
+        self.invalidate_from(0)
+        super().reverse()
+
+    def sort(self, *args, **kwargs):
+        self.invalidate_from(0)
+        super().sort(*args, **kwargs)
+
+    def __reduce__(self):
+        return StyledContents, (list(self), )
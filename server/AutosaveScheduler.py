@@ -0,0 +1,64 @@
+import logging
+import threading
+import time
+import typing
+
+if typing.TYPE_CHECKING:
+    from server.RealTimeDocument import RealTimeDocument
+
+
+class AutosaveScheduler(threading.Thread):
+    """
+    Saves the document files of open RealTimeDocuments in the background.
+
+    A document is saved once nobody edited it for interval seconds, or
+    once its oldest unsaved edit is max_staleness seconds old, so a
+    document that is edited continuously is still saved regularly.
+    Documents whose file is up to date are skipped, which is tracked by the
+    document timestamp they were last saved at.
+    """
+
+    def __init__(self, exit_event: threading.Event, interval: float, max_staleness: float):
+        super().__init__(name="AutosaveScheduler", daemon=True)
+        self.exit_event = exit_event
+        self.interval = interval
+        self.max_staleness = max_staleness
+        # Often enough for both deadlines to be met within a quarter of the shortest one.
+        self.check_interval = min(interval, max_staleness) / 4
+
+        self.documents_lock = threading.Lock()
+        self.documents: set['RealTimeDocument'] = set()
+
+    def add(self, rtd: 'RealTimeDocument'):
+        with self.documents_lock:
+            self.documents.add(rtd)
+
+    def remove(self, rtd: 'RealTimeDocument'):
+        with self.documents_lock:
+            self.documents.discard(rtd)
+
+    def is_due(self, rtd: 'RealTimeDocument', now: float) -> bool:
+        # Read without the document lock, a stale value only moves the save to the next check.
+        if not rtd.dirty:
+            return False
+        first_unsaved_edit = rtd.first_unsaved_edit
+        if first_unsaved_edit is not None and now - first_unsaved_edit >= self.max_staleness:
+            return True
+        last_edit = rtd.last_edit
+        return last_edit is None or now - last_edit >= self.interval
+
+    def save_due(self):
+        with self.documents_lock:
+            documents = list(self.documents)
+        now = time.monotonic()
+        for rtd in documents:
+            if not self.is_due(rtd, now):
+                continue
+            try:
+                rtd.save()
+            except Exception:
+                logging.exception(f"Couldn't autosave {rtd.file_id}")
+
+    def run(self):
+        while not self.exit_event.wait(self.check_interval):
+            self.save_due()
@@ -0,0 +1,89 @@
+import logging
+import os
+import struct
+import typing
+
+from common.Blocks import Block, decode_blocks_from
+from common.Codec import Reader, CodecError
+from common.FountianParser import FountainParser
+
+CACHE_MAGIC = b"SWBC"
+# Bumped whenever Block.encode_into or the parser change what a document file gives.
+CACHE_VERSION = 2
+# Magic, version, size and modification time in nanoseconds of the document file, and block count,
+# followed by the blocks in the version 2 encoding.
+CACHE_HEADER = struct.Struct("!4sBQQI")
+
+
+def cache_path(fountain_path: str) -> str:
+    return os.path.splitext(fountain_path)[0] + ".blocks"
+
+
+def encode_cache(source: os.stat_result, blocks: list[Block]) -> bytes:
+    data = bytearray(CACHE_HEADER.pack(CACHE_MAGIC, CACHE_VERSION, source.st_size, source.st_mtime_ns,
+                                       len(blocks)))
+    for block in blocks:
+        block.encode_into(data)
+    return bytes(data)
+
+
+def decode_cache(data: bytes, source: os.stat_result) -> typing.Optional[list[Block]]:
+    """
+    The cached blocks, or None when the cache is not for this version of the document file.
+    """
+    if len(data) < CACHE_HEADER.size:
+        return None
+    magic, version, size, mtime_ns, block_count = CACHE_HEADER.unpack_from(data)
+    if magic != CACHE_MAGIC or version != CACHE_VERSION:
+        return None
+    if size != source.st_size or mtime_ns != source.st_mtime_ns:
+        return None
+    rdr = Reader(data)
+    rdr.offset = CACHE_HEADER.size
+    try:
+        blocks = decode_blocks_from(rdr, block_count)
+    except (CodecError, ValueError):
+        # Bad UTF-8 in the text raises UnicodeDecodeError, a ValueError.
+        return None
+    if rdr.remaining:
+        return None
+    return blocks
+
+
+def write_cache(path: str, source: os.stat_result, blocks: list[Block]):
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        f.write(encode_cache(source, blocks))
+    # Renamed over the old one, a reader never sees it half written.
+    os.replace(temp_path, path)
+
+
+def load_document_blocks(fountain_path: str) -> list[Block]:
+    """
+    Blocks of a Fountain document file, from its .blocks cache when it's up to date.
+
+    The cache is tied to the size and modification time of the file, a
+    stale or unreadable cache is replaced by parsing the file again.
+    """
+    source = os.stat(fountain_path)
+    path = cache_path(fountain_path)
+    try:
+        with open(path, "rb") as f:
+            blocks = decode_cache(f.read(), source)
+        if blocks is not None:
+            return blocks
+    except FileNotFoundError:
+        pass
+    except OSError:
+        # A cache that can't be read is only slower, the file is parsed instead.
+        logging.exception(f"Couldn't read the blocks cache {path}")
+
+    parser = FountainParser()
+    with open(fountain_path, "r", encoding="utf-8") as f:
+        parser.parse(f.read())
+    try:
+        write_cache(path, source, parser.blocks)
+    except Exception:
+        # The document is still opened, just parsed again next time.
+        logging.exception(f"Couldn't write the blocks cache {path}")
+    return parser.blocks
@@ -1,6 +1,4 @@
-import datetime
 import hashlib
-import ssl
 import threading
 import typing
 from typing import TYPE_CHECKING
@@ -8,6 +6,7 @@ from typing import TYPE_CHECKING
 if TYPE_CHECKING:
     from server import Net
 from common.EndpointCallbackSocket import EndpointCallbackSocket, Endpoint
+from common import Metrics
 from common.LoginEndpoints import *
 from common.ServerEndpoints import *
 from common.ProjectEndpoints import *
@@ -16,12 +15,17 @@ from server.ServerUser import ServerUser
 from server.ServerProject import ServerProject, Folder
 from server.Config import ServerConfig
 from server.RealTimeDocument import RealTimeUser
+if TYPE_CHECKING:
+    from server.Reactor import Reactor
+    from common.AsyncEndpointSocket import AsyncEndpointSocket
 
 
 class ClientHandler(threading.Thread):
-    def __init__(self, sock: ssl.SSLSocket, sock_addr, master: 'Net.Net'):
+    def __init__(self, sock: typing.Union[EndpointCallbackSocket, 'AsyncEndpointSocket'], sock_addr,
+                 master: 'Net.Net'):
         super().__init__()
-        self.sock = EndpointCallbackSocket(sock, on_close=self.close)
+        self.sock = sock
+        self.sock.on_close = self.close
         self.setup_initial_endpoints()
         self.sock_addr = sock_addr
         self.master: 'Net.Net' = master
@@ -31,30 +35,26 @@ class ClientHandler(threading.Thread):
         self.current_real_time_users: dict[str, RealTimeUser] = {}
 
         self.exit_flag = threading.Event()
-
-        self.last_alive = datetime.datetime.now(datetime.timezone.utc)
-
-    def check_alive(self):
-        if datetime.datetime.now(datetime.timezone.utc) - self.last_alive > datetime.timedelta(seconds=7):
-            self.close()
-            return
-        self.sock.send_endp(AreYouAlive())
+        # Set when the client is serviced by a reactor instead of its own thread.
+        self.reactor: typing.Optional['Reactor'] = None
 
     def confirmed_alive(self, _msg):
-        self.last_alive = datetime.datetime.now(datetime.timezone.utc)
+        # Receiving the frame already updated sock.last_received, see LivenessScheduler.
+        pass
 
     def setup_initial_endpoints(self):
         self.sock.set_endpoint(Endpoint(self.close, Close))
         self.sock.set_endpoint(Endpoint(self.confirmed_alive, IAmAlive))
         self.sock.set_endpoint(Endpoint(self.ping, Ping))
-        self.sock.set_endpoint(Endpoint(self.login, LoginRequest))
+        self.sock.set_endpoint(Endpoint(self.login, LoginRequest, offload=True))
 
     def setup_endpoints_logged_in(self):
         self.sock.remove_endpoint(LoginRequest)
-        self.sock.set_endpoint(Endpoint(self.create_project, CreateProject))
-        self.sock.set_endpoint(Endpoint(self.delete_project, DeleteProject))
-        self.sock.set_endpoint(Endpoint(self.rename_project, RenameProject))
-        self.sock.set_endpoint(Endpoint(self.open_project, OpenProject))
+        self.sock.set_endpoint(Endpoint(self.create_project, CreateProject, offload=True))
+        self.sock.set_endpoint(Endpoint(self.delete_project, DeleteProject, offload=True))
+        self.sock.set_endpoint(Endpoint(self.rename_project, RenameProject, offload=True))
+        self.sock.set_endpoint(Endpoint(self.open_project, OpenProject, offload=True))
+        self.sock.set_endpoint(Endpoint(self.stats, StatsRequest))
 
     def setup_endpoints_opened_project(self):
         self.sock.remove_endpoint(CreateProject)
@@ -62,7 +62,7 @@ class ClientHandler(threading.Thread):
         self.sock.remove_endpoint(RenameProject)
         self.sock.remove_endpoint(OpenProject)
 
-        self.sock.set_endpoint(Endpoint(self.join_document, JoinDoc))
+        self.sock.set_endpoint(Endpoint(self.join_document, JoinDoc, offload=True))
         self.sock.set_endpoint(Endpoint(self.patch_script, PatchScript))
 
     def login(self, login_request: LoginRequest):
@@ -139,7 +139,6 @@ class ClientHandler(threading.Thread):
         self.current_real_time_users[open_rtu.rtd.file_id] = open_rtu
 
     def patch_script(self, msg: PatchScript):
-        print("Got patch from client!")
         if msg.document_id not in self.current_real_time_users:
             self.sock.send_endp(ScriptScopeRequestError("Document not opened."))
             return
@@ -147,17 +146,31 @@ class ClientHandler(threading.Thread):
         open_rtu = self.current_real_time_users[msg.document_id]
         open_rtu.uploaded_patch(msg.patch, msg.branch_id, msg.document_timestamp)
 
+    def stats(self, _msg: StatsRequest):
+        self.sock.send_endp(Stats(Metrics.REGISTRY.render_text()))
+
     def ping(self, _data: bytes):
         print(f"Client {self.sock_addr} sent a ping!")
         self.sock.send_endp(Pong())
 
+    @property
+    def closed(self):
+        return self.exit_flag.is_set()
+
     def run(self) -> None:
         while not self.exit_flag.is_set():
-            self.sock.do_receive()
+            if self.sock.congested:
+                # Stop reading requests until the client catches up with our replies.
+                self.sock.outbound.wait_uncongested(0.2)
+                continue
+            if self.sock.wait_readable(0.2):
+                self.sock.do_receive()
         self.close()
 
     def close(self, _msg=b""):
         self.sock.send_endp(Close())
         self.sock.close()
         self.exit_flag.set()
+        if self.reactor:
+            self.reactor.remove_client(self)
         self.master.close_client(self)
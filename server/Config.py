@@ -4,6 +4,47 @@ import dataclasses
 @dataclasses.dataclass
 class ServerConfig:
     LISTENING_ADDR = ('0.0.0.0', 8684)
-    MAX_BIND = 5
+    # Pending connections the kernel queues before they are accepted (capped by somaxconn),
+    # large enough for every client reconnecting at once after a restart.
+    LISTEN_BACKLOG = 1024
+    # Seconds a client has to complete the TLS handshake.
+    HANDSHAKE_TIMEOUT = 10.0
+    # "selector" multiplexes every client on a few reactor threads,
+    # "asyncio" serves every client from a single event loop,
+    # "threaded" runs a thread per client.
+    SERVER_MODE = "selector"
+    REACTOR_THREADS = 4
+    # Threads per reactor running the callbacks that load from the database or the disk, such as
+    # opening a project or a document, so they never stall the other clients of the reactor.
+    REACTOR_OFFLOAD_WORKERS = 4
+    # Per client outbound queue, in bytes. Above the high watermark the client
+    # is not read from until its queue drains below the low watermark, and it
+    # is disconnected once the queue would exceed the maximum size.
+    OUTBOUND_HIGH_WATERMARK = 0x40000
+    OUTBOUND_LOW_WATERMARK = 0x10000
+    OUTBOUND_MAX_SIZE = 0x400000
+    # Clients that sent nothing for the idle timeout are sent AreYouAlive,
+    # and disconnected if they still send nothing within the response timeout.
+    KEEPALIVE_IDLE_TIMEOUT = 5.0
+    KEEPALIVE_RESPONSE_TIMEOUT = 5.0
+    # Local address the metrics text exposition is served on, None to disable it.
+    METRICS_ADDR = ('127.0.0.1', 8685)
+    # Seconds between journal group commits, every patch pushed in between is written and fsynced at once.
+    JOURNAL_COMMIT_INTERVAL = 0.05
+    # Revisions between document snapshots, the journal is compacted after each one.
+    JOURNAL_SNAPSHOT_INTERVAL = 500
+    # Seconds without edits after which a changed document file is saved,
+    # and longest a change may stay unsaved while a document is edited continuously.
+    AUTOSAVE_INTERVAL = 5.0
+    AUTOSAVE_MAX_STALENESS = 60.0
+    # Estimated bytes of projects and documents kept loaded, unused ones are evicted
+    # least recently used first above it.
+    RESIDENCY_MEMORY_BUDGET = 256 * 2**20
+    # Seconds a document stays loaded after its last editor left, and a project after its last user closed it.
+    DOCUMENT_GRACE_PERIOD = 300.0
+    PROJECT_IDLE_TIMEOUT = 1800.0
+    # Seconds between writes of project filesystem and trash changes, every change made in between
+    # is sent as a single update of the changed paths.
+    PROJECT_FLUSH_INTERVAL = 1.0
     MAX_TRASH_CAN_DAYS = 10
     MAX_PROJECT_NAME_LENGTH = 64
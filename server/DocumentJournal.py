@@ -0,0 +1,300 @@
+import logging
+import os
+import struct
+import threading
+import typing
+import zlib
+
+from common.BlockPatches import BlockPatch
+from common.Blocks import Block, decode_blocks_from
+from common.Codec import Reader, CodecError
+
+if typing.TYPE_CHECKING:
+    from server.RealTimeDocument import RealTimeDocument
+
+# Payload length and CRC32 of the payload, which is the revision followed by the patch.
+# Patches and blocks use the version 2 encoding, which has no limit on text lengths.
+RECORD_HEADER = struct.Struct("!II")
+REVISION = struct.Struct("!Q")
+SNAPSHOT_MAGIC = b"SWJ2"
+# Magic, revision and block count, followed by the blocks and a CRC32 of all of it.
+SNAPSHOT_HEADER = struct.Struct("!4sQI")
+SNAPSHOT_CRC = struct.Struct("!I")
+
+
+def fsync_directory(directory: str):
+    # Makes a rename in the directory durable, where directories can be opened.
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class DocumentJournal:
+    """
+    Append-only journal of the patches applied to a RealTimeDocument, with periodic snapshots.
+
+    Every pushed patch is appended as a record carrying its revision, the
+    number of patches applied since the journal was started. Records are
+    only buffered by append, commit writes every buffered record at once
+    and fsyncs, so all the patches pushed between two commits cost one
+    sequential write.
+
+    A snapshot holds the blocks as of a revision. It is written to a
+    temporary file and renamed over the previous one, then the journal is
+    rewritten with only the records from that revision on. A crash in
+    between leaves older records in the journal, which are skipped on
+    recovery. The first snapshot is written before any record reaches the
+    journal, so a journal is never replayed onto anything but its snapshot.
+    """
+
+    def __init__(self, file_id: str, directory: str = "documents"):
+        self.file_id = file_id
+        self.directory = directory
+        self.journal_path = os.path.join(directory, file_id + ".journal")
+        self.snapshot_path = os.path.join(directory, file_id + ".snapshot")
+
+        # Held while appending to the buffer, which is all push_patch waits for.
+        self.pending_lock = threading.Lock()
+        self.pending: list[tuple[int, bytes]] = []
+        # Revision of the next patch appended.
+        self.revision = 0
+
+        # Held for every file operation.
+        self.file_lock = threading.RLock()
+        self.file: typing.Optional[typing.BinaryIO] = None
+        self.snapshot_revision: typing.Optional[int] = None
+        self.closed = False
+
+    @classmethod
+    def encode_record(cls, revision: int, patch: BlockPatch) -> bytes:
+        payload = bytearray(REVISION.pack(revision))
+        patch.encode_into(payload)
+        return RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+    @staticmethod
+    def encode_snapshot(revision: int, blocks: list[Block]) -> bytes:
+        data = bytearray(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, revision, len(blocks)))
+        for block in blocks:
+            block.encode_into(data)
+        return bytes(data + SNAPSHOT_CRC.pack(zlib.crc32(data)))
+
+    @staticmethod
+    def decode_snapshot(data: bytes) -> typing.Optional[tuple[int, list[Block]]]:
+        if len(data) < SNAPSHOT_HEADER.size + SNAPSHOT_CRC.size:
+            return None
+        body = data[:-SNAPSHOT_CRC.size]
+        if SNAPSHOT_CRC.unpack_from(data, len(body))[0] != zlib.crc32(body):
+            return None
+        magic, revision, block_count = SNAPSHOT_HEADER.unpack_from(body)
+        if magic != SNAPSHOT_MAGIC:
+            return None
+        rdr = Reader(body)
+        rdr.offset = SNAPSHOT_HEADER.size
+        try:
+            blocks = decode_blocks_from(rdr, block_count)
+        except CodecError:
+            return None
+        if rdr.remaining:
+            return None
+        return revision, blocks
+
+    def recover(self) -> typing.Optional[list[Block]]:
+        """
+        Blocks as of the last committed revision, from the snapshot and the journal after it.
+        None when there is no snapshot, the document file is then up to date.
+        """
+        with self.file_lock:
+            try:
+                with open(self.snapshot_path, "rb") as f:
+                    snapshot = self.decode_snapshot(f.read())
+            except FileNotFoundError:
+                return None
+            if snapshot is None:
+                # Only ever replaced by a rename, so it's never left half written.
+                raise ValueError(f"Corrupted snapshot {self.snapshot_path}")
+            self.snapshot_revision, blocks = snapshot
+            self.revision = self.snapshot_revision
+
+            try:
+                with open(self.journal_path, "rb") as f:
+                    journal = f.read()
+            except FileNotFoundError:
+                journal = b""
+            offset = 0
+            replayed = 0
+            while offset + RECORD_HEADER.size <= len(journal):
+                size, crc = RECORD_HEADER.unpack_from(journal, offset)
+                payload = journal[offset + RECORD_HEADER.size:offset + RECORD_HEADER.size + size]
+                if len(payload) != size or zlib.crc32(payload) != crc:
+                    # Torn by a crash in the middle of a commit.
+                    break
+                revision = REVISION.unpack_from(payload)[0]
+                if revision > self.revision:
+                    logging.warning(f"Journal {self.journal_path} skips from revision {self.revision} to {revision}")
+                    break
+                if revision == self.revision:
+                    try:
+                        patch = BlockPatch.decode_from(Reader(memoryview(payload)[REVISION.size:]))
+                    except CodecError:
+                        patch = None
+                    if patch is None:
+                        # Its CRC matched, so it was written in an encoding this version can't read.
+                        raise ValueError(f"Undecodable record at {offset} in {self.journal_path}")
+                    patch.apply_on_blocks(blocks)
+                    self.revision += 1
+                    replayed += 1
+                # Older ones are already in the snapshot.
+                offset += RECORD_HEADER.size + size
+            if offset < len(journal):
+                logging.warning(f"Discarding {len(journal) - offset} bytes at the end of {self.journal_path}")
+                with open(self.journal_path, "r+b") as f:
+                    f.truncate(offset)
+                    f.flush()
+                    os.fsync(f.fileno())
+            logging.info(f"Recovered {self.file_id} at revision {self.revision}, {replayed} patches replayed")
+            return blocks
+
+    def append(self, patch: BlockPatch):
+        with self.pending_lock:
+            self.pending.append((self.revision, self.encode_record(self.revision, patch)))
+            self.revision += 1
+
+    def take_pending(self) -> list[tuple[int, bytes]]:
+        with self.pending_lock:
+            pending = self.pending
+            self.pending = []
+        return pending
+
+    @property
+    def needs_first_snapshot(self) -> bool:
+        return self.snapshot_revision is None and bool(self.pending)
+
+    def revisions_since_snapshot(self) -> int:
+        return self.revision - (self.snapshot_revision or 0)
+
+    def commit(self):
+        """
+        Writes every buffered record with a single write and fsync.
+        """
+        with self.file_lock:
+            if self.closed:
+                return
+            if self.needs_first_snapshot:
+                raise RuntimeError(f"Journal {self.file_id} committed before its first snapshot")
+            pending = self.take_pending()
+            if not pending:
+                return
+            if self.file is None:
+                self.file = open(self.journal_path, "ab")
+            self.file.write(b"".join(record for _revision, record in pending))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def write_snapshot(self, revision: int, snapshot: bytes):
+        """
+        Replaces the snapshot with one encoded at revision, then compacts the journal.
+        """
+        with self.file_lock:
+            if self.closed:
+                return
+            temp_path = self.snapshot_path + ".tmp"
+            with open(temp_path, "wb") as f:
+                f.write(snapshot)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.snapshot_path)
+            fsync_directory(self.directory)
+            self.snapshot_revision = revision
+
+            # Patches pushed since the snapshot was taken are kept, the others are in it.
+            pending = [(revision_, record) for revision_, record in self.take_pending() if revision_ >= revision]
+            if self.file is not None:
+                self.file.close()
+            self.file = open(self.journal_path, "wb")
+            self.file.write(b"".join(record for _revision, record in pending))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self, remove: bool = False):
+        """
+        Stops journaling, removing the journal and snapshot files once the document file has been saved.
+        """
+        with self.file_lock:
+            if self.closed:
+                return
+            self.closed = True
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            if remove:
+                self.remove_files(self.file_id, self.directory)
+
+    @staticmethod
+    def remove_files(file_id: str, directory: str = "documents"):
+        # The journal goes first, it is never replayed onto anything but the snapshot.
+        for extension in (".journal", ".snapshot", ".snapshot.tmp"):
+            try:
+                os.remove(os.path.join(directory, file_id + extension))
+            except FileNotFoundError:
+                pass
+
+
+class JournalCommitter(threading.Thread):
+    """
+    Group commits the journals of every open RealTimeDocument.
+
+    Wakes up every interval and commits each journal with buffered records,
+    so editors never wait on a disk write. A document is snapshotted
+    instead when it has no snapshot yet or snapshot_interval revisions were
+    committed since the last one. Blocks are encoded under the document
+    lock, the files are written outside of it.
+    """
+
+    def __init__(self, exit_event: threading.Event, interval: float, snapshot_interval: int):
+        super().__init__(name="JournalCommitter", daemon=True)
+        self.exit_event = exit_event
+        self.interval = interval
+        self.snapshot_interval = snapshot_interval
+
+        self.documents_lock = threading.Lock()
+        self.documents: set['RealTimeDocument'] = set()
+
+    def add(self, rtd: 'RealTimeDocument'):
+        with self.documents_lock:
+            self.documents.add(rtd)
+
+    def remove(self, rtd: 'RealTimeDocument'):
+        with self.documents_lock:
+            self.documents.discard(rtd)
+
+    def commit_document(self, rtd: 'RealTimeDocument'):
+        journal = rtd.journal
+        if journal.needs_first_snapshot or journal.revisions_since_snapshot() >= self.snapshot_interval:
+            with rtd.document_lock:
+                revision = journal.revision
+                snapshot = DocumentJournal.encode_snapshot(revision, rtd.blocks)
+            journal.write_snapshot(revision, snapshot)
+        else:
+            journal.commit()
+
+    def commit_all(self):
+        with self.documents_lock:
+            documents = list(self.documents)
+        for rtd in documents:
+            try:
+                self.commit_document(rtd)
+            except Exception:
+                logging.exception(f"Couldn't commit the journal of {rtd.file_id}")
+
+    def run(self):
+        while not self.exit_event.wait(self.interval):
+            self.commit_all()
+        # Whatever was pushed before exiting.
+        self.commit_all()
@@ -0,0 +1,131 @@
+import heapq
+import itertools
+import logging
+import selectors
+import socket
+import ssl
+import threading
+import time
+import typing
+
+
+class Handshaker(threading.Thread):
+    """
+    Completes the TLS handshake of accepted connections off the accept loop.
+
+    Sockets are wrapped with do_handshake_on_connect=False and driven
+    without blocking from a selector, so any number of handshakes progress
+    at once and a slow or malicious peer only holds up its own connection.
+    Handshakes not done within the timeout are dropped. Connections that
+    complete it are handed to on_ready from this thread.
+    """
+    SELECT_TIMEOUT = 0.2
+
+    def __init__(self, exit_event: threading.Event, ssl_context: ssl.SSLContext, timeout: float,
+                 on_ready: typing.Callable[[ssl.SSLSocket, typing.Any], None]):
+        super().__init__(name="Handshaker", daemon=True)
+        self.exit_event = exit_event
+        self.ssl_context = ssl_context
+        self.timeout = timeout
+        self.on_ready = on_ready
+        self.selector = selectors.DefaultSelector()
+
+        self.queue_lock = threading.Lock()
+        self.queued: list[tuple[ssl.SSLSocket, typing.Any]] = []
+        # (deadline, sequence, socket) of every pending handshake, expired lazily.
+        self.deadlines: list[tuple[float, int, ssl.SSLSocket]] = []
+        self.sequence = itertools.count()
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.wakeup_send.setblocking(False)
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ, None)
+
+    def add_connection(self, sock: socket.socket, sock_addr):
+        sock.setblocking(False)
+        try:
+            ssl_sock = self.ssl_context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False)
+        except (OSError, ValueError):
+            logging.exception(f"Couldn't start the TLS handshake with {sock_addr}.")
+            sock.close()
+            return
+        with self.queue_lock:
+            self.queued.append((ssl_sock, sock_addr))
+        try:
+            self.wakeup_send.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass
+
+    def process_queued(self):
+        with self.queue_lock:
+            queued = self.queued
+            self.queued = []
+        now = time.monotonic()
+        for ssl_sock, sock_addr in queued:
+            try:
+                self.selector.register(ssl_sock, selectors.EVENT_READ, sock_addr)
+            except (OSError, ValueError):
+                ssl_sock.close()
+                continue
+            heapq.heappush(self.deadlines, (now + self.timeout, next(self.sequence), ssl_sock))
+
+    def drop(self, ssl_sock: ssl.SSLSocket):
+        try:
+            self.selector.unregister(ssl_sock)
+        except (KeyError, ValueError):
+            pass
+        ssl_sock.close()
+
+    def expire_deadlines(self):
+        now = time.monotonic()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            _deadline, _sequence, ssl_sock = heapq.heappop(self.deadlines)
+            # Sockets that already completed or failed were unregistered.
+            try:
+                sock_addr = self.selector.get_key(ssl_sock).data
+            except (KeyError, ValueError):
+                continue
+            logging.info(f"TLS handshake with {sock_addr} timed out.")
+            self.drop(ssl_sock)
+
+    def advance(self, ssl_sock: ssl.SSLSocket, sock_addr):
+        try:
+            ssl_sock.do_handshake()
+        except ssl.SSLWantReadError:
+            self.selector.modify(ssl_sock, selectors.EVENT_READ, sock_addr)
+            return
+        except ssl.SSLWantWriteError:
+            self.selector.modify(ssl_sock, selectors.EVENT_WRITE, sock_addr)
+            return
+        except (ssl.SSLError, OSError) as error:
+            logging.info(f"TLS handshake with {sock_addr} failed: {error}")
+            self.drop(ssl_sock)
+            return
+        self.selector.unregister(ssl_sock)
+        try:
+            self.on_ready(ssl_sock, sock_addr)
+        except Exception:
+            logging.exception(f"Exception while setting up client {sock_addr}.")
+            ssl_sock.close()
+
+    def drain_wakeup(self):
+        try:
+            while self.wakeup_recv.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
+    def run(self) -> None:
+        while not self.exit_event.is_set():
+            self.process_queued()
+            for key, _events in self.selector.select(self.SELECT_TIMEOUT):
+                if key.data is None:
+                    self.drain_wakeup()
+                    continue
+                self.advance(key.fileobj, key.data)
+            self.expire_deadlines()
+        for key in list(self.selector.get_map().values()):
+            if key.data is not None:
+                key.fileobj.close()
+        self.selector.close()
+        self.wakeup_recv.close()
+        self.wakeup_send.close()
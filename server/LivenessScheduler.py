@@ -0,0 +1,80 @@
+import heapq
+import itertools
+import threading
+import time
+import typing
+
+from common.EndpointConstructors import AreYouAlive
+
+if typing.TYPE_CHECKING:
+    from server.ClientHandler import ClientHandler
+
+
+class LivenessScheduler(threading.Thread):
+    """
+    Keeps track of when every client has to be checked for liveness.
+
+    Each client has a single deadline in a heap, and the thread only wakes
+    up for the earliest one, so the work done scales with the deadlines
+    that expire rather than with the number of connected clients.
+
+    Any frame received from a client proves it is alive. When a deadline
+    expires, a client that sent something in the meantime is rescheduled
+    from its last frame, an idle one is sent AreYouAlive, and one that
+    still hasn't sent anything response_timeout seconds later is closed.
+    """
+
+    def __init__(self, exit_event: threading.Event, idle_timeout: float, response_timeout: float):
+        super().__init__(name="LivenessScheduler", daemon=True)
+        self.exit_event = exit_event
+        self.idle_timeout = idle_timeout
+        self.response_timeout = response_timeout
+
+        self.condition = threading.Condition()
+        self.deadlines: list[tuple[float, int, 'ClientHandler']] = []
+        # Breaks deadline ties, clients themselves are not comparable.
+        self.sequence = itertools.count()
+
+    def schedule(self, client: 'ClientHandler', deadline: float):
+        with self.condition:
+            heapq.heappush(self.deadlines, (deadline, next(self.sequence), client))
+            if self.deadlines[0][2] is client:
+                self.condition.notify()
+
+    def add_client(self, client: 'ClientHandler'):
+        self.schedule(client, time.monotonic() + self.idle_timeout)
+
+    def check_client(self, client: 'ClientHandler', now: float):
+        if client.closed:
+            # Closed clients simply drop out of the heap.
+            client.master.close_client(client)
+            return
+        idle_deadline = client.sock.last_received + self.idle_timeout
+        if now < idle_deadline:
+            self.schedule(client, idle_deadline)
+        elif now < idle_deadline + self.response_timeout:
+            client.sock.send_endp(AreYouAlive())
+            self.schedule(client, idle_deadline + self.response_timeout)
+        else:
+            client.close()
+
+    def pop_expired(self) -> list[tuple[float, int, 'ClientHandler']]:
+        with self.condition:
+            while not self.exit_event.is_set():
+                now = time.monotonic()
+                if self.deadlines and self.deadlines[0][0] <= now:
+                    expired = []
+                    while self.deadlines and self.deadlines[0][0] <= now:
+                        expired.append(heapq.heappop(self.deadlines))
+                    return expired
+                timeout = self.deadlines[0][0] - now if self.deadlines else None
+                # Also wakes up regularly to notice the exit event.
+                self.condition.wait(min(timeout, 0.5) if timeout is not None else 0.5)
+        return []
+
+    def run(self):
+        while not self.exit_event.is_set():
+            expired = self.pop_expired()
+            now = time.monotonic()
+            for _deadline, _sequence, client in expired:
+                self.check_client(client, now)
@@ -0,0 +1,43 @@
+import http.server
+import logging
+import threading
+
+from common.Metrics import MetricsRegistry
+
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def do_GET(self):
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.registry.render_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", self.CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("Metrics request: " + format % args)
+
+
+class MetricsHTTPServer(threading.Thread):
+    """
+    Serves the metrics registry as a text exposition on GET /metrics, for scraping.
+    Meant to be bound to a local address only, it has no authentication.
+    """
+
+    def __init__(self, address: tuple[str, int], registry: MetricsRegistry):
+        super().__init__(name="MetricsHTTP", daemon=True)
+        self.http_server = http.server.ThreadingHTTPServer(address, MetricsRequestHandler)
+        self.http_server.daemon_threads = True
+        self.http_server.registry = registry
+
+    def run(self):
+        self.http_server.serve_forever(poll_interval=0.5)
+
+    def stop(self):
+        self.http_server.shutdown()
+        self.http_server.server_close()
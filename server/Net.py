@@ -1,3 +1,4 @@
+import asyncio
 import datetime
 import logging
 import os.path
@@ -14,10 +15,21 @@ from cryptography.hazmat.primitives import hashes
 from cryptography.x509.oid import NameOID
 from cryptography.hazmat.primitives import serialization
 from server import Config, ClientHandler
+from server.Reactor import Reactor
+from server.LivenessScheduler import LivenessScheduler
+from server.Handshaker import Handshaker
+from server.MetricsHTTP import MetricsHTTPServer
+from common import Metrics
+from common.EndpointCallbackSocket import EndpointCallbackSocket, broadcast
+from common.AsyncEndpointSocket import AsyncEndpointSocket
 import select
 from common.ServerEndpoints import *
 from server.ServerProject import ServerProject
 from server.RealTimeDocument import RealTimeDocument, RealTimeUser
+from server.DocumentJournal import JournalCommitter
+from server.AutosaveScheduler import AutosaveScheduler
+from server import ResidencyManager
+from server.ProjectWriteBuffer import ProjectWriteBuffer
 
 
 def generate_certificate(cert_path, key_path):
@@ -85,13 +97,30 @@ class Net:
 
         self.connected_lock = threading.RLock()
         self.connected_clients = []
+        self.reactors: list[Reactor] = []
+        self.liveness = LivenessScheduler(self.exit_event, Config.ServerConfig.KEEPALIVE_IDLE_TIMEOUT,
+                                          Config.ServerConfig.KEEPALIVE_RESPONSE_TIMEOUT)
+        self.metrics_server: typing.Optional[MetricsHTTPServer] = None
+        self.journal_committer = JournalCommitter(self.exit_event, Config.ServerConfig.JOURNAL_COMMIT_INTERVAL,
+                                                  Config.ServerConfig.JOURNAL_SNAPSHOT_INTERVAL)
+        self.autosave = AutosaveScheduler(self.exit_event, Config.ServerConfig.AUTOSAVE_INTERVAL,
+                                          Config.ServerConfig.AUTOSAVE_MAX_STALENESS)
+        self.residency = ResidencyManager.ResidencyManager(self.exit_event,
+                                                           Config.ServerConfig.RESIDENCY_MEMORY_BUDGET,
+                                                           Config.ServerConfig.DOCUMENT_GRACE_PERIOD,
+                                                           Config.ServerConfig.PROJECT_IDLE_TIMEOUT)
 
         self.open_projects_lock = threading.RLock()
         self.open_projects: dict[str, ServerProject] = {}
+        # Documents taken out of their project and being saved, opening one waits for its event.
+        self.closing_documents_lock = threading.Lock()
+        self.closing_documents: dict[str, threading.Event] = {}
 
         self.ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
         self.mongo_client = pymongo.MongoClient("localhost", 27017)
         self.database = self.mongo_client["screenwriting"]
+        self.project_writes = ProjectWriteBuffer(self.exit_event, self.database,
+                                                 Config.ServerConfig.PROJECT_FLUSH_INTERVAL)
         try:
             self.database.command("ping")
         except pymongo.errors.ConnectionFailure:
@@ -107,30 +136,142 @@ class Net:
         logging.info("Loaded certificates...")
         self.bind_socket = socket.socket()
         self.bind_socket.bind(Config.ServerConfig.LISTENING_ADDR)
-        self.bind_socket.listen(Config.ServerConfig.MAX_BIND)
+        self.bind_socket.listen(Config.ServerConfig.LISTEN_BACKLOG)
+
+        self.liveness.start()
+        self.journal_committer.start()
+        self.autosave.start()
+        self.residency.start()
+        self.project_writes.start()
+        self.setup_metrics()
+        if Config.ServerConfig.SERVER_MODE == "selector":
+            for i in range(Config.ServerConfig.REACTOR_THREADS):
+                reactor = Reactor(self.exit_event, name=f"Reactor-{i}",
+                                  offload_workers=Config.ServerConfig.REACTOR_OFFLOAD_WORKERS)
+                reactor.start()
+                self.reactors.append(reactor)
+
+    def setup_metrics(self):
+        Metrics.enabled = True
+        Metrics.REGISTRY.gauge("connected_clients", "Connected clients.",
+                               lambda: len(self.connected_clients))
+        Metrics.REGISTRY.gauge("open_projects", "Projects loaded in memory.",
+                               lambda: len(self.open_projects))
+        Metrics.REGISTRY.gauge("open_documents", "Open real time documents.",
+                               lambda: sum(len(rtds) for rtds in self.get_open_documents()))
+        Metrics.REGISTRY.gauge("editing_users", "Users editing a real time document.",
+                               lambda: sum(len(rtd.editing_users) for rtds in self.get_open_documents()
+                                           for rtd in rtds))
+        Metrics.REGISTRY.gauge("resident_bytes", "Estimated size of the loaded projects and documents.",
+                               lambda: self.residency.resident_size)
+        Metrics.REGISTRY.gauge("document_hit_rate", "Document opens served without loading it.",
+                               lambda: self.residency.hit_rate(ResidencyManager.DOCUMENT))
+        Metrics.REGISTRY.gauge("project_hit_rate", "Project opens served without loading it.",
+                               lambda: self.residency.hit_rate(ResidencyManager.PROJECT))
+        if Config.ServerConfig.METRICS_ADDR is None:
+            return
+        try:
+            self.metrics_server = MetricsHTTPServer(Config.ServerConfig.METRICS_ADDR, Metrics.REGISTRY)
+        except OSError:
+            logging.exception("Couldn't start the metrics HTTP server.")
+            return
+        self.metrics_server.start()
+        logging.info(f"Serving metrics on {Config.ServerConfig.METRICS_ADDR}")
+
+    def get_open_documents(self) -> list[list[RealTimeDocument]]:
+        with self.open_projects_lock:
+            projects = list(self.open_projects.values())
+        return [list(project.open_rtd.values()) for project in projects]
 
-        self.last_checked_alive = datetime.datetime.now(datetime.timezone.utc)
+    def start_client(self, handler: ClientHandler.ClientHandler):
+        if not self.reactors:
+            handler.start()
+            return
+        reactor = min(self.reactors, key=lambda r: r.client_count)
+        reactor.add_client(handler)
 
     def run(self):
-        while not self.exit_event.is_set():
-            if select.select([self.bind_socket], [], [], 0.2)[0]:
-                sock, sock_addr = self.bind_socket.accept()
-                sock = self.ssl_context.wrap_socket(sock, server_side=True)
-                handler = ClientHandler.ClientHandler(sock, sock_addr, self)
-                handler.start()
-                with self.connected_lock:
-                    self.connected_clients.append(handler)
-            for client in self.connected_clients.copy():
-                client: ClientHandler.ClientHandler
-                if not client.is_alive():
-                    self.close_client(client)
-            if datetime.datetime.now(datetime.timezone.utc) - self.last_checked_alive > datetime.timedelta(seconds=5):
-                self.last_checked_alive = datetime.datetime.now(datetime.timezone.utc)
-                for client in self.connected_clients.copy():
-                    client.check_alive()
+        if Config.ServerConfig.SERVER_MODE == "asyncio":
+            asyncio.run(self.run_asyncio())
+            self.residency.evict_all()
+            self.project_writes.join()
+            self.journal_committer.join()
+            self.autosave.join()
+            if self.metrics_server:
+                self.metrics_server.stop()
+            return
 
+        # The accept loop only accepts, TLS handshakes are completed by the handshaker,
+        # which then calls accept_client.
+        handshaker = Handshaker(self.exit_event, self.ssl_context, Config.ServerConfig.HANDSHAKE_TIMEOUT,
+                                self.accept_client)
+        handshaker.start()
+        self.bind_socket.setblocking(False)
+        while not self.exit_event.is_set():
+            if not select.select([self.bind_socket], [], [], 0.2)[0]:
+                continue
+            # Takes everything waiting in the backlog at once, for reconnect storms.
+            while True:
+                try:
+                    sock, sock_addr = self.bind_socket.accept()
+                except (BlockingIOError, InterruptedError):
+                    break
+                except OSError:
+                    logging.exception("Exception while accepting a client.")
+                    break
+                handshaker.add_connection(sock, sock_addr)
+
+        handshaker.join()
         for client in self.connected_clients.copy():
             self.close_client(client)
+        for reactor in self.reactors:
+            reactor.join()
+        self.residency.evict_all()
+        self.project_writes.join()
+        self.journal_committer.join()
+        self.autosave.join()
+        if self.metrics_server:
+            self.metrics_server.stop()
+
+    def accept_client(self, sock: ssl.SSLSocket, sock_addr):
+        endpoint_sock = EndpointCallbackSocket(
+            sock, writer_thread=not self.reactors,
+            high_watermark=Config.ServerConfig.OUTBOUND_HIGH_WATERMARK,
+            low_watermark=Config.ServerConfig.OUTBOUND_LOW_WATERMARK,
+            max_outbound=Config.ServerConfig.OUTBOUND_MAX_SIZE
+        )
+        handler = ClientHandler.ClientHandler(endpoint_sock, sock_addr, self)
+        with self.connected_lock:
+            self.connected_clients.append(handler)
+        self.start_client(handler)
+        self.liveness.add_client(handler)
+
+    async def run_asyncio(self):
+        # The event loop already handshakes without blocking other connections.
+        # start_server listens on the socket again, with a backlog of 100 unless told otherwise.
+        server = await asyncio.start_server(self.serve_async_client, sock=self.bind_socket,
+                                            backlog=Config.ServerConfig.LISTEN_BACKLOG,
+                                            ssl=self.ssl_context,
+                                            ssl_handshake_timeout=Config.ServerConfig.HANDSHAKE_TIMEOUT)
+        async with server:
+            while not self.exit_event.is_set():
+                await asyncio.sleep(0.2)
+
+            for client in self.connected_clients.copy():
+                self.close_client(client)
+
+    async def serve_async_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        sock = AsyncEndpointSocket(
+            reader, writer,
+            high_watermark=Config.ServerConfig.OUTBOUND_HIGH_WATERMARK,
+            low_watermark=Config.ServerConfig.OUTBOUND_LOW_WATERMARK,
+            max_outbound=Config.ServerConfig.OUTBOUND_MAX_SIZE
+        )
+        handler = ClientHandler.ClientHandler(sock, sock.get_peer_address(), self)
+        with self.connected_lock:
+            self.connected_clients.append(handler)
+        self.liveness.add_client(handler)
+        await sock.receive_loop()
 
     def close_client(self, client):
         with self.connected_lock:
@@ -153,7 +294,27 @@ class Net:
     def close_project(self, project: ServerProject):
         logging.info(f"Closing project {project.name}")
         with self.open_projects_lock:
-            project.save_to_database(self.database)
+            # Kept loaded until the residency manager evicts it, its changes are
+            # written by project_writes meanwhile and flushed once more on eviction.
+            self.residency.release(ResidencyManager.PROJECT, project.project_id,
+                                   ResidencyManager.estimate_project_size(project))
+
+    def evict_project(self, project: ServerProject):
+        with self.open_projects_lock:
+            if self.residency.contains(ResidencyManager.PROJECT, project.project_id) or \
+                    self.open_projects.get(project.project_id) is not project:
+                # Opened again since it was chosen for eviction.
+                return
+            logging.info(f"Evicting project {project.name}")
+            with project.open_rtd_lock:
+                closing = list(project.open_rtd.values())
+                for rtd in closing:
+                    self.residency.discard(ResidencyManager.DOCUMENT, rtd.file_id)
+                    self.take_realtime_document(rtd, project)
+            self.project_writes.remove(project)
+            self.open_projects.pop(project.project_id, None)
+        for rtd in closing:
+            self.close_realtime_document(rtd)
 
     def leave_realtime_user(self, realtime_user: RealTimeUser,
                             project: ServerProject):
@@ -162,39 +323,70 @@ class Net:
             rtd.broadcast_leave_client(realtime_user)
             with rtd.editing_users_lock:
                 if len(rtd.editing_users) == 0:
-                    self.close_realtime_document(rtd, project)
+                    # Kept open until the residency manager evicts it.
+                    self.residency.release(ResidencyManager.DOCUMENT, rtd.file_id,
+                                           ResidencyManager.estimate_document_size(rtd))
 
-    def close_realtime_document(self, rtd: RealTimeDocument, project: ServerProject):
-        rtd.save()
+    def evict_realtime_document(self, rtd: RealTimeDocument, project: ServerProject):
         with project.open_rtd_lock:
-            project.open_rtd.pop(rtd.file_id, None)
+            if self.residency.contains(ResidencyManager.DOCUMENT, rtd.file_id) or \
+                    project.open_rtd.get(rtd.file_id) is not rtd:
+                # Opened again since it was chosen for eviction.
+                return
+            self.take_realtime_document(rtd, project)
+        # Saved without holding up the opens of the project's other documents.
+        self.close_realtime_document(rtd)
+
+    def take_realtime_document(self, rtd: RealTimeDocument, project: ServerProject):
+        # Called with project.open_rtd_lock held, close_realtime_document has to follow.
+        project.open_rtd.pop(rtd.file_id, None)
+        with self.closing_documents_lock:
+            self.closing_documents[rtd.file_id] = threading.Event()
+
+    def close_realtime_document(self, rtd: RealTimeDocument):
+        self.autosave.remove(rtd)
+        self.journal_committer.remove(rtd)
+        try:
+            # Skipped when the autosave already saved the last patch.
+            rtd.save()
+        except Exception:
+            # The journal is kept, the document is recovered from it when opened again.
+            logging.exception(f"Couldn't save {rtd.file_id}")
+            if rtd.journal is not None:
+                self.journal_committer.commit_document(rtd)
+                rtd.journal.close()
+        else:
+            # Everything journaled is in the saved file now.
+            if rtd.journal is not None:
+                rtd.journal.close(remove=True)
+        finally:
+            with self.closing_documents_lock:
+                closed = self.closing_documents.pop(rtd.file_id)
+            closed.set()
 
     def get_project_list(self) -> list[tuple[str, str]]:
         project_collection = self.database["projects"]
         project_names = [(p["name"], str(p["_id"])) for p in project_collection.find()]
         return project_names
 
-    def broadcast_created_project(self, project: ServerProject):
-        msg = CreatedProject(project.project_id, project.name)
+    def broadcast_to_clients(self, msg: EndpointConstructor):
         with self.connected_lock:
-            for client in self.connected_clients:
-                client: ClientHandler.ClientHandler
-                client.sock.send_endp(msg)
+            broadcast([client.sock for client in self.connected_clients], msg)
+
+    def broadcast_created_project(self, project: ServerProject):
+        self.broadcast_to_clients(CreatedProject(project.project_id, project.name))
 
     def remove_project(self, project):
         msg = DeletedProject(project.project_id)
+        with self.open_projects_lock:
+            self.residency.discard(ResidencyManager.PROJECT, project.project_id)
+            self.project_writes.remove(project)
+            self.open_projects.pop(project.project_id, None)
         project.remove_from_database(self.database)
-        with self.connected_lock:
-            for client in self.connected_clients:
-                client: ClientHandler.ClientHandler
-                client.sock.send_endp(msg)
+        self.broadcast_to_clients(msg)
 
     def broadcast_rename_project(self, project):
-        msg = RenamedProject(project.project_id, project.name)
-        with self.connected_lock:
-            for client in self.connected_clients:
-                client: ClientHandler.ClientHandler
-                client.sock.send_endp(msg)
+        self.broadcast_to_clients(RenamedProject(project.project_id, project.name))
 
     def get_project_by_id(self, id_) -> ServerProject:
         with self.open_projects_lock:
@@ -209,11 +401,17 @@ class Net:
 
         with self.open_projects_lock:
             project = self.open_projects.get(id_, None)
+            size = 0
             if project is None:
                 project = ServerProject.load_from_id(self.database, id_)
+                if project is not None:
+                    size = ResidencyManager.estimate_project_size(project)
+                    self.project_writes.add(project)
             if project is None:
                 return None
             self.open_projects[project.project_id] = project
+            self.residency.use(ResidencyManager.PROJECT, project.project_id,
+                               lambda: self.evict_project(project), size)
 
             with project.project_lock:
                 project.opened_users.append(client_handler)
@@ -221,10 +419,8 @@ class Net:
         return project
 
     def broadcast_opened_project(self, project: ServerProject, client_handler: 'ClientHandler.ClientHandler'):
-        for user in project.opened_users:
-            if user == client_handler:
-                continue
-            user.sock.send_endp(OpenedProject(client_handler.user))
+        broadcast([user.sock for user in project.opened_users if user != client_handler],
+                  OpenedProject(client_handler.user))
 
     def open_realtime_document_by_id(self, client_handler: 'ClientHandler.ClientHandler',
                                      document_id: str):
@@ -234,18 +430,37 @@ class Net:
             return None
 
         project = client_handler.current_project
-        with project.open_rtd_lock:
-            open_rtd = project.open_rtd.get(document_id, None)
-            if open_rtd is None:
-                open_rtd = RealTimeDocument.open_from_database(self.database, document_id, project.project_id)
-                if open_rtd is not None:
-                    project.open_rtd[open_rtd.file_id] = open_rtd
+        while True:
+            with project.open_rtd_lock:
+                open_rtd = project.open_rtd.get(document_id, None)
+                closing = None
+                if open_rtd is None:
+                    with self.closing_documents_lock:
+                        closing = self.closing_documents.get(document_id, None)
+                if closing is None:
+                    return self.join_realtime_document(client_handler, project, document_id, open_rtd)
+            # Its files are only read again once the closing save is done with them.
+            closing.wait()
+
+    def join_realtime_document(self, client_handler: 'ClientHandler.ClientHandler', project: ServerProject,
+                               document_id: str, open_rtd: typing.Optional[RealTimeDocument]):
+        # Called with project.open_rtd_lock held, opens the document when it isn't open yet.
+        size = 0
+        if open_rtd is None:
+            open_rtd = RealTimeDocument.open_from_database(self.database, document_id, project.project_id)
+            if open_rtd is not None:
+                project.open_rtd[open_rtd.file_id] = open_rtd
+                self.journal_committer.add(open_rtd)
+                self.autosave.add(open_rtd)
+                size = ResidencyManager.estimate_document_size(open_rtd)
+
+        if open_rtd is None:
+            return None
+        self.residency.use(ResidencyManager.DOCUMENT, open_rtd.file_id,
+                           lambda: self.evict_realtime_document(open_rtd, project), size)
 
-            if open_rtd is None:
+        with open_rtd.editing_users_lock:
+            if client_handler in open_rtd.editing_users:
                 return None
 
-            with open_rtd.editing_users_lock:
-                if client_handler in open_rtd.editing_users:
-                    return None
-
-                return open_rtd.join_client(client_handler)
+            return open_rtd.join_client(client_handler)
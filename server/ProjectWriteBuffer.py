@@ -0,0 +1,56 @@
+import logging
+import threading
+import typing
+
+from pymongo import database
+
+if typing.TYPE_CHECKING:
+    from server.ServerProject import ServerProject
+
+
+class ProjectWriteBuffer(threading.Thread):
+    """
+    Writes the filesystem and trash changes of open ServerProjects to the
+    database in the background.
+
+    Changes only mark paths of the project entry, every flush_interval
+    seconds the paths marked since the last flush of a project are written
+    by a single update_one, however many edits touched the tree meanwhile.
+    A project is flushed one last time when it is removed.
+    """
+
+    def __init__(self, exit_event: threading.Event, db: database.Database, flush_interval: float):
+        super().__init__(name="ProjectWriteBuffer", daemon=True)
+        self.exit_event = exit_event
+        self.db = db
+        self.flush_interval = flush_interval
+
+        self.projects_lock = threading.Lock()
+        self.projects: set['ServerProject'] = set()
+
+    def add(self, project: 'ServerProject'):
+        with self.projects_lock:
+            self.projects.add(project)
+
+    def remove(self, project: 'ServerProject'):
+        with self.projects_lock:
+            self.projects.discard(project)
+        self.flush_project(project)
+
+    def flush_project(self, project: 'ServerProject'):
+        try:
+            project.save_updates(self.db)
+        except Exception:
+            # The changes stay marked, they are written by the next flush.
+            logging.exception(f"Couldn't write the changes of project {project.project_id}")
+
+    def flush_all(self):
+        with self.projects_lock:
+            projects = list(self.projects)
+        for project in projects:
+            self.flush_project(project)
+
+    def run(self):
+        while not self.exit_event.wait(self.flush_interval):
+            self.flush_all()
+        self.flush_all()
@@ -0,0 +1,188 @@
+import concurrent.futures
+import functools
+import logging
+import selectors
+import socket
+import threading
+import typing
+
+if typing.TYPE_CHECKING:
+    from server.ClientHandler import ClientHandler
+
+
+class Reactor(threading.Thread):
+    """
+    Multiplexes the sockets of many clients on a single thread.
+
+    Instead of every ClientHandler spinning on its own socket, the reactor
+    waits on a selector and only runs a client's endpoint callbacks when
+    its socket has data ready. It also writes out the clients' outbound
+    queues when their sockets can take more data, and stops reading from
+    clients whose outbound queue is congested until it drains.
+
+    Callbacks of endpoints marked offload, which load from the database or
+    the disk, run on a pool of offload_workers threads instead, so they
+    don't stall the other clients. The client isn't read from until its
+    offloaded callback is done, which keeps its frames in order.
+    """
+    SELECT_TIMEOUT = 0.2
+
+    def __init__(self, exit_event: threading.Event, name: str = None, offload_workers: int = 4):
+        super().__init__(name=name, daemon=True)
+        self.exit_event = exit_event
+        self.selector = selectors.DefaultSelector()
+        self.workers = concurrent.futures.ThreadPoolExecutor(offload_workers, thread_name_prefix=f"{self.name}-offload")
+
+        # Registrations are queued and applied from the reactor thread,
+        # so the selector is never modified while it is being waited on.
+        self.queue_lock = threading.Lock()
+        self.queued: list[tuple[bool, 'ClientHandler']] = []
+        self.flush_requests: set['ClientHandler'] = set()
+        self.resume_requests: set['ClientHandler'] = set()
+        self.interests: dict['ClientHandler', int] = {}
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.wakeup_send.setblocking(False)
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ, None)
+
+        # Clients added and not yet removed, a client closed by both its peer and
+        # the server is removed twice.
+        self.clients: set['ClientHandler'] = set()
+
+    @property
+    def client_count(self) -> int:
+        return len(self.clients)
+
+    def add_client(self, client: 'ClientHandler'):
+        client.reactor = self
+        client.sock.on_send_queued = functools.partial(self.request_flush, client)
+        client.sock.run_offloaded = self.workers.submit
+        client.sock.on_offload_done = functools.partial(self.request_resume, client)
+        with self.queue_lock:
+            self.queued.append((True, client))
+            self.clients.add(client)
+        self.wakeup()
+
+    def remove_client(self, client: 'ClientHandler'):
+        with self.queue_lock:
+            if client not in self.clients:
+                return
+            self.clients.remove(client)
+            self.queued.append((False, client))
+        self.wakeup()
+
+    def request_flush(self, client: 'ClientHandler'):
+        with self.queue_lock:
+            self.flush_requests.add(client)
+        # Requests made from the reactor itself are handled at the end of the current pass.
+        if threading.get_ident() != self.ident:
+            self.wakeup()
+
+    def request_resume(self, client: 'ClientHandler'):
+        # Called from a worker once an offloaded callback is done.
+        with self.queue_lock:
+            self.resume_requests.add(client)
+        self.wakeup()
+
+    def wakeup(self):
+        try:
+            self.wakeup_send.send(b"\0")
+        except (BlockingIOError, OSError):
+            # The reactor already has a pending wake up.
+            pass
+
+    def process_queued(self):
+        with self.queue_lock:
+            queued = self.queued
+            self.queued = []
+        for add, client in queued:
+            if add:
+                if client.sock.closed:
+                    continue
+                self.selector.register(client.sock, selectors.EVENT_READ, client)
+                self.interests[client] = selectors.EVENT_READ
+            else:
+                self.unregister(client)
+
+    def unregister(self, client: 'ClientHandler'):
+        if not self.interests.pop(client, None):
+            # Not registered, or only in interests while waiting on an offloaded callback.
+            return
+        try:
+            self.selector.unregister(client.sock)
+        except (KeyError, ValueError):
+            pass
+
+    def update_interest(self, client: 'ClientHandler'):
+        if client not in self.interests:
+            return
+        if client.sock.closed:
+            self.unregister(client)
+            return
+        events = 0
+        if not client.sock.congested and not client.sock.offloaded:
+            events |= selectors.EVENT_READ
+        if len(client.sock.outbound):
+            events |= selectors.EVENT_WRITE
+        current = self.interests[client]
+        if events == current:
+            return
+        # A client waiting on an offloaded callback with nothing to write is left out of the selector.
+        if not events:
+            self.selector.unregister(client.sock)
+        elif not current:
+            self.selector.register(client.sock, events, client)
+        else:
+            self.selector.modify(client.sock, events, client)
+        self.interests[client] = events
+
+    def process_flushes(self):
+        with self.queue_lock:
+            flush_requests = self.flush_requests
+            self.flush_requests = set()
+        for client in flush_requests:
+            client.sock.flush()
+            self.update_interest(client)
+
+    def process_resumes(self):
+        with self.queue_lock:
+            resume_requests = self.resume_requests
+            self.resume_requests = set()
+        for client in resume_requests:
+            if client not in self.interests:
+                continue
+            # Frames that arrived behind the offloaded one are still buffered.
+            client.sock.do_receive()
+            self.update_interest(client)
+
+    def drain_wakeup(self):
+        try:
+            while self.wakeup_recv.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
+    def service(self, client: 'ClientHandler', events: int):
+        if events & selectors.EVENT_WRITE:
+            client.sock.flush()
+        if events & selectors.EVENT_READ:
+            client.sock.do_receive()
+        self.update_interest(client)
+
+    def run(self) -> None:
+        while not self.exit_event.is_set():
+            self.process_queued()
+            for key, events in self.selector.select(self.SELECT_TIMEOUT):
+                if key.data is None:
+                    self.drain_wakeup()
+                    continue
+                try:
+                    self.service(key.data, events)
+                except Exception:
+                    logging.exception("Exception while servicing client.")
+            self.process_resumes()
+            self.process_flushes()
+        self.workers.shutdown(wait=True)
+        self.selector.close()
+        self.wakeup_recv.close()
+        self.wakeup_send.close()
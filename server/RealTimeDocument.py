@@ -1,5 +1,6 @@
 import logging
 import threading
+import time
 import typing
 
 import bson
@@ -7,10 +8,14 @@ import bson
 if typing.TYPE_CHECKING:
     from server.ClientHandler import ClientHandler
 from common.FountianParser import FountainParser
+from common.EndpointCallbackSocket import broadcast
 import os
 from common.ScriptEndpoints import *
 from common.ProjectEndpoints import *
 from common.Project import Document
+from server.RevisionLog import RevisionLog
+from server.DocumentJournal import DocumentJournal
+from server.BlocksCache import load_document_blocks
 from pymongo import database
 
 
@@ -18,7 +23,8 @@ class RealTimeUser:
     def __init__(self, handler: 'ClientHandler', rtd: 'RealTimeDocument'):
         self.rtd = rtd
         self.handler: 'ClientHandler' = handler
-        self.patch_from_old_to_new = BlockPatch()
+        # Document timestamp from which the revisions of the others are not in the user's patches.
+        self.revision_cursor = rtd.document_timestamp
         self.current_branch = 0
         self.frozen_branches_timestamps = {}
 
@@ -27,24 +33,17 @@ class RealTimeUser:
     def ack_patch(self, patch: BlockPatch):
         self.handler.sock.send_endp(AckPatch(self.rtd.file_id, patch))
 
-    def add_to_old(self, patch: BlockPatch):
-        self.patch_from_old_to_new.add_change(patch)
-
-    def broadcast_patch(self, patch: BlockPatch):
-        self.handler.sock.send_endp(
-            PatchedScript(self.rtd.file_id, patch, self.rtd.document_timestamp)
-        )
+    def oldest_revision(self) -> int:
+        """
+        Oldest document timestamp an upload from this user may still be rebased from.
+        """
+        return max(self.revision_cursor, min(self.frozen_branches_timestamps.values(), default=0))
 
     def broadcast_joined(self, realtime_user: 'RealTimeUser'):
         self.handler.sock.send_endp(
             JoinedDoc(self.rtd.file_id, realtime_user.handler.user.username)
         )
 
-    def broadcast_left(self, realtime_user: 'RealTimeUser'):
-        self.handler.sock.send_endp(
-            LeftDoc(self.rtd.file_id, realtime_user.handler.user.username)
-        )
-
     def send_doc_sync(self):
         self.handler.sock.send_endp(
             SyncDoc(self.rtd.file_id, self.rtd.document_timestamp,
@@ -52,43 +51,46 @@ class RealTimeUser:
         )
 
     def uploaded_patch(self, patch: BlockPatch, branch_id, branch_timestamp):
+        # The acknowledgement, the broadcast and the other users' rebase bases
+        # all get the compacted patch.
+        patch.compact()
         with self.rtd.document_lock:
             frozen_branch = False
             if branch_id >= self.current_branch:
                 if branch_timestamp == self.rtd.document_timestamp and branch_id == self.current_branch:
                     # up to date
-                    print(f"{self.handler.sock_addr} Branch is up to date")
+                    logging.debug(f"{self.handler.sock_addr} Branch is up to date")
                     self.rtd.push_patch(patch, self)
-                    self.patch_from_old_to_new = BlockPatch()
+                    self.revision_cursor = self.rtd.document_timestamp
+                    # Uploads arrive in order, older branches won't send anything else.
+                    self.frozen_branches_timestamps.clear()
                 else:
                     # freeze branch
                     self.frozen_branches_timestamps[branch_id] = branch_timestamp
                     self.current_branch += 1
-                    print(f"{self.handler.sock_addr} Branch has been frozen {self.current_branch}")
+                    logging.debug(f"{self.handler.sock_addr} Branch has been frozen {self.current_branch}")
                     frozen_branch = True
             else:
-                print(f"{self.handler.sock_addr} Branch already frozen ", branch_id, self.current_branch)
+                logging.debug(f"{self.handler.sock_addr} Branch already frozen {branch_id} {self.current_branch}")
                 frozen_branch = True
 
             if frozen_branch:
                 # Frozen branch
-                print(f"{self.handler.sock_addr}     Branch frozen")
+                logging.debug(f"{self.handler.sock_addr} Branch frozen")
 
-                # Drop changes before the freezing point
-                self.patch_from_old_to_new.drop_changes_with_smaller_change_id(
-                    self.frozen_branches_timestamps[branch_id]
-                )
+                # Only the revisions since the freezing point are rebased against
+                base_timestamp = max(self.revision_cursor, self.frozen_branches_timestamps[branch_id])
                 for id_ in self.frozen_branches_timestamps.copy():
                     if id_ < branch_id:
                         self.frozen_branches_timestamps.pop(id_, None)
 
-                patch.rebase_to(self.patch_from_old_to_new)
+                patch.rebase_to(self.rtd.revisions.rebase_base(self, base_timestamp))
                 self.rtd.push_patch(patch, self)
             self.ack_patch(patch)
 
 
 class RealTimeDocument(Document):
-    def __init__(self, file_id, project_id, blocks):
+    def __init__(self, file_id, project_id, blocks, journal: typing.Optional[DocumentJournal] = None):
         super().__init__(file_id)
         self.project_id = project_id
         self.document_lock = threading.RLock()
@@ -97,6 +99,17 @@ class RealTimeDocument(Document):
         self.editing_users_lock = threading.RLock()
         self.editing_users: dict[ClientHandler, RealTimeUser] = {}
         self.document_timestamp = 0
+        self.revisions = RevisionLog(self.document_timestamp)
+        # Patches are journaled as they are pushed, committed to disk by the JournalCommitter.
+        self.journal = journal
+
+        # Serializes writes of the document file, never held while waiting for document_lock.
+        self.save_lock = threading.Lock()
+        # Document timestamp the document file was last saved at, the file is up to date when it's the current one.
+        self.saved_timestamp = self.document_timestamp
+        # Monotonic times of the last patch and of the first one not saved yet.
+        self.last_edit: typing.Optional[float] = None
+        self.first_unsaved_edit: typing.Optional[float] = None
 
     def push_patch(self, patch, rt_user):
         with self.document_lock:
@@ -104,34 +117,48 @@ class RealTimeDocument(Document):
             patch.set_changes_id(self.document_timestamp)
             patch.apply_on_blocks(self.blocks)
             with self.editing_users_lock:
-                for _h, editing_user in self.editing_users.items():
-                    if editing_user is rt_user:
-                        continue
-                    editing_user.add_to_old(patch)
-                    editing_user.broadcast_patch(patch)
+                other_users = [u for u in self.editing_users.values() if u is not rt_user]
+                # Encoded once, every user is sent the same frame.
+                broadcast([u.handler.sock for u in other_users],
+                          PatchedScript(self.file_id, patch, self.document_timestamp))
+            self.revisions.append(rt_user, patch)
+            if self.journal is not None:
+                self.journal.append(patch)
             self.document_timestamp += 1
+            self.last_edit = time.monotonic()
+            if self.first_unsaved_edit is None:
+                self.first_unsaved_edit = self.last_edit
+            self.trim_revisions()
+
+    def trim_revisions(self):
+        with self.document_lock:
+            with self.editing_users_lock:
+                oldest = min((u.oldest_revision() for u in self.editing_users.values()),
+                             default=self.document_timestamp)
+            self.revisions.trim(oldest)
 
     def join_client(self, client_handler: 'ClientHandler'):
         with self.document_lock:
             realtime_user = RealTimeUser(client_handler, self)
             realtime_user.send_doc_sync()
             with self.editing_users_lock:
+                broadcast([u.handler.sock for u in self.editing_users.values()],
+                          JoinedDoc(self.file_id, client_handler.user.username))
                 for _h, editing_user in self.editing_users.items():
-                    editing_user.broadcast_joined(realtime_user)
                     realtime_user.broadcast_joined(editing_user)
                 self.editing_users[client_handler] = realtime_user
             return realtime_user
 
     def broadcast_leave_client(self, rt_user: RealTimeUser):
-        with self.editing_users_lock:
-            client_handler = rt_user.handler
+        with self.document_lock:
             with self.editing_users_lock:
+                client_handler = rt_user.handler
                 if client_handler not in self.editing_users:
                     return
                 self.editing_users.pop(client_handler)
-                # TODO: Find out why this changes size during iteration
-                for _h, editing_user in self.editing_users.copy().items():
-                    editing_user.broadcast_left(rt_user)
+                broadcast([u.handler.sock for u in self.editing_users.values()],
+                          LeftDoc(self.file_id, client_handler.user.username))
+            self.trim_revisions()
 
     @classmethod
     def open_from_database(cls, db: database.Database, file_id: str,
@@ -146,21 +173,63 @@ class RealTimeDocument(Document):
         if str(document["project_id"]) != project_id:
             return None
 
-        parser = FountainParser()
         path = os.path.join("documents", file_id + ".fountain")
         if not os.path.isfile(path):
             return None
 
-        with open(path, "r", encoding="utf-8") as f:
-            parser.parse(f.read())
-        return cls(file_id, project_id, parser.blocks)
-
-    def save(self):
+        # Unsaved patches from a crash are in the journal.
+        journal = DocumentJournal(file_id)
+        blocks = journal.recover()
+        if blocks is not None:
+            rtd = cls(file_id, project_id, blocks, journal)
+            # Newer than the document file, saved as soon as the autosave runs.
+            rtd.saved_timestamp = -1
+            rtd.first_unsaved_edit = time.monotonic()
+            return rtd
+        return cls(file_id, project_id, load_document_blocks(path), journal)
+
+    @property
+    def dirty(self) -> bool:
+        return self.document_timestamp != self.saved_timestamp
+
+    def save(self) -> bool:
+        """
+        Writes the document file if it changed since the last save, returns whether it did.
+
+        Only copying the blocks holds document_lock, editors don't wait for
+        the serialization or the disk. The file is written to a temporary
+        file renamed over it, so it's never left half written.
+        """
         with self.document_lock:
-            logging.info(f"Saving RTD {self.file_id}")
-            parser = FountainParser()
-            parser.blocks = self.blocks
-            path = os.path.join("documents", self.file_id + ".fountain")
-            serialized = parser.serialize()
-            with open(path, "w", encoding="utf-8") as f:
-                f.write(serialized)
+            if not self.dirty:
+                return False
+            timestamp = self.document_timestamp
+            blocks = [block.copy() for block in self.blocks]
+            unsaved_since = self.first_unsaved_edit
+            # Edits from now on are not in this save.
+            self.first_unsaved_edit = None
+
+        try:
+            with self.save_lock:
+                # A save of a later snapshot may have run in the meantime.
+                if timestamp <= self.saved_timestamp:
+                    return False
+                logging.info(f"Saving RTD {self.file_id}")
+                parser = FountainParser()
+                parser.blocks = blocks
+                serialized = parser.serialize()
+                path = os.path.join("documents", self.file_id + ".fountain")
+                temp_path = path + ".tmp"
+                with open(temp_path, "w", encoding="utf-8") as f:
+                    f.write(serialized)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temp_path, path)
+                self.saved_timestamp = timestamp
+        except BaseException:
+            with self.document_lock:
+                if unsaved_since is not None and (self.first_unsaved_edit is None or
+                                                  unsaved_since < self.first_unsaved_edit):
+                    self.first_unsaved_edit = unsaved_since
+            raise
+        return True
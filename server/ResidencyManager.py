@@ -0,0 +1,183 @@
+import collections
+import logging
+import threading
+import time
+import typing
+
+from common import Metrics
+
+if typing.TYPE_CHECKING:
+    from server.RealTimeDocument import RealTimeDocument
+    from server.ServerProject import ServerProject
+
+PROJECT = "project"
+DOCUMENT = "document"
+
+# Rough per object costs of what a loaded project or document keeps in memory,
+# the budget only has to be right within a small factor.
+BLOCK_OVERHEAD = 400
+STRING_OVERHEAD = 50
+ENTRY_OVERHEAD = 250
+
+
+def estimate_document_size(rtd: 'RealTimeDocument') -> int:
+    size = 0
+    for block in rtd.blocks:
+        size += BLOCK_OVERHEAD
+        for item in block.block_contents:
+            size += STRING_OVERHEAD + len(item) if isinstance(item, str) else 8
+    return size
+
+
+def estimate_project_size(project: 'ServerProject') -> int:
+    size = ENTRY_OVERHEAD * (1 + len(project.trash))
+    folders = [project.filesystem]
+    while folders:
+        folder = folders.pop()
+        size += ENTRY_OVERHEAD * (1 + len(folder.documents))
+        folders.extend(folder.folders.values())
+    return size
+
+
+class Resident:
+    def __init__(self, kind: str, key: str, on_evict: typing.Callable[[], None], size: int):
+        self.kind = kind
+        self.key = key
+        self.on_evict = on_evict
+        self.size = size
+        self.in_use = True
+        self.released_at = 0.0
+
+
+class ResidencyManager(threading.Thread):
+    """
+    Decides how long ServerProjects and RealTimeDocuments stay loaded once
+    nobody uses them.
+
+    An object is in use from when it is opened until its last user leaves,
+    it is then kept warm, so opening it again is a hit instead of a load
+    from the database and the document files. Warm documents are evicted
+    after document_grace seconds and warm projects after project_idle_timeout
+    seconds, and the least recently released ones go first whenever the
+    estimated size of everything resident exceeds memory_budget. Objects in
+    use are never evicted.
+
+    Eviction callbacks run on this thread (or on evict_all's caller), never
+    with the manager lock held, since they take the project and document
+    locks that the opening paths hold while calling use. A callback has to
+    check contains() under those locks and keep the object when it was
+    opened again in the meantime.
+    """
+
+    def __init__(self, exit_event: threading.Event, memory_budget: int, document_grace: float,
+                 project_idle_timeout: float):
+        super().__init__(name="ResidencyManager", daemon=True)
+        self.exit_event = exit_event
+        self.memory_budget = memory_budget
+        self.grace = {DOCUMENT: document_grace, PROJECT: project_idle_timeout}
+        self.check_interval = min(document_grace, project_idle_timeout) / 4
+
+        self.condition = threading.Condition()
+        self.residents: dict[tuple[str, str], Resident] = {}
+        # Released residents, least recently released first.
+        self.warm: collections.OrderedDict[tuple[str, str], Resident] = collections.OrderedDict()
+        self.resident_size = 0
+        self.hits = {DOCUMENT: 0, PROJECT: 0}
+        self.misses = {DOCUMENT: 0, PROJECT: 0}
+
+    def use(self, kind: str, key: str, on_evict: typing.Callable[[], None], size: int = 0) -> bool:
+        """
+        Marks an object as in use, registering it with its size when it was
+        just loaded. Returns whether it was already resident.
+        """
+        with self.condition:
+            resident = self.residents.get((kind, key))
+            if resident is None:
+                self.residents[(kind, key)] = Resident(kind, key, on_evict, size)
+                self.resident_size += size
+                self.misses[kind] += 1
+                if Metrics.enabled:
+                    Metrics.RESIDENCY_MISSES.inc(kind)
+                # Loading may have pushed everything over the budget.
+                self.condition.notify()
+                return False
+            if not resident.in_use:
+                resident.in_use = True
+                self.warm.pop((kind, key), None)
+            self.hits[kind] += 1
+            if Metrics.enabled:
+                Metrics.RESIDENCY_HITS.inc(kind)
+            return True
+
+    def release(self, kind: str, key: str, size: int):
+        """
+        Marks an object as unused from now on, with its current size.
+        """
+        with self.condition:
+            resident = self.residents.get((kind, key))
+            if resident is None or not resident.in_use:
+                return
+            resident.in_use = False
+            resident.released_at = time.monotonic()
+            self.resident_size += size - resident.size
+            resident.size = size
+            self.warm[(kind, key)] = resident
+            if self.resident_size > self.memory_budget:
+                self.condition.notify()
+
+    def contains(self, kind: str, key: str) -> bool:
+        with self.condition:
+            return (kind, key) in self.residents
+
+    def discard(self, kind: str, key: str):
+        """
+        Forgets an object without calling its eviction callback.
+        """
+        with self.condition:
+            self.pop((kind, key))
+
+    def pop(self, resident_key: tuple[str, str]) -> typing.Optional[Resident]:
+        resident = self.residents.pop(resident_key, None)
+        if resident is not None:
+            self.warm.pop(resident_key, None)
+            self.resident_size -= resident.size
+        return resident
+
+    def hit_rate(self, kind: str) -> float:
+        with self.condition:
+            lookups = self.hits[kind] + self.misses[kind]
+            return self.hits[kind] / lookups if lookups else 0.0
+
+    def take_evictable(self, now: float) -> list[Resident]:
+        with self.condition:
+            evicted = []
+            for resident_key, resident in list(self.warm.items()):
+                if now - resident.released_at >= self.grace[resident.kind] or \
+                        self.resident_size > self.memory_budget:
+                    evicted.append(self.pop(resident_key))
+            return evicted
+
+    def evict(self, residents: list[Resident]):
+        for resident in residents:
+            try:
+                resident.on_evict()
+            except Exception:
+                logging.exception(f"Couldn't evict {resident.kind} {resident.key}")
+        if residents:
+            logging.info(f"Evicted {len(residents)} objects, hit rates: "
+                         f"documents {self.hit_rate(DOCUMENT):.0%}, projects {self.hit_rate(PROJECT):.0%}")
+
+    def evict_due(self):
+        self.evict(self.take_evictable(time.monotonic()))
+
+    def evict_all(self):
+        """
+        Evicts every warm object, for shutting down once all clients are closed.
+        """
+        self.evict(self.take_evictable(float("inf")))
+
+    def run(self):
+        while not self.exit_event.is_set():
+            with self.condition:
+                self.condition.wait(self.check_interval)
+            self.evict_due()
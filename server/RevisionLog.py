@@ -0,0 +1,76 @@
+import collections
+import itertools
+import typing
+
+from common.BlockPatches import BlockPatch
+
+if typing.TYPE_CHECKING:
+    from server.RealTimeDocument import RealTimeUser
+
+
+class RevisionLog:
+    """
+    Patches applied to a RealTimeDocument, one revision per document timestamp.
+
+    A single log is shared by every user of the document, instead of each
+    user keeping a copy of the patches pushed by the others. Users only hold
+    the timestamp of the oldest revision they may still be rebased against,
+    and revisions older than every user's are trimmed, so the log is bounded
+    by the oldest revision in use whatever the number of users.
+    """
+
+    def __init__(self, first_timestamp: int = 0):
+        # Document timestamp of revisions[0].
+        self.first_timestamp = first_timestamp
+        self.revisions: collections.deque[tuple['RealTimeUser', BlockPatch]] = collections.deque()
+
+    def __len__(self) -> int:
+        return len(self.revisions)
+
+    @property
+    def next_timestamp(self) -> int:
+        return self.first_timestamp + len(self.revisions)
+
+    def append(self, author: 'RealTimeUser', patch: BlockPatch):
+        self.revisions.append((author, patch))
+
+    def since(self, timestamp: int) -> list[tuple['RealTimeUser', BlockPatch]]:
+        """
+        Revisions from the given document timestamp on, oldest first.
+        """
+        if timestamp < self.first_timestamp:
+            raise ValueError(f"Revision {timestamp} was trimmed, the log starts at {self.first_timestamp}")
+        count = self.next_timestamp - timestamp
+        if count <= 0:
+            return []
+        # Walks back from the newest revision, only the missed ones are visited.
+        revisions = list(itertools.islice(reversed(self.revisions), count))
+        revisions.reverse()
+        return revisions
+
+    def rebase_base(self, rt_user: 'RealTimeUser', timestamp: int) -> BlockPatch:
+        """
+        Patch a change from rt_user based on the given document timestamp has to be rebased to.
+
+        The revisions of the other users since then are added to it, rebasing
+        maps copies of changes so the shared revisions are left untouched. The
+        user's own revisions in between are the earlier patches of the same
+        branch, the patch was made on top of them, so the base is carried over
+        them rather than including them.
+        """
+        base = BlockPatch()
+        for author, revision in self.since(timestamp):
+            if author is rt_user:
+                for _id, change in revision.change_queue:
+                    base.rebase_to_change(change)
+            else:
+                base.add_change(revision)
+        return base
+
+    def trim(self, timestamp: int):
+        """
+        Drops every revision older than the given document timestamp.
+        """
+        while self.revisions and self.first_timestamp < timestamp:
+            self.revisions.popleft()
+            self.first_timestamp += 1
@@ -2,6 +2,8 @@ import threading
 
 from common.Project import Project, Folder, TrashObject, Document
 from server.RealTimeDocument import RealTimeDocument
+from server.DocumentJournal import DocumentJournal
+from server.BlocksCache import cache_path
 import typing
 if typing.TYPE_CHECKING:
     from server.ClientHandler import ClientHandler
@@ -22,6 +24,58 @@ class ServerProject(Project):
 
         self.project_lock = threading.RLock()
 
+        # Paths into the database entry, like ("filesystem", "folders", "Act 1", "documents", "Scene 1"),
+        # changed since it was last written. Taken together by save_updates.
+        self.changed_paths: set[tuple[str, ...]] = set()
+        # Keeps the updates of concurrent saves in the order they were taken.
+        self.save_lock = threading.Lock()
+
+    @staticmethod
+    def folder_entry_path(folder_path: list[str]) -> tuple[str, ...]:
+        entry_path = ("filesystem",)
+        for name in folder_path:
+            entry_path += ("folders", name)
+        return entry_path
+
+    def mark_changed(self, *path: str):
+        with self.project_lock:
+            self.changed_paths.add(path)
+
+    def create_folder(self, path):
+        with self.project_lock:
+            folder, error = super().create_folder(path)
+            if folder is not None:
+                path_split = self.split_path(path)
+                self.mark_changed(*self.folder_entry_path(path_split[:-1]), "folders", path_split[-1])
+            return folder, error
+
+    def add_document(self, folder_path: list[str], name: str, document: Document) -> bool:
+        with self.project_lock:
+            folder = self.get_folder(folder_path)
+            if folder is None or name in folder.documents:
+                return False
+            folder.documents[name] = document
+            self.mark_changed(*self.folder_entry_path(folder_path), "documents", name)
+            return True
+
+    def trash_document(self, folder_path: list[str], name: str, elimination_date: datetime.datetime) -> bool:
+        with self.project_lock:
+            folder = self.get_folder(folder_path)
+            if folder is None or name not in folder.documents or name in self.trash:
+                return False
+            self.trash[name] = TrashObject(folder.documents.pop(name), elimination_date)
+            self.mark_changed(*self.folder_entry_path(folder_path), "documents", name)
+            self.mark_changed("trash", name)
+            return True
+
+    def get_folder(self, folder_path: list[str]) -> typing.Optional[Folder]:
+        folder = self.filesystem
+        for name in folder_path:
+            folder = folder.folders.get(name)
+            if folder is None:
+                return None
+        return folder
+
     def update_trash(self):
         documents_to_eliminate = []
         for name, trash_document in self.trash.items():
@@ -32,6 +86,7 @@ class ServerProject(Project):
         for document in documents_to_eliminate:
             trash_obj = self.trash.pop(document)
             self.destroy_document(trash_obj.document)
+            self.mark_changed("trash", document)
 
     @staticmethod
     def destroy_document(document: Document):
@@ -39,10 +94,18 @@ class ServerProject(Project):
         if not os.path.isfile(path):
             return
         os.remove(path)
+        if os.path.isfile(cache_path(path)):
+            os.remove(cache_path(path))
+        DocumentJournal.remove_files(document.file_id)
         document.file_id = None
 
     def save_to_database(self, db: database.Database):
+        if self.project_id is not None:
+            self.save_updates(db)
+            return
         project_collection = db["projects"]
+        with self.project_lock:
+            self.changed_paths.clear()
         update_result = project_collection.update_one(
             {
                 "name": self.name
@@ -60,34 +123,88 @@ class ServerProject(Project):
             self.project_id = str(update_result.upserted_id)
 
     def save_filesystem(self, db: database.Database):
-        if self.project_id is None:
-            return
-        project_collection = db["projects"]
-        project_collection.update_one(
-            {
-                "_id": bson.ObjectId(self.project_id)
-            },
-            {
-                "$set": {
-                    "filesystem": self.filesystem.to_dict(),
-                }
-            }
-        )
+        self.save_updates(db, "filesystem")
 
     def save_trash(self, db: database.Database):
+        self.save_updates(db, "trash")
+
+    def take_update(self, root: typing.Optional[str] = None) -> tuple[dict, dict]:
+        """
+        The $set and $unset documents writing the paths changed under root, or
+        every changed path, which are then no longer pending.
+
+        A path inside another changed path is written with it, and a path
+        through a name Mongo can't have in a dotted key is cut before that
+        name. Values are read from the project as it is now, so a path
+        changed several times is written once, and one removed is unset.
+        """
+        with self.project_lock:
+            taken = {path for path in self.changed_paths if root is None or path[0] == root}
+            self.changed_paths -= taken
+            paths = set()
+            for path in taken:
+                for i, name in enumerate(path):
+                    if not name or "." in name or name.startswith("$"):
+                        path = path[:i]
+                        break
+                paths.add(path)
+            paths = {path for path in paths if not any(path[:i] in paths for i in range(1, len(path)))}
+
+            to_set = {}
+            to_unset = {}
+            for path in paths:
+                value = self.get_entry_value(path)
+                if value is None:
+                    to_unset[".".join(path)] = ""
+                else:
+                    to_set[".".join(path)] = value
+            return to_set, to_unset
+
+    def get_entry_value(self, path: tuple[str, ...]):
+        value = {"filesystem": self.filesystem, "trash": self.trash}
+        for name in path:
+            if isinstance(value, Folder):
+                value = getattr(value, name) if name in ("folders", "documents") else None
+            elif isinstance(value, dict):
+                value = value.get(name)
+            else:
+                return None
+            if value is None:
+                return None
+        return self.entry_value_to_dict(value)
+
+    @classmethod
+    def entry_value_to_dict(cls, value):
+        if isinstance(value, Document):
+            return value.to_fileid()
+        if isinstance(value, dict):
+            return {name: cls.entry_value_to_dict(v) for name, v in value.items()}
+        return value.to_dict()
+
+    def save_updates(self, db: database.Database, root: typing.Optional[str] = None) -> bool:
+        """
+        Writes the changes made since the last save as one update_one of
+        the changed paths. Returns whether there was anything to write.
+        """
         if self.project_id is None:
-            return
-        project_collection = db["projects"]
-        project_collection.update_one(
-            {
-                "_id": bson.ObjectId(self.project_id)
-            },
-            {
-                "$set": {
-                    "trash": {name: to.to_dict() for name, to in self.trash.items()}
-                }
-            }
-        )
+            return False
+        with self.save_lock:
+            to_set, to_unset = self.take_update(root)
+            if not to_set and not to_unset:
+                return False
+            update = {}
+            if to_set:
+                update["$set"] = to_set
+            if to_unset:
+                update["$unset"] = to_unset
+            try:
+                db["projects"].update_one({"_id": bson.ObjectId(self.project_id)}, update)
+            except Exception:
+                # Written with the next save instead.
+                with self.project_lock:
+                    self.changed_paths.update(tuple(key.split(".")) for key in (*to_set, *to_unset))
+                raise
+            return True
 
     def remove_from_database(self, db: database.Database):
         print(f"Deleting project {self.project_id}")
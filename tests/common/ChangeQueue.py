@@ -0,0 +1,31 @@
+import unittest
+from common.ChangeQueue import ChangeQueue
+
+
+class ChangeQueueTest(unittest.TestCase):
+    def test_drop_before(self):
+        queue = ChangeQueue((id_, f"change {id_}") for id_ in (1, 2, 2, 3, 5))
+        queue.drop_before(3)
+        self.assertEqual([id_ for id_, _change in queue], [3, 5])
+        self.assertNotIn(2, queue)
+        self.assertIn(3, queue)
+
+    def test_remove_ids(self):
+        queue = ChangeQueue((id_, f"change {id_}") for id_ in (1, 1, 2, 3, 4))
+        queue.remove_ids({1, 3})
+        self.assertEqual([id_ for id_, _change in queue], [2, 4])
+        self.assertEqual(queue[0], (2, "change 2"))
+
+    def test_unordered_ids(self):
+        queue = ChangeQueue((id_, None) for id_ in (4, 1, 5, 2))
+        self.assertFalse(queue.monotonic)
+        queue.drop_before(3)
+        self.assertEqual([id_ for id_, _change in queue], [4, 5])
+        queue.remove_ids({5})
+        self.assertEqual(len(queue), 1)
+
+    def test_set_ids(self):
+        queue = ChangeQueue((id_, None) for id_ in (7, 8))
+        queue.set_ids(2)
+        self.assertEqual([id_ for id_, _change in queue], [2, 2])
+        self.assertNotIn(7, queue)
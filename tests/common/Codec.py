@@ -0,0 +1,62 @@
+import unittest
+from common.Codec import *
+from common.Blocks import Block, BlockType, Style
+from common.BlockPatches import BlockPatch, BlockAddChange, BlockDataAddChange, BlockDataRemoveChange
+from common.EndpointCallbackSocket import EndpointCallbackSocket, Endpoint
+from common.FrameCompression import FrameFlag
+from common.ProjectEndpoints import SyncDoc
+from common.ScriptEndpoints import PatchScript
+
+FILE_ID = "0123456789abcdef01234567"
+
+
+class CodecTest(unittest.TestCase):
+    def test_varint(self):
+        buf = bytearray()
+        values = [0, 1, 0x7F, 0x80, 0xFFFF, 1 << 40]
+        for value in values:
+            write_varint(buf, value)
+        self.assertEqual(buf[:4], b"\x00\x01\x7f\x80")
+        rdr = Reader(buf)
+        self.assertEqual([rdr.read_varint() for _ in values], values)
+        self.assertEqual(rdr.remaining, 0)
+
+    def test_truncated(self):
+        with self.assertRaises(CodecError):
+            Reader(b"\x80\x80").read_varint()
+        with self.assertRaises(CodecError):
+            Reader(b"\x05abc").read_str()
+
+    def test_sync_doc(self):
+        blocks = [
+            Block(BlockType.ACTION, ["Text ", Style.ITALICS, "styled", Style.ITALICS]),
+            # Longer than the 65535 characters version 1 can hold.
+            Block(BlockType.DIALOGUE, ["a" * 70000]),
+        ]
+        msg = SyncDoc(FILE_ID, 300, blocks).encode(2)
+        decoded = SyncDoc.decode(memoryview(msg), 2)
+        self.assertEqual(decoded.document_timestamp, 300)
+        self.assertEqual([(b.block_type, b.block_contents) for b in decoded.blocks],
+                         [(b.block_type, b.block_contents) for b in blocks])
+        self.assertIsNone(SyncDoc.decode(msg[:-1], 2))
+
+    def test_patch_frame(self):
+        patch = BlockPatch()
+        patch.change_queue.append((1000, BlockAddChange(2, Block(BlockType.CHARACTER, ["BOB"]))))
+        patch.change_queue.append((1001, BlockDataAddChange(3, ["hi"], 2)))
+        patch.change_queue.append((1001, BlockDataRemoveChange(0, 1, 2)))
+        endpoint = Endpoint(None, PatchScript)
+        for codec_version in (1, 2):
+            frame = EndpointCallbackSocket.encode_frame(PatchScript(FILE_ID, patch, 4, 7), codec_version=codec_version)
+            endpoint_word, msg_size = EndpointCallbackSocket.HEADER.unpack_from(frame)
+            _endpoint, msg, decoded_version = EndpointCallbackSocket.decode_message(
+                endpoint, endpoint_word >> 24, memoryview(frame)[EndpointCallbackSocket.HEADER_SIZE:])
+            self.assertEqual(decoded_version, codec_version)
+            self.assertEqual(bool(endpoint_word >> 24 & FrameFlag.CODEC_V2), codec_version == 2)
+            decoded = PatchScript.decode(msg, decoded_version)
+            self.assertEqual((decoded.branch_id, decoded.document_timestamp), (4, 7))
+            self.assertEqual(decoded.patch.to_bytes(), patch.to_bytes())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import ssl
+import unittest
+from common.EndpointCallbackSocket import EndpointCallbackSocket, Endpoint
+from common.EndpointConstructors import EndpointID, Ping, Pong
+
+
+class BlockedOnceSocket:
+    def __init__(self):
+        self.sent = bytearray()
+        self.blocked = True
+
+    def setblocking(self, _blocking):
+        pass
+
+    def send(self, data) -> int:
+        if self.blocked:
+            self.blocked = False
+            raise ssl.SSLWantWriteError()
+        self.sent += data
+        return len(data)
+
+
+class ReceivingSocket:
+    def __init__(self, data: bytes):
+        self.data = data
+
+    def setblocking(self, _blocking):
+        pass
+
+    def recv_into(self, buffer, size: int) -> int:
+        if not self.data:
+            raise BlockingIOError()
+        received = min(size, len(self.data))
+        buffer[:received] = self.data[:received]
+        self.data = self.data[received:]
+        return received
+
+
+def frame_ids(data: bytes, in_batch: bool = False) -> list[EndpointID]:
+    ids = []
+    offset = 0
+    while offset < len(data):
+        endpoint_word, msg_size = EndpointCallbackSocket.HEADER.unpack_from(data, offset)
+        offset += EndpointCallbackSocket.HEADER_SIZE
+        endpoint_id = EndpointID(endpoint_word & 0xFFFFFF)
+        if endpoint_id != EndpointID.BATCH:
+            ids.append(endpoint_id)
+        elif in_batch:
+            # Receivers don't unpack batches inside batches.
+            ids.append(None)
+        else:
+            ids += frame_ids(data[offset:offset + msg_size], True)
+        offset += msg_size
+    return ids
+
+
+class EndpointCallbackSocketTest(unittest.TestCase):
+    def test_blocked_batch_not_batched_again(self):
+        raw = BlockedOnceSocket()
+        sock = EndpointCallbackSocket(raw, writer_thread=False)
+        sock.batch_frames = True
+        sock.send_endp(Ping())
+        sock.send_endp(Ping())
+        self.assertFalse(sock.flush())
+        sock.send_endp(Pong())
+        self.assertTrue(sock.flush())
+        self.assertEqual(frame_ids(bytes(raw.sent)), [EndpointID.PING, EndpointID.PING, EndpointID.PONG])
+
+    def test_offloaded_callback_holds_later_frames(self):
+        raw = ReceivingSocket(EndpointCallbackSocket.encode_frame(Ping()) + EndpointCallbackSocket.encode_frame(Pong()))
+        sock = EndpointCallbackSocket(raw, writer_thread=False)
+        received = []
+        offloaded = []
+        sock.set_endpoint(Endpoint(lambda _msg: received.append(EndpointID.PING), Ping, offload=True))
+        sock.set_endpoint(Endpoint(lambda _msg: received.append(EndpointID.PONG), Pong))
+        sock.run_offloaded = offloaded.append
+        sock.on_offload_done = sock.do_receive
+        sock.do_receive()
+        self.assertEqual(received, [])
+        self.assertTrue(sock.offloaded)
+        offloaded.pop()()
+        self.assertEqual(received, [EndpointID.PING, EndpointID.PONG])
+        self.assertFalse(sock.offloaded)
+
+
+if __name__ == '__main__':
+    unittest.main()
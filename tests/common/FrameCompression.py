@@ -0,0 +1,39 @@
+import unittest
+from common.FrameCompression import *
+
+
+class FrameCompressionTest(unittest.TestCase):
+    def get_data(self):
+        return b"INT. APARTMENT - NIGHT\n\nShe waits by the door.\n" * 1000
+
+    def test_round_trip(self):
+        data = self.get_data()
+        for codec in (FrameFlag.ZLIB, FrameFlag.ZSTD):
+            if not codec & available_codecs():
+                continue
+            compressed = compress(codec, data)
+            self.assertLess(len(compressed), len(data))
+            self.assertEqual(decompress(codec, memoryview(compressed), len(data)), data)
+
+    def test_size_limit(self):
+        data = self.get_data()
+        for codec in (FrameFlag.ZLIB, FrameFlag.ZSTD):
+            if not codec & available_codecs():
+                continue
+            self.assertIsNone(decompress(codec, compress(codec, data), len(data) - 1))
+
+    def test_unlimited_endpoint_capped(self):
+        bomb = b"\0" * (MAX_DECOMPRESSED_SIZE + 1)
+        for codec in (FrameFlag.ZLIB, FrameFlag.ZSTD):
+            if not codec & available_codecs():
+                continue
+            self.assertIsNone(decompress(codec, compress(codec, bomb), -1))
+            self.assertEqual(len(decompress(codec, compress(codec, bomb[1:]), -1)), MAX_DECOMPRESSED_SIZE)
+
+    def test_invalid_data(self):
+        self.assertIsNone(decompress(FrameFlag.ZLIB, b"not compressed", 4096))
+
+    def test_endpoint_word(self):
+        word = join_endpoint_word(101, FrameFlag.ZLIB)
+        self.assertEqual(split_endpoint_word(word), (101, FrameFlag.ZLIB))
+        self.assertEqual(split_endpoint_word(101), (101, FrameFlag.NONE))
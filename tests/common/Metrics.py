@@ -0,0 +1,31 @@
+import unittest
+from common.Metrics import *
+from common.EndpointConstructors import EndpointID
+
+
+class MetricsTest(unittest.TestCase):
+    def test_counter(self):
+        registry = MetricsRegistry()
+        counter = registry.counter("frames_total", "Frames.", "endpoint")
+        counter.inc(EndpointID.PING)
+        counter.inc(EndpointID.PING, 2)
+        self.assertIn('frames_total{endpoint="PING"} 3', registry.render_text())
+
+    def test_histogram_buckets(self):
+        registry = MetricsRegistry()
+        histogram = registry.histogram("latency_seconds", "Latency.", buckets=(0.1, 1.0))
+        histogram.observe(0.1)
+        histogram.observe(0.5)
+        histogram.observe(2.0)
+        text = registry.render_text()
+        self.assertIn('latency_seconds_bucket{le="0.1"} 1', text)
+        self.assertIn('latency_seconds_bucket{le="1.0"} 2', text)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 3', text)
+        self.assertIn('latency_seconds_count 3', text)
+
+    def test_gauge_function(self):
+        registry = MetricsRegistry()
+        values = [1, 2]
+        registry.gauge("values", "Values.", lambda: len(values))
+        values.append(3)
+        self.assertIn("values 3", registry.render_text())
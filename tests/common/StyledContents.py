@@ -0,0 +1,54 @@
+import unittest
+from common.Blocks import Block, BlockType, Style, encode_styled
+from common.StyledContents import StyledContents, content_size
+
+
+class StyledContentsTest(unittest.TestCase):
+    def get_contents(self):
+        return StyledContents(["Text ", Style.ITALICS, "styled", Style.ITALICS, " hehe."])
+
+    def assertIndexed(self, contents: StyledContents):
+        contents.index_ends()
+        self.assertEqual(contents.ends, [sum(map(content_size, contents[:i + 1])) for i in range(len(contents))])
+
+    def test_insert_at(self):
+        contents = self.get_contents()
+        contents.insert_at(8, ["abc"])
+        self.assertEqual(contents, ["Text ", Style.ITALICS, "st", "abc", "yled", Style.ITALICS, " hehe."])
+        self.assertIndexed(contents)
+        # Right after a marker goes in front of the next text.
+        contents.insert_at(6, ["x"])
+        self.assertEqual(contents[2], "x")
+        self.assertIndexed(contents)
+
+    def test_insert_before_trailing_marker(self):
+        contents = StyledContents(["Text", Style.BOLD])
+        contents.insert_at(5, ["x"])
+        self.assertEqual(contents, ["Text", "x", Style.BOLD])
+
+    def test_remove_range(self):
+        contents = self.get_contents()
+        contents.remove_range(3, 5)
+        self.assertEqual(contents, ["Tex", "yled", Style.ITALICS, " hehe."])
+        self.assertIndexed(contents)
+        contents.remove_range(2, 100)
+        self.assertEqual(contents, ["Te"])
+
+    def test_list_mutations_drop_index(self):
+        contents = self.get_contents()
+        contents.index_ends()
+        contents[2] = "restyled"
+        contents.append("!")
+        self.assertEqual(contents.length(), 22)
+        self.assertIndexed(contents)
+
+    def test_block_encoding_unchanged(self):
+        block = Block(BlockType.ACTION, ["Text ", Style.ITALICS, "styled", Style.ITALICS, " hehe."])
+        self.assertIsInstance(block.block_contents, StyledContents)
+        self.assertEqual(encode_styled(block.block_contents), encode_styled(list(block.block_contents)))
+        self.assertEqual(block.get_block_len(), 19)
+        self.assertEqual(block.get_at(7), "t")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import os
+import tempfile
+import threading
+import unittest
+from common.BlockPatches import BlockPatch, BlockDataAddChange
+from common.Blocks import Block, BlockType
+from server.AutosaveScheduler import AutosaveScheduler
+from server.RealTimeDocument import RealTimeDocument
+
+
+class AutosaveSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        # Documents are saved relative to the working directory.
+        os.chdir(self.directory.name)
+        os.mkdir("documents")
+        self.rtd = RealTimeDocument("doc", "project", [Block(BlockType.ACTION, ["Hello"])])
+        self.scheduler = AutosaveScheduler(threading.Event(), interval=5, max_staleness=60)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    def edit(self, now: float):
+        patch = BlockPatch()
+        patch.add_change(BlockDataAddChange(5, ["!"], 0))
+        self.rtd.push_patch(patch, None)
+        self.rtd.last_edit = now
+        if self.rtd.first_unsaved_edit > now:
+            self.rtd.first_unsaved_edit = now
+
+    def test_save_skips_unchanged(self):
+        self.assertFalse(self.rtd.save())
+        self.edit(0)
+        self.assertTrue(self.rtd.save())
+        self.assertFalse(self.rtd.dirty)
+        self.assertFalse(self.rtd.save())
+        with open(os.path.join("documents", "doc.fountain"), encoding="utf-8") as f:
+            self.assertIn("Hello!", f.read())
+        self.assertEqual(os.listdir("documents"), ["doc.fountain"])
+
+    def test_due_after_idle_interval(self):
+        self.assertFalse(self.scheduler.is_due(self.rtd, 100))
+        self.edit(100)
+        self.assertFalse(self.scheduler.is_due(self.rtd, 104))
+        self.assertTrue(self.scheduler.is_due(self.rtd, 105))
+
+    def test_due_after_max_staleness(self):
+        for now in range(0, 60, 2):
+            self.edit(now)
+            self.assertFalse(self.scheduler.is_due(self.rtd, now + 1))
+        self.edit(60)
+        self.assertTrue(self.scheduler.is_due(self.rtd, 60))
+        self.rtd.save()
+        self.assertFalse(self.scheduler.is_due(self.rtd, 200))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import os
+import tempfile
+import unittest
+from common.FountianParser import FountainParser
+from server.BlocksCache import load_document_blocks, cache_path
+
+SCRIPT = """INT. HOUSE - DAY
+
+John walks in, *slowly*.
+
+JOHN
+Anybody home?
+"""
+
+
+class BlocksCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "doc.fountain")
+        self.write(SCRIPT)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, text: str):
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.write(text)
+
+    @staticmethod
+    def parsed(text: str) -> list:
+        parser = FountainParser()
+        parser.parse(text)
+        return [(block.block_type, list(block.block_contents)) for block in parser.blocks]
+
+    def load(self) -> list:
+        return [(block.block_type, list(block.block_contents)) for block in load_document_blocks(self.path)]
+
+    def test_cache_matches_parser(self):
+        self.assertEqual(self.load(), self.parsed(SCRIPT))
+        self.assertTrue(os.path.isfile(cache_path(self.path)))
+        # Loaded from the cache this time.
+        self.assertEqual(self.load(), self.parsed(SCRIPT))
+
+    def test_stale_cache_regenerated(self):
+        self.load()
+        changed = SCRIPT + "\nJohn leaves.\n"
+        self.write(changed)
+        self.assertEqual(self.load(), self.parsed(changed))
+
+    def test_long_paragraph(self):
+        # Over the 16 bit lengths of the version 1 encoding.
+        long_script = SCRIPT + "\n" + "word " * 20000 + "\n"
+        self.write(long_script)
+        self.assertEqual(self.load(), self.parsed(long_script))
+        self.assertEqual(self.load(), self.parsed(long_script))
+
+    def test_corrupted_cache_ignored(self):
+        self.load()
+        with open(cache_path(self.path), "r+b") as f:
+            f.truncate(os.path.getsize(cache_path(self.path)) - 2)
+        self.assertEqual(self.load(), self.parsed(SCRIPT))
+
+    def test_unreadable_cache_ignored(self):
+        os.mkdir(cache_path(self.path))
+        with self.assertLogs(level="ERROR"):
+            self.assertEqual(self.load(), self.parsed(SCRIPT))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import os
+import tempfile
+import unittest
+from common.BlockPatches import BlockPatch, BlockDataAddChange, BlockAddChange
+from common.Blocks import Block, BlockType
+from server.DocumentJournal import DocumentJournal
+
+
+class DocumentJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.blocks = [Block(BlockType.ACTION, ["First"]), Block(BlockType.DIALOGUE, ["Second"])]
+        self.journal = DocumentJournal("doc", self.directory.name)
+
+    def tearDown(self):
+        self.journal.close()
+        self.directory.cleanup()
+
+    def push(self, *changes):
+        patch = BlockPatch()
+        for change in changes:
+            patch.add_change(change)
+        patch.apply_on_blocks(self.blocks)
+        self.journal.append(patch)
+
+    def snapshot(self):
+        revision = self.journal.revision
+        self.journal.write_snapshot(revision, DocumentJournal.encode_snapshot(revision, self.blocks))
+
+    def recover(self) -> list:
+        journal = DocumentJournal("doc", self.directory.name)
+        blocks = journal.recover()
+        self.assertEqual(journal.revision, self.journal.revision)
+        return [(block.block_type, list(block.block_contents)) for block in blocks]
+
+    def expected(self) -> list:
+        return [(block.block_type, list(block.block_contents)) for block in self.blocks]
+
+    def test_recover_journal_tail(self):
+        self.push(BlockDataAddChange(5, [" typed"], 0))
+        self.snapshot()
+        self.push(BlockAddChange(1, Block(BlockType.CHARACTER, ["NEW"])))
+        self.push(BlockDataAddChange(0, ["Still "], 2))
+        self.journal.commit()
+        self.assertEqual(self.recover(), self.expected())
+
+    def test_snapshot_compacts_journal(self):
+        self.snapshot()
+        for i in range(5):
+            self.push(BlockDataAddChange(0, [str(i)], 1))
+        self.journal.commit()
+        size = os.path.getsize(self.journal.journal_path)
+        self.push(BlockDataAddChange(0, ["x"], 0))
+        self.snapshot()
+        self.assertEqual(os.path.getsize(self.journal.journal_path), 0)
+        self.assertLess(0, size)
+        self.assertEqual(self.recover(), self.expected())
+
+    def test_torn_record_discarded(self):
+        self.snapshot()
+        self.push(BlockDataAddChange(0, ["kept "], 0))
+        self.journal.commit()
+        expected = self.expected()
+        self.push(BlockDataAddChange(0, ["torn "], 0))
+        self.journal.commit()
+        with open(self.journal.journal_path, "r+b") as f:
+            f.truncate(os.path.getsize(self.journal.journal_path) - 3)
+        journal = DocumentJournal("doc", self.directory.name)
+        blocks = journal.recover()
+        self.assertEqual([(block.block_type, list(block.block_contents)) for block in blocks], expected)
+        self.assertEqual(journal.revision, 1)
+
+    def test_long_text(self):
+        # Over the 16 bit lengths of the version 1 encoding.
+        self.push(BlockDataAddChange(0, ["x" * 70000], 0))
+        self.snapshot()
+        self.push(BlockDataAddChange(3, ["y" * 70000], 1))
+        self.journal.commit()
+        self.assertEqual(self.recover(), self.expected())
+
+    def test_no_snapshot(self):
+        self.assertIsNone(DocumentJournal("doc", self.directory.name).recover())
+        self.push(BlockDataAddChange(0, ["x"], 0))
+        self.assertTrue(self.journal.needs_first_snapshot)
+
+
+if __name__ == '__main__':
+    unittest.main()
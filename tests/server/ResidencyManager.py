@@ -0,0 +1,59 @@
+import threading
+import time
+import unittest
+from server.ResidencyManager import ResidencyManager, DOCUMENT, PROJECT
+
+
+class ResidencyManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.manager = ResidencyManager(threading.Event(), memory_budget=1000, document_grace=300,
+                                        project_idle_timeout=1800)
+        self.evicted = []
+
+    def use(self, kind: str, key: str, size: int = 0) -> bool:
+        return self.manager.use(kind, key, lambda: self.evicted.append(key), size)
+
+    def test_hits_and_misses(self):
+        self.assertFalse(self.use(DOCUMENT, "a", 100))
+        self.manager.release(DOCUMENT, "a", 100)
+        self.assertTrue(self.use(DOCUMENT, "a"))
+        self.assertEqual(self.manager.hit_rate(DOCUMENT), 0.5)
+        self.assertEqual(self.manager.hit_rate(PROJECT), 0.0)
+
+    def test_grace_period(self):
+        self.use(DOCUMENT, "a", 100)
+        self.use(PROJECT, "p", 100)
+        self.manager.release(DOCUMENT, "a", 100)
+        self.manager.release(PROJECT, "p", 100)
+        now = time.monotonic()
+        self.manager.evict(self.manager.take_evictable(now + 299))
+        self.assertEqual(self.evicted, [])
+        self.manager.evict(self.manager.take_evictable(now + 301))
+        self.assertEqual(self.evicted, ["a"])
+        self.manager.evict(self.manager.take_evictable(now + 1801))
+        self.assertEqual(self.evicted, ["a", "p"])
+        self.assertEqual(self.manager.resident_size, 0)
+
+    def test_budget_evicts_least_recently_released(self):
+        for key in ("a", "b", "c"):
+            self.use(DOCUMENT, key, 400)
+        self.manager.release(DOCUMENT, "b", 400)
+        self.manager.release(DOCUMENT, "a", 400)
+        self.manager.evict_due()
+        # "c" is in use, so releasing "b" alone gets back under the budget.
+        self.assertEqual(self.evicted, ["b"])
+        self.assertTrue(self.manager.contains(DOCUMENT, "a"))
+        self.assertEqual(self.manager.resident_size, 800)
+
+    def test_in_use_never_evicted(self):
+        self.use(DOCUMENT, "a", 5000)
+        self.manager.evict_all()
+        self.assertEqual(self.evicted, [])
+        self.manager.release(DOCUMENT, "a", 5000)
+        self.use(DOCUMENT, "a")
+        self.manager.evict_all()
+        self.assertEqual(self.evicted, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import datetime
+import unittest
+from common.Project import Folder, Document
+from server.ServerProject import ServerProject
+
+FILE_ID = "0123456789abcdef01234567"
+
+
+class RecordingCollection:
+    def __init__(self):
+        self.updates = []
+
+    def update_one(self, filter_, update, upsert=False):
+        self.updates.append(update)
+
+
+class ServerProjectUpdatesTest(unittest.TestCase):
+    def setUp(self):
+        self.project = ServerProject("project", Folder.new(), {})
+        self.project.project_id = "89abcdef0123456789abcdef"
+        self.collection = RecordingCollection()
+        self.db = {"projects": self.collection}
+
+    def test_path_scoped_set_and_unset(self):
+        self.project.create_folder("Act 1")
+        self.project.save_to_database(self.db)
+        self.project.add_document(["Act 1"], "Scene", Document(FILE_ID))
+        self.project.trash_document(["Act 1"], "Scene", datetime.datetime(2030, 1, 1))
+        self.project.save_to_database(self.db)
+        self.assertEqual(self.collection.updates[0], {
+            "$set": {"filesystem.folders.Act 1": {"folders": {}, "documents": {}}}
+        })
+        update = self.collection.updates[1]
+        self.assertEqual(update["$unset"], {"filesystem.folders.Act 1.documents.Scene": ""})
+        self.assertEqual(list(update["$set"]), ["trash.Scene"])
+        self.assertFalse(self.project.save_updates(self.db))
+        self.assertEqual(len(self.collection.updates), 2)
+
+    def test_edits_coalesced(self):
+        self.project.create_folder("Act 1")
+        for i in range(5):
+            self.project.add_document(["Act 1"], f"Scene {i}", Document(FILE_ID))
+        self.project.save_filesystem(self.db)
+        # The new folder is written with its documents, once.
+        self.assertEqual(len(self.collection.updates), 1)
+        self.assertEqual(list(self.collection.updates[0]["$set"]), ["filesystem.folders.Act 1"])
+        self.assertEqual(len(self.collection.updates[0]["$set"]["filesystem.folders.Act 1"]["documents"]), 5)
+
+    def test_dotted_name_writes_parent(self):
+        self.project.add_document([], "scene.fountain", Document(FILE_ID))
+        self.project.save_filesystem(self.db)
+        self.assertEqual(list(self.collection.updates[0]["$set"]), ["filesystem.documents"])
+
+
+if __name__ == '__main__':
+    unittest.main()